@@ -0,0 +1,201 @@
+import hmac
+import json
+from functools import wraps
+from flask import Blueprint, Response, current_app, g, jsonify, request, stream_with_context, url_for
+from api_keys import hash_api_key
+from bulk import read_csv, read_ndjson, import_urls, insert_chunk
+from cache import MISSING
+from clicks import parse_click_batch, write_clicks
+from forms import original_url_error
+from links import (find_link, link_policy, link_policy_error, row_policy, link_expiry, expires_in_error,
+                   is_expired)
+from pagination import URL_SORTS, DEFAULT_SORT
+from storage import StorageError
+
+# Versioned JSON API, authenticated with API keys instead of session cookies and CSRF tokens
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+# Get shared app service (storage, caches, click buffer, code allocator)
+def service(name):
+  return current_app.extensions['shortener'][name]
+
+# JSON error response
+def api_error(message, status):
+  return jsonify({'error': message}), status
+
+# JSON response for read endpoints, answered with 304 when client's If-None-Match matches its ETag
+def conditional_json(data):
+  response = jsonify(data)
+  response.cache_control.private = True
+  response.cache_control.no_cache = True
+  response.vary.update(('Authorization', 'X-API-Key'))
+  response.add_etag()
+  return response.make_conditional(request)
+
+# Public representation of a URL row
+def link_json(row):
+  return {
+    'shortened_url': row['shortened_url'],
+    'short_url': url_for('redirect_url', shortened_url=row['shortened_url'], _external=True),
+    'original_url': row['original_url'],
+    'clicks': row['clicks'],
+    'redirect_status': row['redirect_status'],
+    'cache_max_age': row['cache_max_age'],
+    'expires_at': row['expires_at'],
+  }
+
+# Get URL row owned by API user, with pending clicks added, None if not found
+def owned_link(shortened_url):
+  url_row = service('storage').get_user_url(shortened_url, g.api_user['id'])
+  return service('click_buffer').apply([url_row])[0] if url_row else None
+
+# Require a valid API key in X-API-Key or Authorization: Bearer header, sets g.api_user
+def require_api_key(view):
+  @wraps(view)
+  def wrapper(*args, **kwargs):
+    key = request.headers.get('X-API-Key')
+    authorization = request.headers.get('Authorization', '')
+    if not key and authorization.startswith('Bearer '):
+      key = authorization[len('Bearer '):]
+    if not key:
+      return api_error('API key required!', 401)
+    cache = service('api_key_cache')
+    key_hash = hash_api_key(key)
+    user = cache.get(key_hash)
+    if user is None:
+      try:
+        user_row = service('storage').api_key_user(key_hash)
+      except StorageError as e:
+        print(e) # Log error to server only
+        return api_error('Database error!', 500)
+      user = dict(user_row) if user_row else MISSING
+      cache.set(key_hash, user)
+    if user is MISSING:
+      return api_error('Invalid API key!', 401)
+    g.api_user = user
+    return view(*args, **kwargs)
+  return wrapper
+
+# Bulk create short URLs from a streamed CSV (text/csv) or NDJSON body
+# Results are streamed back as NDJSON, one line per input line, as each chunk is committed
+@api.route('/links/bulk', methods=['POST'])
+@require_api_key
+def bulk_create():
+  lines = (line.decode('utf-8', 'replace') for line in request.stream)
+  records = read_csv(lines) if request.mimetype == 'text/csv' else read_ndjson(lines)
+  user = g.api_user
+  chunk_size = current_app.config['BULK_CHUNK_SIZE']
+
+  def generate():
+    try:
+      for result in import_urls(service('storage'), user['id'], user['username'], service('code_allocator'), records,
+                                chunk_size, on_created=service('link_cache').invalidate):
+        yield json.dumps(result) + '\n'
+    except StorageError as e:
+      print(e) # Log error to server only
+      yield json.dumps({'error': 'Database error!'}) + '\n'
+
+  return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Resolve short code to its original URL, without counting a click
+@api.route('/links/<shortened_url>', methods=['GET'])
+@require_api_key
+def resolve_link(shortened_url):
+  try:
+    url_row = find_link(service('link_cache'), service('storage'), shortened_url)
+  except StorageError as e:
+    print(e) # Log error to server only
+    return api_error('Database error!', 500)
+  if not url_row:
+    return api_error('URL not found!', 404)
+  if is_expired(url_row):
+    return api_error('URL has expired!', 410)
+  redirect_status, cache_max_age = row_policy(url_row)
+  return conditional_json({'shortened_url': shortened_url, 'original_url': url_row['original_url'],
+                           'redirect_status': redirect_status, 'cache_max_age': cache_max_age})
+
+# Create short URL from JSON body {"original_url": "...", "redirect_status": 302, "cache_max_age": 0, "expires_in": 3600}
+# redirect_status (301, 302, 307 or 308) and cache_max_age (seconds) are optional, see links.link_policy,
+# expires_in is the link's lifetime in seconds, it never expires without one
+@api.route('/links', methods=['POST'])
+@require_api_key
+def create_link():
+  data = request.get_json(silent=True)
+  if not isinstance(data, dict):
+    data = {}
+  original_url = data.get('original_url')
+  error = original_url_error(original_url) if isinstance(original_url, str) else 'Invalid URL!'
+  error = error or link_policy_error(data.get('redirect_status'), data.get('cache_max_age'))
+  error = error or expires_in_error(data.get('expires_in'))
+  if error:
+    return api_error(error, 400)
+  policy = link_policy(data.get('redirect_status'), data.get('cache_max_age'), current_app.config['REDIRECT_CACHE_MAX_AGE'])
+  expires_at = link_expiry(data.get('expires_in'))
+  user = g.api_user
+  try:
+    result = insert_chunk(service('storage'), user['id'], user['username'], service('code_allocator'), [(1, original_url)],
+                          policy, expires_at)[0]
+  except StorageError as e:
+    print(e) # Log error to server only
+    return api_error('Database error!', 500)
+  # Drop a cached 404 for this code, if any
+  service('link_cache').invalidate(result['shortened_url'])
+  link = link_json({'shortened_url': result['shortened_url'], 'original_url': original_url, 'clicks': 0,
+                    'redirect_status': policy[0], 'cache_max_age': policy[1], 'expires_at': expires_at})
+  return jsonify(link), 201
+
+# List API user's URLs, one keyset page at a time (?sort=recent|clicks&after=<next>&limit=<n>)
+@api.route('/links', methods=['GET'])
+@require_api_key
+def list_links():
+  sort = request.args.get('sort', DEFAULT_SORT)
+  if sort not in URL_SORTS:
+    sort = DEFAULT_SORT
+  limit = min(max(request.args.get('limit', current_app.config['LISTING_PAGE_SIZE'], type=int), 1),
+              current_app.config['API_MAX_PAGE_SIZE'])
+  try:
+    page = service('storage').user_urls_page(g.api_user['id'], sort, request.args.get('after'), limit,
+                          service('click_buffer').applier())
+    links = [link_json(row) for row in page]
+  except StorageError as e:
+    print(e) # Log error to server only
+    return api_error('Database error!', 500)
+  return conditional_json({'links': links, 'sort': sort, 'next': page.next_page})
+
+# Clicks of API user's URL, total and per hour/day from rollups
+@api.route('/links/<shortened_url>/stats', methods=['GET'])
+@require_api_key
+def link_stats(shortened_url):
+  try:
+    url = owned_link(shortened_url)
+    if not url:
+      return api_error('URL not found!', 404)
+    hourly, daily = service('storage').url_click_stats(url['id'])
+  except StorageError as e:
+    print(e) # Log error to server only
+    return api_error('Database error!', 500)
+  stats = link_json(url)
+  stats['hourly'] = [{'hour': row['bucket'], 'clicks': row['clicks']} for row in hourly]
+  stats['daily'] = [{'day': row['bucket'], 'clicks': row['clicks']} for row in daily]
+  return conditional_json(stats)
+
+# Click batches of redirect replicas (see clicks.RemoteClickBuffer), written to the DB like a click buffer flush
+# Authenticated with the REPLICA_TOKEN shared with replicas instead of an API key, not found if there's none
+@api.route('/replica/clicks', methods=['POST'])
+def replica_clicks():
+  token = current_app.config['REPLICA_TOKEN']
+  if not token:
+    return api_error('Not found!', 404)
+  authorization = request.headers.get('Authorization', '').encode()
+  if not hmac.compare_digest(authorization, ('Bearer ' + token).encode()):
+    return api_error('Invalid replica token!', 401)
+  batch = parse_click_batch(request.get_json(silent=True))
+  if batch is None:
+    return api_error('Invalid click batch!', 400)
+  counts, events = batch
+  try:
+    write_clicks(service('storage'), counts, events)
+  except StorageError as e:
+    print(e) # Log error to server only
+    return api_error('Database error!', 500)
+  return jsonify({'clicks': sum(counts.values()), 'events': len(events)})
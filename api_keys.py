@@ -0,0 +1,12 @@
+import hashlib
+import secrets
+
+# API keys are only stored hashed, the plain key is shown once on creation
+def hash_api_key(key):
+  return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+# Create API key for user, returns plain key
+def create_api_key(storage, user_id, name=None):
+  key = secrets.token_urlsafe(32)
+  storage.add_api_key(user_id, hash_api_key(key), name)
+  return key
@@ -1,101 +1,605 @@
 import os
-import sqlite3
+import hmac
+import math
+import time
+import json
+import hashlib
+import click
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (Flask, Response, render_template, stream_template, request, redirect, url_for, flash, session, g,
+                   has_request_context)
+from flask.cli import AppGroup
+from werkzeug.middleware.proxy_fix import ProxyFix
+from jinja2 import FileSystemBytecodeCache
 from flask_login import LoginManager, login_user, current_user, logout_user
 from flask_bcrypt import Bcrypt
 from flask_wtf.csrf import CSRFProtect
 from models import User
-from utils import generate_short_url
+from storage import create_storage, StorageError
+from api import api
+from api_keys import create_api_key, hash_api_key
+from assets import ASSETS_DIR, build_assets, load_manifest, manifest_path
+from bulk import read_csv, read_ndjson, import_urls, insert_chunk
+from pagination import URL_SORTS, DEFAULT_SORT
+from cache import LRUCache
+from links import find_link, link_policy, link_expiry, is_expired, redirect_policy
+from clicks import ClickBuffer, SharedClickBuffer, RemoteClickBuffer, MAX_BUFFERED_EVENTS
+from purge import LinkPurger
+from snapshot import LinkSnapshot, write_snapshot
+from code_index import CodeIndex, build_code_index
+from shared_tier import SharedTier, SharedCache, connect as connect_shared_tier
+from throttle import LoginThrottle, SharedLoginThrottle
+from ratelimit import RateLimiter, SharedRateLimiter, parse_budget
+from passwords import PasswordHasher, HasherBusy
+from metrics import Registry, QueryMetrics, register_caches, register_pool, parse_networks, address_in
+from utils import ShortCodeAllocator, DEFAULT_ALPHABET, DEFAULT_LENGTH
 from forms import (LoginForm, RegisterForm, ProfileForm, CreateURLForm, SearchForm)
 
 # For Development environment, env.py must be set, for Production, environmental variables must be set by system
 if os.path.exists('env.py'):
   import env
 
-# Database connection details
-db_file = os.environ.get('DATABASE_URL')
-
 # App Configuration
 app = Flask(__name__)
 
 # Config app
 config = {
   'SECRET_KEY': os.environ.get('SECRET_KEY'),
+  # Database: SQLite file path, or postgresql:// URL (needs psycopg)
+  'DATABASE': os.environ.get('DATABASE_URL'),
   'RECAPTCHA_PUBLIC_KEY': os.environ.get('RC_SITE_KEY'),
   'RECAPTCHA_PRIVATE_KEY': os.environ.get('RC_SECRET_KEY'),
+  # Short URL lookup cache: max entries, TTL of found links and of not found (404) codes, in seconds
+  'LINK_CACHE_SIZE': int(os.environ.get('LINK_CACHE_SIZE', 10000)),
+  'LINK_CACHE_TTL': int(os.environ.get('LINK_CACHE_TTL', 300)),
+  'LINK_CACHE_NEGATIVE_TTL': int(os.environ.get('LINK_CACHE_NEGATIVE_TTL', 30)),
+  # Click counters are written to DB every N milliseconds or every N clicks, whichever comes first
+  'CLICK_FLUSH_INTERVAL_MS': int(os.environ.get('CLICK_FLUSH_INTERVAL_MS', 1000)),
+  'CLICK_FLUSH_THRESHOLD': int(os.environ.get('CLICK_FLUSH_THRESHOLD', 500)),
+  # Click events each worker keeps while flushes fail, later ones are dropped (their clicks are still counted)
+  'CLICK_BUFFER_MAX_EVENTS': int(os.environ.get('CLICK_BUFFER_MAX_EVENTS', MAX_BUFFERED_EVENTS)),
+  # Short code format, key used to shuffle codes (defaults to SECRET_KEY, empty for sequential codes)
+  # and number of sequence ids each worker reserves at once
+  'SHORT_CODE_LENGTH': int(os.environ.get('SHORT_CODE_LENGTH', DEFAULT_LENGTH)),
+  'SHORT_CODE_ALPHABET': os.environ.get('SHORT_CODE_ALPHABET', DEFAULT_ALPHABET),
+  'SHORT_CODE_KEY': os.environ.get('SHORT_CODE_KEY', os.environ.get('SECRET_KEY')),
+  'SHORT_CODE_BLOCK_SIZE': int(os.environ.get('SHORT_CODE_BLOCK_SIZE', 100)),
+  # Number of search results per page
+  'SEARCH_PAGE_SIZE': int(os.environ.get('SEARCH_PAGE_SIZE', 20)),
+  # Number of URLs per page in My URLs and profile listings, and whether listings are streamed while rendering
+  'LISTING_PAGE_SIZE': int(os.environ.get('LISTING_PAGE_SIZE', 50)),
+  'STREAM_LISTINGS': os.environ.get('STREAM_LISTINGS', 'False').lower() in ('1', 'true', 'yes'),
+  # Loaded users cache: max entries and TTL in seconds
+  'USER_CACHE_SIZE': int(os.environ.get('USER_CACHE_SIZE', 1000)),
+  'USER_CACHE_TTL': int(os.environ.get('USER_CACHE_TTL', 60)),
+  # Carry logged in user's profile in the signed session cookie, refreshed from DB after max age in seconds
+  'USER_SESSION_SNAPSHOT': os.environ.get('USER_SESSION_SNAPSHOT', 'False').lower() in ('1', 'true', 'yes'),
+  'USER_SNAPSHOT_MAX_AGE': int(os.environ.get('USER_SNAPSHOT_MAX_AGE', 300)),
+  # URLs inserted per transaction by bulk imports
+  'BULK_CHUNK_SIZE': int(os.environ.get('BULK_CHUNK_SIZE', 500)),
+  # Largest page of links the API returns
+  'API_MAX_PAGE_SIZE': int(os.environ.get('API_MAX_PAGE_SIZE', 500)),
+  # Threads used by the ASGI redirect path (asgi.py) for DB lookups on cache misses
+  'ASGI_DB_THREADS': int(os.environ.get('ASGI_DB_THREADS', 8)),
+  # Optional tier shared by all workers (Redis protocol) for link/user caches, click counters and login throttling
+  # e.g. redis://localhost:6379/0, memory:// for an in-process stand-in, empty to keep everything per worker
+  'REDIS_URL': os.environ.get('REDIS_URL'),
+  'REDIS_KEY_PREFIX': os.environ.get('REDIS_KEY_PREFIX', 'shortener:'),
+  # Socket timeout of tier calls and seconds the tier is skipped after a failure, in seconds
+  'REDIS_TIMEOUT': float(os.environ.get('REDIS_TIMEOUT', 0.25)),
+  'REDIS_RETRY_INTERVAL': float(os.environ.get('REDIS_RETRY_INTERVAL', 5)),
+  # Seconds each worker keeps shared cache entries locally, bounds how late other workers see invalidations
+  'SHARED_CACHE_LOCAL_TTL': int(os.environ.get('SHARED_CACHE_LOCAL_TTL', 5)),
+  # Cache lifetime in seconds of permanent (301/308) redirects created without one
+  'REDIRECT_CACHE_MAX_AGE': int(os.environ.get('REDIRECT_CACHE_MAX_AGE', 86400)),
+  # Cache lifetime in seconds of static assets built with "flask assets build" (their names change with content)
+  'ASSET_MAX_AGE': int(os.environ.get('ASSET_MAX_AGE', 31536000)),
+  # Seconds browsers may keep the visitors' home page without asking again, 0 to revalidate it (by ETag) every time
+  'PAGE_CACHE_MAX_AGE': int(os.environ.get('PAGE_CACHE_MAX_AGE', 0)),
+  # Directory where compiled templates are kept for other workers and restarts, empty to compile in every worker
+  'TEMPLATE_CACHE_DIR': os.environ.get('TEMPLATE_CACHE_DIR'),
+  # Expired links are deleted every N seconds (0 to only purge with "flask urls purge"), N links per transaction,
+  # by the one process started with PURGE_WORKER set (e.g. a single-worker instance), or by the command from cron
+  'PURGE_INTERVAL': int(os.environ.get('PURGE_INTERVAL', 3600)),
+  'PURGE_BATCH_SIZE': int(os.environ.get('PURGE_BATCH_SIZE', 500)),
+  'PURGE_WORKER': os.environ.get('PURGE_WORKER', 'False').lower() in ('1', 'true', 'yes'),
+  # Links never clicked N days after creation are deleted too, 0 to keep them. Permanent (301/308) or cacheable
+  # links are kept, their clicks can be answered by browsers and proxies. The purge writes out the pending clicks
+  # of all workers only through the shared tier (REDIS_URL): without it, clicks still buffered in other workers
+  # (up to CLICK_FLUSH_INTERVAL_MS) aren't seen. Purged links are dropped from the purging process's link cache
+  # only (link_cache.invalidate is local), other workers may redirect them until their LINK_CACHE_TTL is up
+  'PURGE_UNCLICKED_DAYS': int(os.environ.get('PURGE_UNCLICKED_DAYS', 0)),
+  # Redirect replica mode: path of a link snapshot written on the primary with "flask urls snapshot", checked for
+  # a new version every N seconds. Replicas answer redirects from it, send their clicks to PRIMARY_URL in batches
+  # and redirect every other page there
+  'REPLICA_SNAPSHOT': os.environ.get('REPLICA_SNAPSHOT'),
+  'SNAPSHOT_CHECK_INTERVAL': int(os.environ.get('SNAPSHOT_CHECK_INTERVAL', 5)),
+  'PRIMARY_URL': os.environ.get('PRIMARY_URL'),
+  # Secret shared by the primary and its replicas, which send it with their clicks (none accepted if not set)
+  'REPLICA_TOKEN': os.environ.get('REPLICA_TOKEN'),
+  'REPLICA_CLICK_TIMEOUT': float(os.environ.get('REPLICA_CLICK_TIMEOUT', 5)),
+  # Memory-mapped code index file answering redirect lookups before the DB (built with "flask urls index"),
+  # seconds between reads of links other workers created or deleted since. Only for workers sharing one host
+  'CODE_INDEX': os.environ.get('CODE_INDEX'),
+  'CODE_INDEX_CHECK_INTERVAL': float(os.environ.get('CODE_INDEX_CHECK_INTERVAL', 1)),
+  # Links created or deleted since the last build a worker keeps in memory, past that it rebuilds the index
+  'CODE_INDEX_MAX_DELTA': int(os.environ.get('CODE_INDEX_MAX_DELTA', 100000)),
+  # Number of reverse proxies (load balancer, CDN) in front of the app, each adding the address it got the request
+  # from to X-Forwarded-For. Client IPs (login throttling, rate limits) are read from there, 0 uses the address of
+  # the connection, i.e. of the proxy if there is one (the header can't be trusted without proxies)
+  'TRUSTED_PROXY_HOPS': int(os.environ.get('TRUSTED_PROXY_HOPS', 0)),
+  # Path the app is served under by the proxy in front of it, e.g. /s (links of pre-rendered pages point there)
+  'APPLICATION_ROOT': os.environ.get('APPLICATION_ROOT', '/'),
+  # Login attempts allowed per account and per client IP within a sliding window of minutes
+  'LOGIN_MAX_ATTEMPTS': int(os.environ.get('LOGIN_MAX_ATTEMPTS', 5)),
+  'LOGIN_IP_MAX_ATTEMPTS': int(os.environ.get('LOGIN_IP_MAX_ATTEMPTS', 50)),
+  'LOGIN_WINDOW_MINUTES': int(os.environ.get('LOGIN_WINDOW_MINUTES', 30)),
+  # Requests each client may send per route group, as "<requests>/<seconds>": bursts of up to <requests>, refilled
+  # over <seconds>. Redirects are counted per IP, search per user (per IP for visitors), creating URLs per user and
+  # API calls per key. Empty to not limit a group, RATE_LIMIT_ENABLED=false to turn limiting off
+  'RATE_LIMIT_ENABLED': os.environ.get('RATE_LIMIT_ENABLED', 'True').lower() in ('1', 'true', 'yes'),
+  'RATE_LIMIT_REDIRECT': os.environ.get('RATE_LIMIT_REDIRECT', '300/60'),
+  'RATE_LIMIT_SEARCH': os.environ.get('RATE_LIMIT_SEARCH', '30/60'),
+  'RATE_LIMIT_SHORTEN': os.environ.get('RATE_LIMIT_SHORTEN', '30/60'),
+  'RATE_LIMIT_API': os.environ.get('RATE_LIMIT_API', '600/60'),
+  # bcrypt cost of new password hashes, older hashes are rehashed on the user's next login
+  'BCRYPT_LOG_ROUNDS': int(os.environ.get('BCRYPT_LOG_ROUNDS', 12)),
+  # Threads hashing/checking passwords, and requests allowed to wait for one before getting a 429
+  'PASSWORD_HASH_WORKERS': int(os.environ.get('PASSWORD_HASH_WORKERS', 2)),
+  'PASSWORD_HASH_QUEUE': int(os.environ.get('PASSWORD_HASH_QUEUE', 8)),
+  # Request/query timing and counters served on /metrics (Prometheus text format), per worker process
+  # It isn't public: scrapers must send METRICS_TOKEN as "Authorization: Bearer <token>", or connect from one of
+  # METRICS_NETWORKS (comma separated addresses or CIDR networks, e.g. 10.0.0.0/8, read through TRUSTED_PROXY_HOPS).
+  # With neither set, /metrics answers 404
+  'METRICS_ENABLED': os.environ.get('METRICS_ENABLED', 'True').lower() in ('1', 'true', 'yes'),
+  'METRICS_TOKEN': os.environ.get('METRICS_TOKEN'),
+  'METRICS_NETWORKS': os.environ.get('METRICS_NETWORKS', ''),
+  # Queries taking at least this many milliseconds are logged with their SQL, 0 to disable
+  'SLOW_QUERY_MS': float(os.environ.get('SLOW_QUERY_MS', 0)),
 }
 app.config.update(config)
 
+# request.remote_addr is the client's IP as seen by the outermost trusted proxy, see TRUSTED_PROXY_HOPS
+if app.config['TRUSTED_PROXY_HOPS']:
+  app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXY_HOPS'])
+
+# Compiled templates read from and written to TEMPLATE_CACHE_DIR, before any template is loaded
+if app.config['TEMPLATE_CACHE_DIR']:
+  os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+  app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])
+
+# Redirect replicas serve redirects from a link snapshot, see REPLICA_SNAPSHOT
+replica = bool(app.config['REPLICA_SNAPSHOT'])
+if replica and not app.config['PRIMARY_URL']:
+  raise RuntimeError('PRIMARY_URL must be set when REPLICA_SNAPSHOT is')
+
+# Routes a redirect replica serves itself, anything else is sent to the primary
+REPLICA_ENDPOINTS = ('redirect_url', 'static', 'metrics_page')
+
+def to_primary():
+  if request.endpoint not in REPLICA_ENDPOINTS:
+    # 307 keeps method and body of form posts
+    return redirect(app.config['PRIMARY_URL'].rstrip('/') + request.full_path.rstrip('?'), code=307)
+
+# Registered before CSRF protection, which would reject form posts meant for the primary
+if replica:
+  app.before_request(to_primary)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
 bcrypt = Bcrypt(app)
 csrf = CSRFProtect(app)
+# Login and register hash passwords on a bounded pool, away from redirect traffic
+password_hasher = PasswordHasher(bcrypt, log_rounds=app.config['BCRYPT_LOG_ROUNDS'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 queue_size=app.config['PASSWORD_HASH_QUEUE'])
+# Storage backend (SQLite or PostgreSQL) with pooled connections, reused between requests
+storage = create_storage(app)
+# Optional memory-mapped index of links, read by lookups before the DB
+if app.config['CODE_INDEX']:
+  storage.code_index = CodeIndex(app.config['CODE_INDEX'],
+                                 alphabet=app.config['SHORT_CODE_ALPHABET'],
+                                 length=app.config['SHORT_CODE_LENGTH'],
+                                 check_interval=app.config['CODE_INDEX_CHECK_INTERVAL'],
+                                 max_delta=app.config['CODE_INDEX_MAX_DELTA'],
+                                 rebuild=lambda: build_code_index(storage, app.config['CODE_INDEX'],
+                                                                  alphabet=app.config['SHORT_CODE_ALPHABET'],
+                                                                  length=app.config['SHORT_CODE_LENGTH']))
+# Optional tier shared by all workers, None when REDIS_URL isn't set
+shared_tier = None
+if app.config['REDIS_URL']:
+  shared_tier = SharedTier(connect_shared_tier(app.config['REDIS_URL'], app.config['REDIS_TIMEOUT']),
+                           prefix=app.config['REDIS_KEY_PREFIX'],
+                           retry_interval=app.config['REDIS_RETRY_INTERVAL'])
+
+# Login throttling limits, counted per account and per client IP
+login_limits = dict(max_attempts=app.config['LOGIN_MAX_ATTEMPTS'],
+                    max_ip_attempts=app.config['LOGIN_IP_MAX_ATTEMPTS'],
+                    window=timedelta(minutes=app.config['LOGIN_WINDOW_MINUTES']))
+
+# Request rate budgets of route groups, see rate_limit
+rate_budgets = {name: budget for name, budget in (
+  ('redirect', parse_budget(app.config['RATE_LIMIT_REDIRECT'])),
+  ('search', parse_budget(app.config['RATE_LIMIT_SEARCH'])),
+  ('shorten', parse_budget(app.config['RATE_LIMIT_SHORTEN'])),
+  ('api', parse_budget(app.config['RATE_LIMIT_API'])),
+) if budget}
+
+if shared_tier:
+  # Short URL lookups and users cached once for all workers, each keeping a short-lived local copy
+  # Falls back to the DB for anything not cached locally while the tier is down
+  link_cache = SharedCache(shared_tier, 'link', dumps=lambda row: json.dumps(dict(row)), loads=json.loads,
+                           maxsize=app.config['LINK_CACHE_SIZE'],
+                           ttl=app.config['LINK_CACHE_TTL'],
+                           negative_ttl=app.config['LINK_CACHE_NEGATIVE_TTL'],
+                           local_ttl=app.config['SHARED_CACHE_LOCAL_TTL'])
+  # Users are stored as snapshots, password hashes never leave the DB
+  user_cache = SharedCache(shared_tier, 'user',
+                           dumps=lambda user: json.dumps(user.to_snapshot()),
+                           loads=lambda raw: User.from_snapshot(json.loads(raw)),
+                           maxsize=app.config['USER_CACHE_SIZE'],
+                           ttl=app.config['USER_CACHE_TTL'],
+                           local_ttl=app.config['SHARED_CACHE_LOCAL_TTL'])
+  # Click counters incremented atomically in the tier, drained to the DB in batches by any worker
+  click_buffer = SharedClickBuffer(storage, shared_tier,
+                                   flush_interval=app.config['CLICK_FLUSH_INTERVAL_MS'] / 1000,
+                                   flush_threshold=app.config['CLICK_FLUSH_THRESHOLD'],
+                                   max_events=app.config['CLICK_BUFFER_MAX_EVENTS'])
+  # Login attempt counters kept in the tier
+  login_throttle = SharedLoginThrottle(storage, shared_tier, **login_limits)
+  # Request rates counted in the tier, so limits hold across workers
+  rate_limiter = SharedRateLimiter(shared_tier, rate_budgets)
+else:
+  # In-process cache of short URL lookups used by redirect_url (per worker, bounded by TTL)
+  link_cache = LRUCache(maxsize=app.config['LINK_CACHE_SIZE'],
+                        ttl=app.config['LINK_CACHE_TTL'],
+                        negative_ttl=app.config['LINK_CACHE_NEGATIVE_TTL'])
+  # In-process cache of User objects used by load_user, invalidated on profile edit
+  user_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+  # Buffered click counts, flushed in batches in the background and on shutdown
+  click_buffer = ClickBuffer(storage,
+                             flush_interval=app.config['CLICK_FLUSH_INTERVAL_MS'] / 1000,
+                             flush_threshold=app.config['CLICK_FLUSH_THRESHOLD'],
+                             max_events=app.config['CLICK_BUFFER_MAX_EVENTS'])
+  # Login attempt counters kept in the login_attempts table
+  login_throttle = LoginThrottle(storage, **login_limits)
+  # Request rates counted per worker
+  rate_limiter = RateLimiter(rate_budgets)
+# Where redirects look links up: the DB, or the link snapshot on redirect replicas
+link_source = storage
+if replica:
+  link_source = LinkSnapshot(app.config['REPLICA_SNAPSHOT'], check_interval=app.config['SNAPSHOT_CHECK_INTERVAL'])
+  # Clicks are counted here and written by the primary
+  click_buffer = RemoteClickBuffer(app.config['PRIMARY_URL'], app.config['REPLICA_TOKEN'],
+                                   timeout=app.config['REPLICA_CLICK_TIMEOUT'],
+                                   flush_interval=app.config['CLICK_FLUSH_INTERVAL_MS'] / 1000,
+                                   flush_threshold=app.config['CLICK_FLUSH_THRESHOLD'],
+                                   max_events=app.config['CLICK_BUFFER_MAX_EVENTS'])
+# Unique short code allocator, mints codes from per-worker blocks of sequence ids
+code_allocator = ShortCodeAllocator(storage,
+                                    alphabet=app.config['SHORT_CODE_ALPHABET'],
+                                    length=app.config['SHORT_CODE_LENGTH'],
+                                    key=app.config['SHORT_CODE_KEY'],
+                                    block_size=app.config['SHORT_CODE_BLOCK_SIZE'])
+
+# Deletes expired (and optionally never clicked) links in small batches, then compacts the DB
+link_purger = LinkPurger(storage, link_cache, click_buffer,
+                         interval=app.config['PURGE_INTERVAL'],
+                         batch_size=app.config['PURGE_BATCH_SIZE'],
+                         unclicked_age=app.config['PURGE_UNCLICKED_DAYS'] * 86400)
+
+# Cache of API key owners, so API requests don't look up their key every time (revocation applies after TTL)
+api_key_cache = LRUCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+# Shared services, used by blueprints through current_app.extensions
+app.extensions['shortener'] = {
+  'storage': storage,
+  'link_cache': link_cache,
+  'user_cache': user_cache,
+  'api_key_cache': api_key_cache,
+  'click_buffer': click_buffer,
+  'code_allocator': code_allocator,
+}
+
+# Metrics of this worker process, served on /metrics
+metrics = Registry()
+# Scrapers allowed without a token, see METRICS_NETWORKS
+metrics_networks = parse_networks(app.config['METRICS_NETWORKS'])
+request_latency = metrics.histogram('shortener_request_duration_seconds', 'Time spent handling requests, by route.',
+                                    ['endpoint', 'method'])
+responses = metrics.counter('shortener_responses_total', 'Responses sent, by route and status code.',
+                            ['endpoint', 'method', 'status'])
+logins = metrics.counter('shortener_logins_total', 'Login attempts by result.', ['result'])
+if app.config['METRICS_ENABLED']:
+  # Time every query of the storage backend, logging slow ones
+  storage.metrics = QueryMetrics(metrics, slow_query_seconds=app.config['SLOW_QUERY_MS'] / 1000)
+  register_pool(metrics, storage)
+  register_caches(metrics, {'link': link_cache, 'user': user_cache, 'api_key': api_key_cache})
+  metrics.collected('shortener_click_flushes_total', 'Click buffer flushes written to the DB.', [],
+                    lambda: [((), click_buffer.flushes)], kind='counter')
+  metrics.collected('shortener_click_events_dropped_total',
+                    'Click events dropped: buffer full while flushes failed, or refused by the primary.', [],
+                    lambda: [((), click_buffer.dropped_events)], kind='counter')
+  metrics.collected('shortener_links_purged_total', 'Expired or unclicked links deleted by this worker.', [],
+                    lambda: [((), link_purger.purged)], kind='counter')
+  metrics.collected('shortener_rate_limited_total', 'Requests refused with a 429 by rate limiting.', [],
+                    lambda: [((), rate_limiter.limited)], kind='counter')
+  metrics.collected('shortener_password_hashes_in_flight', 'Password hashes running or waiting for a worker.', [],
+                    lambda: [((), password_hasher.in_flight)])
+  metrics.collected('shortener_password_hashes_rejected_total', 'Password hashes refused with a 429, pool full.', [],
+                    lambda: [((), password_hasher.rejected)], kind='counter')
+  if storage.code_index is not None:
+    metrics.collected('shortener_code_index_created_timestamp_seconds', 'Build time of the loaded code index.', [],
+                      lambda: [((), storage.code_index.created_at)] if storage.code_index.created_at else [])
+    metrics.collected('shortener_code_index_links', 'Links in the loaded code index, without its delta log.', [],
+                      lambda: [((), storage.code_index.links)])
+  if replica:
+    metrics.collected('shortener_snapshot_created_timestamp_seconds', 'Creation time of the loaded link snapshot.', [],
+                      lambda: [((), link_source.created_at)] if link_source.created_at else [])
+    metrics.collected('shortener_snapshot_links', 'Links in the loaded link snapshot.', [],
+                      lambda: [((), link_source.links)])
+  if shared_tier:
+    metrics.collected('shortener_shared_tier_failures_total', 'Shared tier calls that failed.', [],
+                      lambda: [((), shared_tier.failures)], kind='counter')
+
+# Record response time and status of a request, by endpoint (None for URLs no route matched)
+def record_response(endpoint, method, status, seconds):
+  request_latency.observe(seconds, endpoint or 'none', method)
+  responses.inc(endpoint or 'none', method, str(status))
+
+def start_request_timer():
+  g.request_started = time.perf_counter()
+
+def record_request(response):
+  started = g.pop('request_started', None)
+  if started is not None:
+    record_response(request.endpoint, request.method, response.status_code, time.perf_counter() - started)
+  return response
+
+if app.config['METRICS_ENABLED']:
+  app.before_request(start_request_timer)
+  app.after_request(record_request)
+
+# Built static assets, original name -> fingerprinted name, empty until "flask assets build" ran
+asset_manifest = load_manifest(manifest_path(app.static_folder))
+
+# url_for('static', filename=...) points to the built copy of an asset if there's one
+def asset_url(endpoint, values):
+  if endpoint == 'static' and values.get('filename') in asset_manifest:
+    values['filename'] = asset_manifest[values['filename']]
+
+# A built asset never changes under its name, browsers and CDNs may keep it as long as they like
+def cache_asset(response):
+  if request.endpoint == 'static' and request.view_args['filename'].startswith(ASSETS_DIR + '/') and (
+      response.status_code in (200, 304)):
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+  return response
+
+if asset_manifest:
+  app.url_defaults(asset_url)
+  app.after_request(cache_asset)
+
+# Route group of each limited endpoint (a rate budget name), see RATE_LIMIT_* config
+RATE_LIMITED_ENDPOINTS = {
+  'redirect_url': 'redirect',
+  'search': 'search',
+  'shorten': 'shorten',
+  'api.bulk_create': 'api',
+  'api.resolve_link': 'api',
+  'api.create_link': 'api',
+  'api.list_links': 'api',
+  'api.link_stats': 'api',
+}
 
-# Connect to the database
-def connect_db():
-  conn = sqlite3.connect(db_file)
-  conn.row_factory = sqlite3.Row
-  return conn
+# Client a request is counted against: its API key, its logged in user (read from the session cookie, without
+# loading the user) or its IP
+def rate_limit_client(budget):
+  if budget == 'api':
+    key = request.headers.get('X-API-Key')
+    authorization = request.headers.get('Authorization', '')
+    if not key and authorization.startswith('Bearer '):
+      key = authorization[len('Bearer '):]
+    if key:
+      return 'key:' + hash_api_key(key)
+  elif budget != 'redirect' and session.get('_user_id'):
+    return 'user:' + session['_user_id']
+  return 'ip:' + str(request.remote_addr)
 
-# Create DB method - Created DB and Table if not exists
+# Refuse requests over their client's budget with a pre-rendered 429, before any other work
+def rate_limit():
+  budget = RATE_LIMITED_ENDPOINTS.get(request.endpoint)
+  # Showing the create form costs nothing, only creating URLs is limited
+  if budget not in rate_budgets or (budget == 'shorten' and request.method != 'POST'):
+    return None
+  wait = rate_limiter.take(budget, rate_limit_client(budget))
+  if wait is None:
+    return None
+  if budget == 'api':
+    return Response(STATIC_PAGES['api_429'], status=429, mimetype='application/json',
+                    headers={'Retry-After': str(wait)})
+  return static_page(429, {'Retry-After': str(wait)})
+
+if app.config['RATE_LIMIT_ENABLED']:
+  app.before_request(rate_limit)
+
+# Purge job runs in the designated purge worker only, started by its first request (not by CLI commands)
+if app.config['PURGE_INTERVAL'] and app.config['PURGE_WORKER'] and not replica:
+  app.before_request(link_purger.start)
+
+# JSON API, authenticated by API key so CSRF protection doesn't apply
+csrf.exempt(api)
+app.register_blueprint(api)
+
+# Create DB method - Creates DB and brings its schema up to date
 def create_db():
-  # Establish DB connection
-  conn = connect_db()
-  cursor = conn.cursor()
-
-  # Create users table
-  cursor.execute("""CREATE TABLE IF NOT EXISTS users (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    username TEXT UNIQUE NOT NULL,
-                    password TEXT NOT NULL,
-                    fname TEXT NOT NULL,
-                    lname TEXT NOT NULL,
-                    email TEXT UNIQUE NOT NULL,
-                    phone TEXT NULL,
-                    website TEXT,
-                    last_login DATETIME DEFAULT NULL,
-                    last_failed_login DATETIME DEFAULT NULL,
-                    failed_login_attempts INTEGER DEFAULT 0
-                  )""")
-
-  # Create urls table
-  cursor.execute("""CREATE TABLE IF NOT EXISTS urls (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    original_url TEXT NOT NULL,
-                    shortened_url TEXT UNIQUE NOT NULL,
-                    user_id INTEGER REFERENCES users(id),
-                    clicks INTEGER DEFAULT 0
-                  )""")
-
-  conn.commit()
-  # Close DB connection
-  conn.close()
+  return storage.migrate()
+
+# DB CLI commands, run offline with: flask --app app db <command>
+db_cli = AppGroup('db', help='Database schema commands.')
+
+@db_cli.command('upgrade')
+@click.option('--target', type=int, default=None, help='Stop at this schema version.')
+def db_upgrade(target):
+  """Apply pending schema migrations."""
+  applied = storage.migrate(target)
+  for version, name in applied:
+    click.echo(f'Applied {version}: {name}')
+  if not applied:
+    click.echo('Database is up to date.')
+
+@db_cli.command('status')
+def db_status():
+  """Show current schema version and pending migrations."""
+  version, pending = storage.schema_status()
+  click.echo(f'Current version: {version}')
+  for version, name in pending:
+    click.echo(f'Pending {version}: {name}')
+
+@db_cli.command('vacuum')
+def db_vacuum():
+  """Rebuild the database file, returning free pages to the OS (blocks writers while it runs)."""
+  storage.vacuum()
+  click.echo('Database vacuumed.')
+
+app.cli.add_command(db_cli)
+
+# Stats CLI commands, run with: flask --app app stats <command>
+stats_cli = AppGroup('stats', help='Materialized stats commands.')
+
+@stats_cli.command('rebuild')
+def stats_rebuild():
+  """Recompute per-user URL and click counters from the urls table."""
+  storage.rebuild_user_stats()
+  click.echo('User stats rebuilt.')
+
+app.cli.add_command(stats_cli)
+
+# Get user row by username for CLI commands, failing the command if not found
+def cli_user(username):
+  user_row = storage.get_user_by_username(username)
+  if not user_row:
+    raise click.ClickException(f'User {username} not found.')
+  return user_row
+
+# API key CLI commands, run with: flask --app app apikey <command>
+apikey_cli = AppGroup('apikey', help='API key commands.')
+
+@apikey_cli.command('create')
+@click.argument('username')
+@click.option('--name', default=None, help='Label for the key.')
+def apikey_create(username, name):
+  """Create an API key for a user. The key is only shown once."""
+  user_row = cli_user(username)
+  click.echo(create_api_key(storage, user_row['id'], name))
+
+@apikey_cli.command('revoke')
+@click.argument('key_id', type=int)
+def apikey_revoke(key_id):
+  """Delete an API key by id."""
+  if not storage.delete_api_key(key_id):
+    raise click.ClickException(f'API key {key_id} not found.')
+  click.echo(f'API key {key_id} revoked.')
+
+app.cli.add_command(apikey_cli)
+
+# URL CLI commands, run with: flask --app app urls <command>
+urls_cli = AppGroup('urls', help='Short URL commands.')
+
+@urls_cli.command('import')
+@click.argument('file', type=click.File('r'))
+@click.option('--user', 'username', required=True, help='Owner of the imported URLs.')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'ndjson']), default=None,
+              help='Input format, guessed from file extension by default.')
+def urls_import(file, username, file_format):
+  """Bulk create short URLs from a CSV or NDJSON file (- for stdin), printing NDJSON results."""
+  if file_format is None:
+    file_format = 'csv' if file.name.endswith('.csv') else 'ndjson'
+  records = read_csv(file) if file_format == 'csv' else read_ndjson(file)
+  user_row = cli_user(username)
+  for result in import_urls(storage, user_row['id'], user_row['username'], code_allocator, records,
+                            app.config['BULK_CHUNK_SIZE']):
+    click.echo(json.dumps(result))
+
+@urls_cli.command('purge')
+def urls_purge():
+  """Delete expired links (and unclicked ones, see PURGE_UNCLICKED_DAYS) now."""
+  click.echo(f'{link_purger.run_once()} links purged.')
+
+@urls_cli.command('index')
+def urls_index():
+  """Rebuild the code index (CODE_INDEX) from the database, starting a new delta log."""
+  if not app.config['CODE_INDEX']:
+    raise click.ClickException('CODE_INDEX is not set.')
+  count = build_code_index(storage, app.config['CODE_INDEX'], alphabet=app.config['SHORT_CODE_ALPHABET'],
+                           length=app.config['SHORT_CODE_LENGTH'])
+  click.echo(f'{count} links indexed.')
+
+@urls_cli.command('snapshot')
+@click.argument('path')
+def urls_snapshot(path):
+  """Write a read-only snapshot of all links for redirect replicas (see REPLICA_SNAPSHOT)."""
+  click.echo(f'{write_snapshot(storage, path)} links written to {path}.')
+
+app.cli.add_command(urls_cli)
+
+# Static asset CLI commands, run with: flask --app app assets <command>
+assets_cli = AppGroup('assets', help='Static asset commands.')
+
+@assets_cli.command('build')
+def assets_build():
+  """Write minified, fingerprinted copies of static CSS and JS files, served by workers started afterwards."""
+  manifest = build_assets(app.static_folder)
+  click.echo(f'{len(manifest)} assets built in {os.path.join(app.static_folder, ASSETS_DIR)}.')
+
+app.cli.add_command(assets_cli)
+
+# Get logged in user from session snapshot, if enabled, fresh and matching user_id
+def session_user(user_id):
+  if not app.config['USER_SESSION_SNAPSHOT'] or not has_request_context():
+    return None
+  snapshot = session.get('user_snapshot')
+  if not snapshot or str(snapshot['user']['id']) != user_id:
+    return None
+  if time.time() - snapshot['at'] > app.config['USER_SNAPSHOT_MAX_AGE']:
+    return None
+  return User.from_snapshot(snapshot['user'])
+
+# Store logged in user snapshot in signed session cookie, so next requests need no DB access
+def store_session_user(user):
+  if app.config['USER_SESSION_SNAPSHOT']:
+    session['user_snapshot'] = {'user': user.to_snapshot(), 'at': int(time.time())}
 
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-  try:
-    # Establish DB connection
-    conn = connect_db()
-    cursor = conn.cursor()
-    # Get user data fron DB, using user_id method parameter
-    query = "SELECT * FROM users WHERE id = ? LIMIT 1"
-    cursor.execute(query, (user_id,))
-    user_row = cursor.fetchone()
-  except sqlite3.Error as e:
-    print(e) # Log error to server only
-  finally:
-    if conn:
-      # Close DB connection
-      conn.close()
-    if user_row:
-      # Create and return User object if user exists
-      return User(user_row['id'], user_row['username'], user_row['password'], user_row['fname'], user_row['lname'], user_row['email'], user_row['phone'], user_row['website'])
-  # If DB failed or User not found, return None
-  return None
+  # Redirect replicas have no users, their own pages (404, 410) are rendered as for visitors
+  if replica:
+    return None
+  user_id = str(user_id)
+  # Use session snapshot of logged in user if there is one
+  user = session_user(user_id)
+  if user:
+    return user
+  user = user_cache.get(user_id)
+  if user is None:
+    user_row = None
+    try:
+      # Get user data fron DB, using user_id method parameter
+      user_row = storage.get_user(user_id)
+    except StorageError as e:
+      print(e) # Log error to server only
+    # If DB failed or User not found, return None
+    if not user_row:
+      return None
+    # Create User object and cache it
+    user = User.from_row(user_row)
+    user_cache.set(user_id, user)
+  # Refresh snapshot of the session's own user
+  if has_request_context() and session.get('_user_id') == user_id:
+    store_session_user(user)
+  return user
 
 # Homepage Route - Welcome message for new users, Dashboard for logged users
 @app.route('/')
@@ -105,28 +609,19 @@ def index():
     # initialize statistics variable
     stats = {'urls': 0, 'clicks': 0}
     try:
-      # establish db connection
-      conn = connect_db()
-      cursor = conn.cursor()
-      # count user's URLs
-      query = "SELECT Count() FROM urls WHERE user_id = ?"
-      cursor.execute(query, (current_user.get_id(),))
-      urls = cursor.fetchone()[0]
+      # Get user's URL and click counters
+      urls, clicks = storage.user_stats(current_user.get_id())
       stats['urls'] = urls
-      # count user's total Clicks
-      query_clicks = "SELECT SUM(clicks) AS total_clicks FROM urls WHERE user_id = ?"
-      cursor.execute(query_clicks, (current_user.get_id(),))
-      clicks = cursor.fetchone()[0]
-      stats['clicks'] = clicks
-    except sqlite3.Error as e:
+      # Add clicks not yet flushed to DB
+      stats['clicks'] = (clicks or 0) + click_buffer.pending_for_user(current_user.get_id())
+    except StorageError as e:
       print(e) # Log error to server only
       flash("Database error!", "error")
-    finally:
-      if conn:
-        # Close DB connection
-        conn.close()
     # send stats variable to index page
     return render_template('index.html', stats=stats)
+  # Visitors all get the same page, unless a message waits for them (e.g. after logging out)
+  elif '_flashes' not in session:
+    return cached_page('index')
   else:
     return render_template('index.html')
 
@@ -145,61 +640,76 @@ def login():
     # Validate form data
     if form.validate_on_submit():
       loggedin = False
+      # Seconds to wait before retrying, if the attempt is refused with a 429
+      retry_after = None
       current_time = datetime.utcnow()
       username = form.username.data
       password = form.password.data
       try:
-        # Establish DB connection
-        conn = connect_db()
-        cursor = conn.cursor()
-        query = "SELECT * FROM users WHERE username = ? LIMIT 1"
-        cursor.execute(query, (username,))
-        user_row = cursor.fetchone()
-        # Check if user exists and password hash matches
-        if user_row and bcrypt.check_password_hash(user_row['password'], password):
-          thirty_minutes_ago = datetime.utcnow() - timedelta(minutes=30)
-          last_failed_login = datetime.strptime(user_row['last_failed_login'], '%Y-%m-%d %H:%M:%S.%f') if user_row['last_failed_login'] is not None else None
-          if int(0 if user_row['failed_login_attempts'] is None else user_row['failed_login_attempts']) > 4 and last_failed_login >= thirty_minutes_ago:
-            time_elapsed = current_time - last_failed_login
-            remaining_minutes = (timedelta(minutes=30) - time_elapsed).total_seconds() / 60
-            flash(f"Too many failed attempts. Account locked for {int(remaining_minutes)} minutes.", "error")
-          else:
+        # Count attempt against account and client IP first, blocked attempts never reach bcrypt
+        remaining = login_throttle.attempt(username, request.remote_addr)
+        if remaining is not None:
+          logins.inc('locked')
+          retry_after = int(remaining.total_seconds())
+          flash(f"Too many failed attempts. Try again in {math.ceil(retry_after / 60)} minutes.", "error")
+        else:
+          user_row = storage.get_user_by_username(username)
+          # Check if user exists and password hash matches
+          if user_row and password_hasher.check(user_row['password'], password):
             # Create User object
-            user = User(user_row['id'], user_row['username'], user_row['password'], user_row['fname'], user_row['lname'], user_row['email'], user_row['phone'], user_row['website'])
+            user = User.from_row(user_row)
             # Login user using Flask Login
             login_user(user)
+            store_session_user(user)
             loggedin = True
+            logins.inc('success')
             flash("Successfully logged in!", "success")
-            query_log = "UPDATE users SET last_login = ?, failed_login_attempts = 0 WHERE id = ?"
-            cursor.execute(query_log, (current_time, user_row['id']))
-            conn.commit()
-        elif not user_row:
-          flash("User not found. Please register!", "error")
-        else:
-          flash("Invalid credentials. Try again!", "error")
-          flash("Account will be locked for 30 minutes after 5 failed attempts!", "info")
-          query_log = "UPDATE users SET failed_login_attempts = failed_login_attempts + 1, last_failed_login = ? WHERE id = ?"
-          cursor.execute(query_log, (current_time, user_row['id']))
-          conn.commit()
-      except sqlite3.Error as e:
+            login_throttle.succeeded(username)
+            storage.record_login(user_row['id'], current_time)
+            rehash_password(user_row, password)
+          elif not user_row:
+            logins.inc('unknown_user')
+            flash("User not found. Please register!", "error")
+          else:
+            logins.inc('failed')
+            flash("Invalid credentials. Try again!", "error")
+            flash(f"Logins are blocked for a while after {login_throttle.max_attempts} failed attempts!", "info")
+      except HasherBusy:
+        retry_after = 1
+        flash("Too many login attempts right now. Try again in a moment!", "error")
+      except StorageError as e:
         print(e) # Log error to server only
         flash("Database error!", "error")
       finally:
-        if conn:
-          # Close DB connection
-          conn.close()
         if loggedin:
           # If logged in successfully, redirect to index
           return redirect(url_for('index'))
+        if retry_after is not None:
+          return too_many_requests(render_template('login.html', form=form), retry_after)
     else:
       flash("Invalid data! Check fields and try again.", "error")
   # If method is not POST, or submitted data is not correct, render login page
   return render_template('login.html', form=form)
 
+# Rehash password of logged in user if it was hashed with a different cost than BCRYPT_LOG_ROUNDS
+# Skipped if the hashing pool is busy, done on a later login instead
+def rehash_password(user_row, password):
+  if not password_hasher.needs_rehash(user_row['password']):
+    return
+  try:
+    storage.update_password(user_row['id'], password_hasher.generate(password))
+  except (HasherBusy, StorageError) as e:
+    print(e) # Log error to server only
+
+# 429 response with page body, for requests refused by login throttling or because password hashing is saturated
+def too_many_requests(body, retry_after=1):
+  return body, 429, {'Retry-After': str(retry_after)}
+
 # Logout route
 @app.route('/logout')
 def logout():
   logout_user()
+  session.pop('user_snapshot', None)
   flash("Successfully logged out!", "info")
   return redirect(url_for('login'))
 
@@ -218,35 +728,33 @@ def register():
     # Validate form data
     if form.validate_on_submit():
       signedup = False
+      busy = False
       try:
         username = form.username.data
         # Generate password hash
-        password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        password = password_hasher.generate(form.password.data)
         fname = form.fname.data
         lname = form.lname.data
         email = form.email.data
         phone = form.phone.data
         website = form.website.data
-        # Establish DB connection
-        conn = connect_db()
-        cursor = conn.cursor()
         # Insert new user into DB
-        query = "INSERT INTO users (username, password, fname, lname, email, phone, website) VALUES (?, ?, ?, ?, ?, ?, ?)"
-        cursor.execute(query, (username, password, fname, lname, email, phone, website))
-        conn.commit()
+        storage.create_user(username, password, fname, lname, email, phone, website)
         signedup = True
-      except sqlite3.Error as e:
+      except HasherBusy:
+        busy = True
+        flash("Too many sign ups right now. Try again in a moment!", "error")
+      except StorageError as e:
         print(e) # Log error to server only
         flash("Database error!", "error")
         signedup = False
       finally:
-        if conn:
-          # Close DB connection
-          conn.close()
         if signedup:
           flash("Successfully registered! Please Log in!", "success")
           # If registered successfully, redirect to login
           return redirect(url_for('login'))
+        elif busy:
+          return too_many_requests(render_template('register.html', form=form))
         else:
           flash("Failed to register. Try again!", "error")
     else:
@@ -266,25 +774,18 @@ def profile(user_id = None):
   elif user_id is not None:
     user = load_user(user_id)
     urls = None
+    sort = listing_sort()
     if not user:
       flash("User not found!", "error")
     else:
       try:
-        # Establish DB connection
-        conn = connect_db()
-        cursor = conn.cursor()
-        # Get URLs of user
-        query = "SELECT * FROM urls WHERE user_id = ?"
-        cursor.execute(query, (user_id,))
-        urls = cursor.fetchall()
-      except sqlite3.Error as e:
+        # Get one page of URLs of user, adding clicks not yet flushed to DB
+        urls = storage.user_urls_page(user_id, sort, request.args.get('after'),
+                                      app.config['LISTING_PAGE_SIZE'], click_buffer.applier())
+      except StorageError as e:
         print(e) # Log error to server only
         flash("Database error!", "error")
-      finally:
-        if conn:
-          # Close DB connection
-          conn.close()
-    return render_template('profile.html', user=user, urls=urls)
+    return render_listing('profile.html', user=user, urls=urls, sort=sort)
   # If user is not logged in and no user_id is provided, redirect home with message
   else:
     flash("Authentication needed. Please login or register!", "error")
@@ -308,28 +809,23 @@ def profile_edit():
           email = form.email.data
           phone = form.phone.data
           website = form.website.data
-          # Establish DB connection
-          conn = connect_db()
-          cursor = conn.cursor()
           # Update user in database with submitted data
-          query = "UPDATE users SET fname=?, lname=?, email=?, phone=?, website=? WHERE username=?"
-          cursor.execute(query, (fname, lname, email, phone, website, current_user.username))
-          conn.commit()
+          storage.update_user(current_user.username, fname, lname, email, phone, website)
           updated = True
-        except sqlite3.Error as e:
+        except StorageError as e:
           print(e) # Log error to server only
           flash("Database error!", "error")
           updated = False
         finally:
-          if conn:
-            # Close DB connection
-            conn.close()
           if updated:
             current_user.fname = fname
             current_user.lname = lname
             current_user.email = email
             current_user.phone = phone
             current_user.website = website
+            # Drop stale cached user and refresh session snapshot
+            user_cache.invalidate(str(current_user.id))
+            store_session_user(current_user)
             flash("Profile successfully updated!", "success")
             # If database updated successfully, redirect to profile with message
             return redirect(url_for('profile'))
@@ -343,30 +839,35 @@ def profile_edit():
   flash("Authentication needed. Please login or register!", "error")
   return redirect(url_for('index'))
 
+# Sort order of URL listings from query string
+def listing_sort():
+  sort = request.args.get('sort', DEFAULT_SORT)
+  return sort if sort in URL_SORTS else DEFAULT_SORT
+
+# Render a URL listing page, streaming it if enabled so the browser gets the start of the page before it's all rendered
+def render_listing(template, **context):
+  if app.config['STREAM_LISTINGS']:
+    return stream_template(template, **context)
+  return render_template(template, **context)
+
 # My URLs route
 @app.route('/my-urls')
 def my_urls():
   # Check if user is logged in
   if current_user.is_authenticated and current_user.get_id():
+    urls = None
+    sort = listing_sort()
     try:
-      # Establish DB connection
-      conn = connect_db()
-      cursor = conn.cursor()
-      # Get URLs of user
-      query = "SELECT * FROM urls WHERE user_id = ?"
-      cursor.execute(query, (current_user.get_id(),))
-      urls = cursor.fetchall()
-    except sqlite3.Error as e:
+      # Get one page of URLs of user, adding clicks not yet flushed to DB
+      urls = storage.user_urls_page(current_user.get_id(), sort, request.args.get('after'),
+                                    app.config['LISTING_PAGE_SIZE'], click_buffer.applier())
+    except StorageError as e:
       print(e) # Log error to server only
       flash("Database error!", "error")
-    finally:
-      if conn:
-        # Close DB connection
-        conn.close()
-      if urls:
-        return render_template('my_urls.html', urls=urls)
-      return render_template('my_urls.html')
-  redirect(url_for('index'))
+    return render_listing('my_urls.html', urls=urls, sort=sort)
+  # If user is not logged in, redirect to index with error message
+  flash("Authentication needed. Please login or register!", "error")
+  return redirect(url_for('index'))
 
 # Create Short URL route
 @app.route('/shorten', methods=['GET','POST'])
@@ -382,24 +883,20 @@ def shorten():
         created = False
         try:
           original_url = form.original_url.data
-          # Generate short URL
-          shortened_url = generate_short_url()
-          # Establish DB connection
-          conn = connect_db()
-          cursor = conn.cursor()
-          # Add url to db linking original_url with generated short URL
-          query = "INSERT INTO urls (original_url, shortened_url, user_id) VALUES (?, ?, ?)"
-          cursor.execute(query, (original_url, shortened_url, current_user.id))
-          conn.commit()
+          # Redirect status and cache lifetime, blank lifetime means the default of the status
+          policy = link_policy(form.redirect_status.data, form.cache_max_age.data, app.config['REDIRECT_CACHE_MAX_AGE'])
+          # Add url to db linking original_url with allocated short URL, indexed for search and counted in user's stats
+          result = insert_chunk(storage, current_user.id, current_user.username, code_allocator, [(1, original_url)],
+                                policy, link_expiry(form.expires_in.data))
+          shortened_url = result[0]['shortened_url']
+          # Drop a cached 404 for this code, if any
+          link_cache.invalidate(shortened_url)
           created = True
-        except sqlite3.Error as e:
+        except StorageError as e:
           print(e) # Log error to server only
           flash("Database error!", "error")
           created = False
         finally:
-          if conn:
-            # Close DB connection
-            conn.close()
           if created:
             flash("URL " + shortened_url + " created successfully", "success")
             # If URL successfully generated and added to DB, redirect to user's URLs with message
@@ -421,59 +918,65 @@ def search():
   form = SearchForm(request.args)
   if 'q' in request.args and form.validate():
     search_query = form.q.data
+    urls = None
+    next_page = None
     try:
-      # Establish DB connection
-      conn = connect_db()
-      cursor = conn.cursor()
-      # Get URLs of query
-      db_query = """SELECT urls.shortened_url, urls.original_url, urls.clicks, urls.user_id, users.username
-                    FROM urls
-                    JOIN users ON urls.user_id = users.id
-                    WHERE urls.original_url LIKE ? OR users.username LIKE ?;"""
-      cursor.execute(db_query, (f'%{search_query}%', f'%{search_query}%'))
-      urls = cursor.fetchall()
-    except sqlite3.Error as e:
+      # Get one page of URLs of query from full-text index, best matches first
+      urls, next_page = storage.search_urls(search_query, app.config['SEARCH_PAGE_SIZE'], request.args.get('after'))
+      # Add clicks not yet flushed to DB
+      urls = click_buffer.apply(urls)
+    except StorageError as e:
       print(e) # Log error to server only
       flash("Database error!", "error")
     finally:
-      if conn:
-        # Close DB connection
-        conn.close()
       if urls:
-        return render_template('search.html', form=form, urls=urls, query=search_query)
+        return render_template('search.html', form=form, urls=urls, query=search_query, next_page=next_page)
       return render_template('search.html', form=form, query=search_query)
   return render_template('search.html', form=form)
 
+# Metrics route - Prometheus text format, see METRICS_ENABLED, METRICS_TOKEN and METRICS_NETWORKS
+@app.route('/metrics')
+def metrics_page():
+  if not app.config['METRICS_ENABLED']:
+    return render_template('error.html'), 404
+  token = app.config['METRICS_TOKEN']
+  authorization = request.headers.get('Authorization', '').encode()
+  authorized = token and hmac.compare_digest(authorization, ('Bearer ' + token).encode())
+  if not authorized and not address_in(request.remote_addr, metrics_networks):
+    # Nobody is let in when neither a token nor networks are set
+    if token:
+      return Response('Unauthorized', status=401, mimetype='text/plain')
+    return render_template('error.html'), 404
+  return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 # Route to redirect and track clicks
 @app.route('/<shortened_url>')
 def redirect_url(shortened_url):
+  url_row = None
+  expired = False
   try:
-    # Establish DB connection
-    conn = connect_db()
-    cursor = conn.cursor()
-    # Get DB entry of the short URL in route
-    query = "SELECT * FROM urls WHERE shortened_url = ? LIMIT 1"
-    cursor.execute(query, (shortened_url,))
-    url_row = cursor.fetchone()
+    # Get short URL from cache, or from DB on a cache miss
+    url_row = find_link(link_cache, link_source, shortened_url)
+    # Expired links are kept until the purge job deletes them, but no longer redirect or count clicks
+    expired = bool(url_row) and is_expired(url_row)
     # Check if short url exists
-    if url_row:
-      # Update click count
-      cursor = conn.cursor()
-      query_count = "UPDATE urls SET clicks = clicks + 1 WHERE id = ?"
-      cursor.execute(query_count, (url_row['id'],))
-      conn.commit()
-  except sqlite3.Error as e:
+    if url_row and not expired:
+      # Count click, written to DB later in batch
+      click_buffer.record(url_row['id'], url_row['user_id'], request.referrer, request.user_agent.string)
+  except StorageError as e:
     print(e) # Log error to server only
   finally:
-    if conn:
-      # Close DB connection
-      conn.close()
+    if expired:
+      return static_page(410)
     # Check if short url exists
     if url_row:
-      # Redirect to original URL
-      return redirect(url_row['original_url'])
-    # If URL doesn't exist, render error page with 404 HTTP Status code
-    return render_template('error.html'), 404
+      # Redirect to original URL with link's status and caching policy
+      status, cache_control = redirect_policy(url_row)
+      response = redirect(url_row['original_url'], code=status)
+      response.headers['Cache-Control'] = cache_control
+      return response
+    # If URL doesn't exist, send error page with 404 HTTP Status code
+    return static_page(404)
 
 # Delete URL route
 @app.route('/<shortened_url>/delete')
@@ -482,29 +985,20 @@ def delete_url(shortened_url):
   if current_user.is_authenticated and current_user.get_id():
     deleted = False
     try:
-      # Establish DB connection
-      conn = connect_db()
-      cursor = conn.cursor()
       # Get the short URL from DB
-      query = "SELECT * FROM urls WHERE shortened_url = ? AND user_id = ? LIMIT 1"
-      cursor.execute(query, (shortened_url, current_user.get_id()))
-      url_row = cursor.fetchone()
+      url_row = storage.get_user_url(shortened_url, current_user.get_id())
       # Check if URL exists
       if url_row:
-        # Delete URL from DB
-        cursor = conn.cursor()
-        query_delete = "DELETE FROM urls WHERE shortened_url = ?"
-        cursor.execute(query_delete, (shortened_url,))
-        conn.commit()
+        # Delete URL from DB with its search entry, click rollups and share of user's stats
+        storage.delete_url(url_row)
+        # Stop serving the deleted URL from cache
+        link_cache.invalidate(shortened_url)
         deleted = True
-    except sqlite3.Error as e:
+    except StorageError as e:
       print(e) # Log error to server only
       flash("Database error!", "error")
       deleted = False
     finally:
-      if conn:
-        # Close DB connection
-        conn.close()
       if deleted:
         flash("URL " + shortened_url + " successfully deleted!", "info")
       else:
@@ -515,10 +1009,76 @@ def delete_url(shortened_url):
   # Redirect to index regardless of result, with message processed above
   return redirect(url_for('index'))
 
+# URL stats route - clicks per hour and per day, read from rollup tables only
+@app.route('/<shortened_url>/stats')
+def url_stats(shortened_url):
+  # Check if user is logged in
+  if current_user.is_authenticated and current_user.get_id():
+    url = None
+    hourly = []
+    daily = []
+    try:
+      # Get the short URL from DB, only owner can see stats
+      url_row = storage.get_user_url(shortened_url, current_user.get_id())
+      if url_row:
+        # Add clicks not yet flushed to DB
+        url = click_buffer.apply([url_row])[0]
+        # Clicks per hour in last 48 hours and per day in last 30 days
+        hourly, daily = storage.url_click_stats(url_row['id'])
+    except StorageError as e:
+      print(e) # Log error to server only
+      flash("Database error!", "error")
+    if url:
+      return render_template('url_stats.html', url=url, hourly=hourly, daily=daily)
+    flash("URL " + shortened_url + " not found!", "error")
+    return redirect(url_for('my_urls'))
+  # If user is not logged in, redirect to index with error message
+  flash("Authentication needed. Please login or register!", "error")
+  return redirect(url_for('index'))
+
+# Compile every template now (or load its bytecode from TEMPLATE_CACHE_DIR), not on each worker's first requests
+for template_name in app.jinja_env.list_templates():
+  app.jinja_env.get_template(template_name)
+
+# Pages of refused requests and of missing or expired short URLs, rendered once and sent as is to everyone,
+# so scanning codes or going over a rate limit costs no template rendering or user lookup. Their nav has no
+# links depending on the user (pre_rendered), and links are paths under APPLICATION_ROOT
+with app.test_request_context():
+  STATIC_PAGES = {
+    404: render_template('error.html', pre_rendered=True).encode('utf-8'),
+    410: render_template('error.html', pre_rendered=True, message='This short URL has expired!').encode('utf-8'),
+    429: render_template('error.html', pre_rendered=True,
+                         message='Too many requests! Please try again later.').encode('utf-8'),
+    'api_429': json.dumps({'error': 'Too many requests!'}).encode('utf-8'),
+  }
+
+STATIC_PAGE_ETAGS = {name: hashlib.sha256(page).hexdigest()[:20] for name, page in STATIC_PAGES.items()}
+
+def static_page(status, headers=None):
+  return Response(STATIC_PAGES[status], status=status, mimetype='text/html', headers=headers)
+
+# Page that is the same for every visitor (template <name>.html), revalidated by ETag: a 304 without body while
+# it's unchanged. Logged in users get another page at the same URL, so it varies on Cookie
+# Rendered by the first visitor's request, so it links under the path and host the app is really served at,
+# then kept until the worker restarts (a deploy, or changed templates or assets, needs one)
+def cached_page(name):
+  if name not in STATIC_PAGES:
+    page = render_template(f'{name}.html').encode('utf-8')
+    # ETag first, requests of other threads use the page as soon as it's there
+    STATIC_PAGE_ETAGS[name] = hashlib.sha256(page).hexdigest()[:20]
+    STATIC_PAGES[name] = page
+  response = Response(STATIC_PAGES[name], mimetype='text/html')
+  response.set_etag(STATIC_PAGE_ETAGS[name])
+  max_age = app.config['PAGE_CACHE_MAX_AGE']
+  response.headers['Cache-Control'] = f'public, max-age={max_age}' if max_age else 'no-cache'
+  response.vary.add('Cookie')
+  return response.make_conditional(request)
+
 # Run APP
 if __name__ == '__main__':
-  # Call Create DB - will create DB for first use
-  create_db()
+  # Call Create DB - will create DB for first use (replicas don't use one)
+  if not replica:
+    create_db()
   debug = False
   if os.environ.get('ENVIRONMENT') == 'Development':
     debug = True
@@ -0,0 +1,134 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.wsgi import WsgiToAsgi
+from werkzeug.exceptions import HTTPException
+from werkzeug.urls import iri_to_uri
+from app import (app, link_source, link_cache, click_buffer, shared_tier, record_response, rate_limiter, rate_budgets,
+                 STATIC_PAGES)
+from cache import MISSING
+from links import find_link, is_expired, redirect_policy
+
+# ASGI entry point, run with e.g.: uvicorn asgi:application
+# Redirects of short URLs (and their pre-rendered 404, 410 and 429 pages) are answered here without holding
+# a WSGI worker thread, everything else is handed to the Flask app
+
+# Threads doing DB lookups on cache misses
+db_executor = ThreadPoolExecutor(max_workers=app.config['ASGI_DB_THREADS'], thread_name_prefix='asgi-db')
+# Flask app wrapped for ASGI, serves UI and API
+flask_application = WsgiToAsgi(app)
+# URL map adapter used to tell redirect requests apart from other routes
+url_adapter = app.url_map.bind('')
+# Worker-local part of the link cache, the only part read on the event loop (shared tier calls are network calls)
+local_link_cache = getattr(link_cache, 'local', link_cache)
+# Redirects are rate limited with this worker's own buckets for the same reason
+local_rate_limiter = getattr(rate_limiter, 'local', rate_limiter)
+redirect_limited = app.config['RATE_LIMIT_ENABLED'] and 'redirect' in rate_budgets
+
+# Look up short URL in shared tier or link source (pooled DB connection, or snapshot on replicas), runs in db_executor
+def lookup(shortened_url):
+  return find_link(link_cache, link_source, shortened_url)
+
+# Short code of request if it's routed to redirect_url, None otherwise
+def redirect_code(scope):
+  if scope['method'] not in ('GET', 'HEAD'):
+    return None
+  try:
+    endpoint, args = url_adapter.match(scope['path'], method=scope['method'])
+  except HTTPException:
+    return None
+  return args['shortened_url'] if endpoint == 'redirect_url' else None
+
+# Get header value from ASGI scope
+def header(scope, name):
+  for key, value in scope['headers']:
+    if key == name:
+      return value.decode('latin-1')
+  return None
+
+# Client IP of request, from X-Forwarded-For if there are trusted proxies, like ProxyFix in the Flask app
+# (see TRUSTED_PROXY_HOPS)
+def client_ip(scope):
+  hops = app.config['TRUSTED_PROXY_HOPS']
+  forwarded = header(scope, b'x-forwarded-for')
+  if hops and forwarded:
+    addresses = [address.strip() for address in forwarded.split(',')]
+    if len(addresses) >= hops:
+      return addresses[-hops]
+  return str((scope.get('client') or ('None',))[0])
+
+# Send one of the app's pre-rendered pages
+async def send_page(scope, send, status, started, headers=()):
+  body = STATIC_PAGES[status]
+  await send({
+    'type': 'http.response.start',
+    'status': status,
+    'headers': [(b'content-type', b'text/html; charset=utf-8'), (b'content-length', str(len(body)).encode()),
+                *headers],
+  })
+  await send({'type': 'http.response.body', 'body': body if scope['method'] != 'HEAD' else b''})
+  if app.config['METRICS_ENABLED']:
+    record_response('redirect_url', scope['method'], status, time.perf_counter() - started)
+
+async def redirect_application(scope, receive, send):
+  started = time.perf_counter()
+  shortened_url = redirect_code(scope)
+  if not shortened_url:
+    await flask_application(scope, receive, send)
+    return
+  if redirect_limited:
+    wait = local_rate_limiter.take('redirect', 'ip:' + client_ip(scope))
+    if wait is not None:
+      await send_page(scope, send, 429, started, [(b'retry-after', str(wait).encode())])
+      return
+  url_row = local_link_cache.get(shortened_url)
+  if url_row is None:
+    # Cache miss, query DB off the event loop
+    try:
+      url_row = await asyncio.get_running_loop().run_in_executor(db_executor, lookup, shortened_url)
+    except Exception as e:
+      print(e) # Log error to server only
+      url_row = None
+  if not url_row or url_row is MISSING:
+    await send_page(scope, send, 404, started)
+    return
+  if is_expired(url_row):
+    await send_page(scope, send, 410, started)
+    return
+  # Count click, written to DB later in batch
+  click = (url_row['id'], url_row['user_id'], header(scope, b'referer'), header(scope, b'user-agent'))
+  if shared_tier:
+    # Counted in the shared tier, without waiting for it
+    asyncio.get_running_loop().run_in_executor(db_executor, click_buffer.record, *click)
+  else:
+    click_buffer.record(*click)
+  # Link's status and caching policy
+  status, cache_control = redirect_policy(url_row)
+  await send({
+    'type': 'http.response.start',
+    'status': status,
+    'headers': [(b'location', iri_to_uri(url_row['original_url']).encode('latin-1')),
+                (b'cache-control', cache_control.encode('latin-1')),
+                (b'content-length', b'0')],
+  })
+  await send({'type': 'http.response.body', 'body': b''})
+  if app.config['METRICS_ENABLED']:
+    record_response('redirect_url', scope['method'], status, time.perf_counter() - started)
+
+# Flush pending clicks when the server shuts down
+async def lifespan(receive, send):
+  while True:
+    message = await receive()
+    if message['type'] == 'lifespan.startup':
+      await send({'type': 'lifespan.startup.complete'})
+    elif message['type'] == 'lifespan.shutdown':
+      await asyncio.get_running_loop().run_in_executor(None, click_buffer.stop)
+      db_executor.shutdown(wait=False)
+      await send({'type': 'lifespan.shutdown.complete'})
+      return
+
+async def application(scope, receive, send):
+  if scope['type'] == 'http':
+    await redirect_application(scope, receive, send)
+  elif scope['type'] == 'lifespan':
+    await lifespan(receive, send)
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import re
+
+# Build step for static assets (flask assets build): minified copies of the CSS and JS files, named after a hash
+# of their content (css/style.css -> dist/css/style.<hash>.css), and a manifest mapping original to built names.
+# Built names change whenever content does, so they're served with a long lifetime, pages pick them up through
+# url_for('static', ...) once the manifest is loaded (see app.asset_url)
+
+# Output directory inside the static folder, and its manifest
+ASSETS_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+# Characters of the content hash in built names
+FINGERPRINT_LENGTH = 12
+
+# CSS string literals (kept as they are) or comments (dropped)
+CSS_TOKENS = re.compile(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')|/\*.*?\*/', re.DOTALL)
+
+def minify_css_code(code):
+  code = re.sub(r'\s+', ' ', code)
+  code = re.sub(r'\s*([{};,>])\s*', r'\1', code)
+  # Space after the colon of declarations only, a space before a colon in selectors (a :hover) matters
+  code = re.sub(r'([{;])([\w-]+):\s+', r'\1\2:', code)
+  return code.replace(';}', '}')
+
+def minify_css(text):
+  parts = []
+  # Code around comments is minified as one piece, only strings split it
+  code = ''
+  position = 0
+  for match in CSS_TOKENS.finditer(text):
+    code += text[position:match.start()]
+    if match.group(1):
+      parts += [minify_css_code(code), match.group(1)]
+      code = ''
+    position = match.end()
+  parts.append(minify_css_code(code + text[position:]))
+  return ''.join(parts).strip()
+
+# Only drops indentation, blank lines and whole-line // comments, line breaks are kept so the script's
+# meaning never depends on the minifier (automatic semicolons, comment markers inside strings)
+def minify_js(text):
+  lines = (line.strip() for line in text.splitlines())
+  return '\n'.join(line for line in lines if line and not line.startswith('//'))
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+# Build minified, fingerprinted copies of the CSS and JS files of static_folder and write their manifest
+# Files built earlier are kept, pages cached by clients may still point to them
+# Returns the manifest, {original name: built name} with names relative to static_folder
+def build_assets(static_folder):
+  manifest = {}
+  for directory, subdirectories, files in os.walk(static_folder):
+    if os.path.relpath(directory, static_folder) == '.':
+      subdirectories[:] = [name for name in subdirectories if name != ASSETS_DIR]
+    for file in sorted(files):
+      stem, extension = os.path.splitext(file)
+      if extension not in MINIFIERS:
+        continue
+      source = os.path.join(directory, file)
+      name = os.path.relpath(source, static_folder).replace(os.sep, '/')
+      with open(source, encoding='utf-8') as handle:
+        content = MINIFIERS[extension](handle.read()).encode('utf-8')
+      fingerprint = hashlib.sha256(content).hexdigest()[:FINGERPRINT_LENGTH]
+      built = '/'.join(filter(None, (ASSETS_DIR, os.path.dirname(name), f'{stem}.{fingerprint}{extension}')))
+      target = os.path.join(static_folder, *built.split('/'))
+      os.makedirs(os.path.dirname(target), exist_ok=True)
+      with open(target, 'wb') as handle:
+        handle.write(content)
+      manifest[name] = built
+  path = manifest_path(static_folder)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with open(path + '.tmp', 'w', encoding='utf-8') as handle:
+    json.dump(manifest, handle, indent=2, sort_keys=True)
+  os.replace(path + '.tmp', path)
+  return manifest
+
+def manifest_path(static_folder):
+  return os.path.join(static_folder, ASSETS_DIR, MANIFEST_NAME)
+
+# Manifest of built assets at path, empty if they weren't built (original files are served then)
+def load_manifest(path):
+  try:
+    with open(path, encoding='utf-8') as handle:
+      return json.load(handle)
+  except FileNotFoundError:
+    return {}
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# Benchmark main routes: seeds a synthetic DB, then times requests per route through the Flask
+# test client (default) or against a running server (--base-url), reporting p50/p95/p99 latency
+# and throughput, saved as JSON so runs can be compared across commits (--compare)
+#
+#   python benchmarks/run.py --urls 20000 --clicks 200000 --requests 2000
+#   python benchmarks/run.py --compare benchmarks/results/<older>.json
+#
+# Against a server, seed the DB it uses first, e.g.:
+#   python benchmarks/run.py --database bench.db --routes none
+#   DATABASE_URL=bench.db python app.py &
+#   python benchmarks/run.py --database bench.db --skip-seed --base-url http://localhost:5000
+# (a server checks reCAPTCHA on /shorten, so time link creation there with api_create, throttles
+# logins per client IP, so raise its LOGIN_IP_MAX_ATTEMPTS when timing login, and rate limits requests,
+# so start it with RATE_LIMIT_ENABLED=false)
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, HTTPRedirectHandler, Request, build_opener
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.seed import WORDS, PASSWORD, random_url, seed
+
+CSRF_TOKEN = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+def parse_args():
+  parser = argparse.ArgumentParser(description='Benchmark URL shortener routes.')
+  parser.add_argument('--database', help='SQLite file or postgresql:// URL (default: new temporary SQLite file)')
+  parser.add_argument('--redis-url', help='Shared tier URL, e.g. memory:// or redis://localhost:6379/0')
+  parser.add_argument('--skip-seed', action='store_true', help='Reuse a DB seeded by an earlier run')
+  parser.add_argument('--users', type=int, default=100)
+  parser.add_argument('--urls', type=int, default=10000)
+  parser.add_argument('--clicks', type=int, default=100000)
+  parser.add_argument('--zipf', type=float, default=1.1, help='Zipf exponent of clicks and redirected codes')
+  parser.add_argument('--seed', type=int, default=1, help='Random seed')
+  parser.add_argument('--routes', default=','.join(ROUTES), help='Comma separated routes to run, "none" to only seed')
+  parser.add_argument('--requests', type=int, default=1000, help='Timed requests per route')
+  parser.add_argument('--login-requests', type=int, default=50, help='Timed requests of login (bcrypt bound)')
+  parser.add_argument('--warmup', type=int, default=50, help='Untimed requests per route before timing')
+  parser.add_argument('--concurrency', type=int, default=1, help='Threads sending requests')
+  parser.add_argument('--base-url', help='Benchmark a running server instead of the test client')
+  parser.add_argument('--output', help='Results JSON file (default: benchmarks/results/<time>-<commit>.json)')
+  parser.add_argument('--compare', help='Earlier results JSON to compare with')
+  return parser.parse_args()
+
+# Drivers send one request and return (status, body text)
+
+class TestClientDriver:
+  def __init__(self, app):
+    self.client = app.test_client()
+
+  def request(self, method, path, data=None, json_body=None, headers=None):
+    response = self.client.open(path, method=method, data=data, json=json_body, headers=headers)
+    return response.status_code, response.get_data(as_text=True)
+
+class NoRedirect(HTTPRedirectHandler):
+  def redirect_request(self, *args):
+    return None
+
+class HTTPDriver:
+  def __init__(self, base_url):
+    self.base_url = base_url.rstrip('/')
+    self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect())
+
+  def request(self, method, path, data=None, json_body=None, headers=None):
+    headers = dict(headers or {})
+    body = None
+    if json_body is not None:
+      body = json.dumps(json_body).encode('utf-8')
+      headers['Content-Type'] = 'application/json'
+    elif data is not None:
+      body = urlencode(data).encode('utf-8')
+      headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    try:
+      with self.opener.open(Request(self.base_url + path, data=body, headers=headers, method=method)) as response:
+        return response.status, response.read().decode('utf-8', 'replace')
+    except HTTPError as e:
+      return e.code, e.read().decode('utf-8', 'replace')
+
+def csrf_token(driver, path):
+  match = CSRF_TOKEN.search(driver.request('GET', path)[1])
+  return match.group(1) if match else ''
+
+def login(driver, username, password):
+  return driver.request('POST', '/login', data={'username': username, 'password': password,
+                                               'csrf_token': csrf_token(driver, '/login')})
+
+# Routes: setup(driver, context) runs once per thread, prepare(driver, context, rng) before each
+# request, both untimed; send(driver, context, rng, prepared) is the timed request
+class Route:
+  def __init__(self, send, expected, setup=None, prepare=None):
+    self.send = send
+    self.expected = expected
+    self.setup = setup
+    self.prepare = prepare
+
+# Codes are picked with the same Zipf skew as seeded clicks, so hot links dominate like in production
+def hot_code(context, rng):
+  return rng.choices(context['codes'], cum_weights=context['weights'], k=1)[0]
+
+def login_owner(driver, context):
+  login(driver, context['usernames'][0], context['password'])
+  return {'csrf_token': csrf_token(driver, '/shorten')}
+
+def search_query(rng):
+  return ' '.join(rng.sample(WORDS, rng.choice((1, 1, 2))))
+
+def relogin_prepare(driver, context, rng):
+  driver.request('GET', '/logout')
+  return csrf_token(driver, '/login')
+
+ROUTES = {
+  'redirect': Route(lambda d, c, rng, p: d.request('GET', '/' + hot_code(c, rng)), (302,)),
+  'redirect_miss': Route(lambda d, c, rng, p: d.request('GET', '/zz' + str(rng.randrange(10 ** 9))), (404,)),
+  'search': Route(lambda d, c, rng, p: d.request('GET', '/search?' + urlencode({'q': search_query(rng)})), (200,)),
+  'login': Route(lambda d, c, rng, token: d.request('POST', '/login', data={
+                   'username': rng.choice(c['usernames']), 'password': c['password'], 'csrf_token': token}),
+                 (302,), prepare=relogin_prepare),
+  'home': Route(lambda d, c, rng, p: d.request('GET', '/'), (200,)),
+  'dashboard': Route(lambda d, c, rng, p: d.request('GET', '/'), (200,), setup=login_owner),
+  'my_urls': Route(lambda d, c, rng, p: d.request('GET', '/my-urls'), (200,), setup=login_owner),
+  'shorten': Route(lambda d, c, rng, p: d.request('POST', '/shorten', data={
+                     'original_url': random_url(rng), 'csrf_token': c['thread']['csrf_token']}),
+                   (302,), setup=login_owner),
+  'api_resolve': Route(lambda d, c, rng, p: d.request('GET', '/api/v1/links/' + hot_code(c, rng),
+                                                       headers={'X-API-Key': c['api_key']}), (200,)),
+  'api_create': Route(lambda d, c, rng, p: d.request('POST', '/api/v1/links', json_body={'original_url': random_url(rng)},
+                                                      headers={'X-API-Key': c['api_key']}), (201,)),
+}
+
+# Nearest-rank percentile of sorted values
+def percentile(values, p):
+  return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+def summarize(latencies, errors, elapsed):
+  latencies = sorted(latencies)
+  if not latencies:
+    return {'requests': 0, 'errors': errors}
+  return {
+    'requests': len(latencies),
+    'errors': errors,
+    'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+    'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+    'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+    'mean_ms': round(sum(latencies) / len(latencies) * 1000, 3),
+    'max_ms': round(latencies[-1] * 1000, 3),
+    'throughput_rps': round(len(latencies) / elapsed, 1),
+  }
+
+# Send warmup + timed requests of route from concurrency threads, returns summary
+def run_route(name, route, make_driver, context, requests, warmup, concurrency, random_seed):
+  latencies = []
+  errors = [0]
+  lock = threading.Lock()
+  ready = threading.Barrier(concurrency + 1)
+
+  def worker(index):
+    rng = random.Random(f'{random_seed}-{name}-{index}')
+    driver = make_driver()
+    thread_context = dict(context, thread=route.setup(driver, context) if route.setup else None)
+    count = requests // concurrency + (1 if index < requests % concurrency else 0)
+    for _ in range(warmup // concurrency):
+      route.send(driver, thread_context, rng, route.prepare(driver, thread_context, rng) if route.prepare else None)
+    ready.wait()
+    own = []
+    failed = 0
+    for _ in range(count):
+      prepared = route.prepare(driver, thread_context, rng) if route.prepare else None
+      start = time.perf_counter()
+      status, _ = route.send(driver, thread_context, rng, prepared)
+      own.append(time.perf_counter() - start)
+      if status not in route.expected:
+        failed += 1
+    with lock:
+      latencies.extend(own)
+      errors[0] += failed
+
+  threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+  for thread in threads:
+    thread.start()
+  ready.wait()
+  start = time.perf_counter()
+  for thread in threads:
+    thread.join()
+  elapsed = time.perf_counter() - start
+  # Throughput counts timed requests only; prepare steps (e.g. login's logout) run inside the window
+  return summarize(latencies, errors[0], elapsed)
+
+def git_commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                          text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def print_results(results, baseline=None):
+  columns = ('requests', 'errors', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps')
+  print(f"{'route':<14}" + ''.join(f'{column:>16}' for column in columns))
+  for name, stats in results['routes'].items():
+    old = (baseline or {}).get('routes', {}).get(name, {})
+    cells = []
+    for column in columns:
+      value = stats.get(column, '-')
+      if column.endswith(('_ms', '_rps')) and old.get(column) and isinstance(value, (int, float)):
+        value = f'{value} ({(value - old[column]) / old[column] * 100:+.0f}%)'
+      cells.append(f'{value:>16}')
+    print(f'{name:<14}' + ''.join(cells))
+
+def main():
+  args = parse_args()
+  routes = [] if args.routes == 'none' else [name.strip() for name in args.routes.split(',')]
+  unknown = [name for name in routes if name not in ROUTES]
+  if unknown:
+    sys.exit(f"Unknown routes: {', '.join(unknown)} (choose from {', '.join(ROUTES)})")
+
+  # App reads its configuration from the environment on import
+  database = args.database or os.path.join(tempfile.mkdtemp(prefix='shortener-bench-'), 'bench.db')
+  os.environ['DATABASE_URL'] = database
+  os.environ.setdefault('SECRET_KEY', 'benchmark')
+  if args.redis_url:
+    os.environ['REDIS_URL'] = args.redis_url
+  # All logins come from one client IP, keep them under its throttling limit (attempts are still counted)
+  os.environ.setdefault('LOGIN_IP_MAX_ATTEMPTS', '1000000')
+  # Same for request rate limits, timing them isn't the point
+  os.environ.setdefault('RATE_LIMIT_ENABLED', 'false')
+  os.chdir(ROOT)
+  import app as shortener
+  from api_keys import create_api_key
+  # Skips reCAPTCHA validation of the test client's forms
+  shortener.app.config['TESTING'] = True
+  shortener.create_db()
+
+  # Seeded usernames and codes are kept next to a SQLite DB (in results/ for PostgreSQL), for --skip-seed runs
+  if '://' in database:
+    manifest = os.path.join(ROOT, 'benchmarks', 'results', 'postgresql.seed.json')
+  else:
+    manifest = database + '.seed.json'
+  params = {key: getattr(args, key) for key in ('users', 'urls', 'clicks', 'zipf', 'seed')}
+  if args.skip_seed:
+    with open(manifest) as file:
+      seeded = json.load(file)
+    params = seeded['params']
+  else:
+    started = time.perf_counter()
+    # Every user shares one hash made with the app's bcrypt cost, so login timing is realistic
+    password_hash = shortener.bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+    seeded = seed(shortener.storage, shortener.code_allocator, password_hash, args.users, args.urls, args.clicks,
+                  args.zipf, random_seed=args.seed)
+    seeded['params'] = params
+    os.makedirs(os.path.dirname(manifest), exist_ok=True)
+    with open(manifest, 'w') as file:
+      json.dump(seeded, file)
+    print(f'Seeded {args.users} users, {args.urls} URLs, {args.clicks} clicks in {time.perf_counter() - started:.1f}s')
+
+  owner = shortener.storage.get_user_by_username(seeded['usernames'][0])
+  context = {
+    'codes': seeded['codes'],
+    'weights': seeded['weights'],
+    'usernames': seeded['usernames'],
+    'password': PASSWORD,
+    'api_key': create_api_key(shortener.storage, owner['id'], 'benchmark'),
+  }
+  if args.base_url:
+    make_driver = lambda: HTTPDriver(args.base_url)
+  else:
+    make_driver = lambda: TestClientDriver(shortener.app)
+
+  results = {
+    'commit': git_commit(),
+    'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'python': platform.python_version(),
+    'driver': 'http' if args.base_url else 'test_client',
+    'backend': 'postgresql' if '://' in database else 'sqlite',
+    'shared_tier': bool(args.redis_url),
+    'concurrency': args.concurrency,
+    'seed': params,
+    'routes': {},
+  }
+  for name in routes:
+    requests = args.login_requests if name == 'login' else args.requests
+    warmup = min(args.warmup, requests)
+    results['routes'][name] = run_route(name, ROUTES[name], make_driver, context, requests, warmup,
+                                        args.concurrency, args.seed)
+  shortener.click_buffer.stop()
+  if not routes:
+    return
+
+  output = args.output or os.path.join(ROOT, 'benchmarks', 'results',
+                                       f"{results['time'].replace(':', '')}-{results['commit'] or 'nogit'}.json")
+  os.makedirs(os.path.dirname(output), exist_ok=True)
+  with open(output, 'w') as file:
+    json.dump(results, file, indent=2)
+  baseline = None
+  if args.compare:
+    with open(args.compare) as file:
+      baseline = json.load(file)
+  print_results(results, baseline)
+  print(f'Results saved to {output}')
+
+if __name__ == '__main__':
+  main()
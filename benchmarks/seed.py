@@ -0,0 +1,74 @@
+import random
+from datetime import datetime, timedelta
+from clicks import rollup
+
+# Synthetic data for benchmarks: users, URLs built from a small vocabulary (so searches match),
+# and clicks following a Zipf distribution over URLs (a few hot links, a long tail)
+
+WORDS = ('alpha', 'bravo', 'cloud', 'delta', 'docs', 'echo', 'forum', 'garden', 'harbor', 'index',
+         'jungle', 'kernel', 'lemon', 'market', 'news', 'orbit', 'python', 'quartz', 'river', 'shop',
+         'travel', 'update', 'video', 'weather', 'xray', 'yellow', 'zebra', 'blog', 'music', 'photo')
+TLDS = ('com', 'org', 'net', 'io', 'dev')
+
+# Password of every seeded user
+PASSWORD = 'Bench-passw0rd!'
+
+# URLs inserted and click events written per transaction
+CHUNK_SIZE = 1000
+
+def username(index):
+  return f'bench_user_{index}'
+
+def random_url(rng):
+  host = f'{rng.choice(WORDS)}{rng.choice(WORDS)}.{rng.choice(TLDS)}'
+  path = '/'.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+  return f'https://www.{host}/{path}?id={rng.randint(1, 10 ** 6)}'
+
+# Cumulative Zipf weights of n ranks with exponent s, for random.choices
+def zipf_weights(n, s):
+  total = 0.0
+  cumulative = []
+  for rank in range(1, n + 1):
+    total += 1.0 / rank ** s
+    cumulative.append(total)
+  return cumulative
+
+# Seed storage through app's storage backend and code allocator
+# Returns dict with usernames, created codes (hottest first) and Zipf weights of codes
+def seed(storage, allocator, password_hash, users=100, urls=10000, clicks=100000, zipf_s=1.1, days=30, random_seed=1):
+  rng = random.Random(random_seed)
+  for index in range(users):
+    storage.create_user(username(index), password_hash, 'Bench', f'User {index}',
+                        f'{username(index)}@example.com', None, None)
+  user_rows = [storage.get_user_by_username(username(index)) for index in range(users)]
+
+  # Spread URLs over users, some users having many more than others
+  owners = rng.choices(user_rows, weights=[1.0 / (rank + 1) for rank in range(users)], k=urls)
+  codes = []
+  for start in range(0, urls, CHUNK_SIZE):
+    by_user = {}
+    for owner in owners[start:start + CHUNK_SIZE]:
+      by_user.setdefault(owner['id'], (owner, []))[1].append(random_url(rng))
+    for owner, original_urls in by_user.values():
+      chunk_codes = allocator.allocate(len(original_urls))
+      storage.create_urls(owner['id'], owner['username'], list(zip(original_urls, chunk_codes)))
+      codes.extend(chunk_codes)
+
+  # Hot URLs are spread over users and creation times
+  rng.shuffle(codes)
+  weights = zipf_weights(len(codes), zipf_s)
+  url_ids = {code: storage.get_link(code)['id'] for code in codes}
+  now = datetime.utcnow()
+  for start in range(0, clicks, CHUNK_SIZE * 10):
+    size = min(CHUNK_SIZE * 10, clicks - start)
+    events = []
+    counts = {}
+    for code in rng.choices(codes, cum_weights=weights, k=size):
+      url_id = url_ids[code]
+      clicked_at = now - timedelta(seconds=rng.randint(0, days * 86400))
+      events.append((url_id, clicked_at.strftime('%Y-%m-%d %H:%M:%S'), None, 'benchmark'))
+      counts[url_id] = counts.get(url_id, 0) + 1
+    hourly, daily = rollup(events)
+    storage.apply_clicks([(count, url_id) for url_id, count in sorted(counts.items())], events, hourly, daily)
+  storage.rebuild_user_stats()
+  return {'usernames': [row['username'] for row in user_rows], 'codes': codes, 'weights': weights}
@@ -0,0 +1,80 @@
+import csv
+import json
+from forms import original_url_error
+from links import link_policy
+from storage import CodeCollision
+from utils import MAX_CODE_ATTEMPTS
+
+# URLs inserted per transaction
+DEFAULT_CHUNK_SIZE = 500
+
+# Read (line number, original_url) from CSV lines
+# Uses the url/original_url column if first row is a header, first column otherwise
+def read_csv(lines):
+  column = 0
+  for number, row in enumerate(csv.reader(lines), 1):
+    if not row:
+      continue
+    if number == 1:
+      header = [cell.strip().lower() for cell in row]
+      if 'original_url' in header or 'url' in header:
+        column = header.index('original_url' if 'original_url' in header else 'url')
+        continue
+    yield number, row[column].strip() if column < len(row) else None
+
+# Read (line number, original_url) from NDJSON lines
+# Each line is a JSON string or an object with url/original_url key
+def read_ndjson(lines):
+  for number, line in enumerate(lines, 1):
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      item = json.loads(line)
+    except ValueError:
+      yield number, None
+      continue
+    if isinstance(item, dict):
+      item = item.get('original_url', item.get('url'))
+    yield number, item if isinstance(item, str) else None
+
+# Insert one chunk of validated (line number, original_url) in a single transaction
+# policy is the (redirect_status, cache_max_age) of all its URLs, links.link_policy() by default,
+# expires_at their expiry time in epoch seconds (None for never)
+def insert_chunk(storage, user_id, username, allocator, chunk, policy=None, expires_at=None):
+  redirect_status, cache_max_age = policy or link_policy()
+  for attempt in range(MAX_CODE_ATTEMPTS):
+    # Codes for the whole chunk come from one reserved block
+    codes = allocator.allocate(len(chunk))
+    try:
+      storage.create_urls(user_id, username, [(original_url, code) for (_, original_url), code in zip(chunk, codes)],
+                          redirect_status, cache_max_age, expires_at)
+      break
+    except CodeCollision:
+      # Code taken by a legacy random code, retry chunk with new codes
+      if attempt == MAX_CODE_ATTEMPTS - 1:
+        raise
+  return [{'line': number, 'original_url': original_url, 'shortened_url': code}
+          for (number, original_url), code in zip(chunk, codes)]
+
+# Validate and insert URLs in chunks, yielding a result dict per input line as soon as its chunk is committed
+# on_created is called with each new short code (e.g. to drop cached 404s)
+def import_urls(storage, user_id, username, allocator, records, chunk_size=DEFAULT_CHUNK_SIZE, on_created=None):
+  chunk = []
+  for number, original_url in records:
+    error = original_url_error(original_url) if original_url else 'Invalid URL!'
+    if error:
+      yield {'line': number, 'original_url': original_url, 'error': error}
+      continue
+    chunk.append((number, original_url))
+    if len(chunk) >= chunk_size:
+      yield from created(insert_chunk(storage, user_id, username, allocator, chunk), on_created)
+      chunk = []
+  if chunk:
+    yield from created(insert_chunk(storage, user_id, username, allocator, chunk), on_created)
+
+def created(results, on_created):
+  for result in results:
+    if on_created:
+      on_created(result['shortened_url'])
+    yield result
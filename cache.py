@@ -0,0 +1,92 @@
+import threading
+import time
+from collections import OrderedDict
+
+# Marker stored for keys known not to exist (negative cache)
+MISSING = object()
+
+# Bounded in-process LRU cache with per-entry TTL
+class LRUCache:
+  def __init__(self, maxsize=10000, ttl=300, negative_ttl=30):
+    self.maxsize = maxsize
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self._data = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.negative_hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.invalidations = 0
+
+  # Get cached value, MISSING for a cached negative entry, or default if not cached
+  def get(self, key, default=None):
+    now = time.monotonic()
+    with self._lock:
+      entry = self._data.get(key)
+      if entry is None:
+        self.misses += 1
+        return default
+      expires_at, value = entry
+      if expires_at <= now:
+        # Stale entry, drop it and count as a miss
+        del self._data[key]
+        self.expirations += 1
+        self.misses += 1
+        return default
+      # Mark as most recently used
+      self._data.move_to_end(key)
+      if value is MISSING:
+        self.negative_hits += 1
+      else:
+        self.hits += 1
+      return value
+
+  # Store value, evicting least recently used entries over maxsize
+  def set(self, key, value, ttl=None):
+    if self.maxsize <= 0:
+      return
+    if ttl is None:
+      ttl = self.negative_ttl if value is MISSING else self.ttl
+    if ttl <= 0:
+      return
+    with self._lock:
+      self._data[key] = (time.monotonic() + ttl, value)
+      self._data.move_to_end(key)
+      while len(self._data) > self.maxsize:
+        self._data.popitem(last=False)
+        self.evictions += 1
+
+  # Remember that key doesn't exist
+  def set_missing(self, key):
+    self.set(key, MISSING)
+
+  # Drop a single entry (positive or negative)
+  def invalidate(self, key):
+    with self._lock:
+      if self._data.pop(key, None) is not None:
+        self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+
+  def __len__(self):
+    return len(self._data)
+
+  # Counters used to size the cache against real traffic
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.negative_hits + self.misses
+      return {
+        'size': len(self._data),
+        'maxsize': self.maxsize,
+        'hits': self.hits,
+        'negative_hits': self.negative_hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+        'invalidations': self.invalidations,
+        'hit_ratio': (self.hits + self.negative_hits) / lookups if lookups else 0.0,
+      }
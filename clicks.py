@@ -0,0 +1,391 @@
+import atexit
+import json
+import threading
+import urllib.error
+import urllib.request
+from datetime import datetime
+from shared_tier import TierDown
+from storage import StorageError
+
+# Longest referrer / user agent kept per click event
+MAX_HEADER_LENGTH = 512
+# Format of click event times (UTC)
+CLICKED_AT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Click events a worker keeps at most while flushes fail (DB, tier or primary down)
+MAX_BUFFERED_EVENTS = 100000
+
+# Write-behind buffer for click counts and click events, flushed to the DB in batches by a background thread
+# Counts are always kept, events past max_events are dropped (and counted) so an outage can't exhaust memory,
+# their clicks still count but are missing from the hourly/daily rollups
+class ClickBuffer:
+  def __init__(self, storage, flush_interval=1.0, flush_threshold=500, max_events=MAX_BUFFERED_EVENTS):
+    self.storage = storage
+    self.flush_interval = flush_interval
+    self.flush_threshold = flush_threshold
+    self.max_events = max_events
+    # url_id -> unflushed clicks
+    self._counts = {}
+    # url_id -> owner user_id, so dashboards can add pending clicks per user
+    self._owners = {}
+    # (url_id, clicked_at, referrer, user_agent) tuples waiting to be logged
+    self._log = []
+    self._events = 0
+    self._lock = threading.Lock()
+    self._flush_lock = threading.Lock()
+    self._wake = threading.Event()
+    self._stopping = False
+    self._thread = None
+    self.flushes = 0
+    self.dropped_events = 0
+
+  # Count a click, waking the flusher early once enough clicks are pending
+  def record(self, url_id, user_id=None, referrer=None, user_agent=None):
+    self._buffer(click_event(url_id, referrer, user_agent), user_id)
+
+  # Add click event to this worker's buffer
+  def _buffer(self, event, user_id):
+    url_id = event[0]
+    with self._lock:
+      self._counts[url_id] = self._counts.get(url_id, 0) + 1
+      self._owners[url_id] = user_id
+      if len(self._log) < self.max_events:
+        self._log.append(event)
+      else:
+        self.dropped_events += 1
+      self._events += 1
+      full = self._events >= self.flush_threshold
+    if self._thread is None:
+      self.start()
+    if full:
+      self._wake.set()
+
+  # Unflushed clicks of a single URL
+  def pending(self, url_id):
+    with self._lock:
+      return self._counts.get(url_id, 0)
+
+  # Unflushed clicks of all URLs owned by user
+  def pending_for_user(self, user_id):
+    user_id = int(user_id)
+    with self._lock:
+      return sum(count for url_id, count in self._counts.items() if self._owners.get(url_id) == user_id)
+
+  # Copy of unflushed clicks per URL
+  def snapshot(self):
+    with self._lock:
+      return dict(self._counts)
+
+  # Copy URL rows into dicts with pending clicks added, for display
+  def apply(self, rows):
+    counts = self.snapshot()
+    return [with_clicks(row, counts) for row in rows]
+
+  # Function adding pending clicks to a single row, for rows read lazily
+  def applier(self):
+    counts = self.snapshot()
+    return lambda row: with_clicks(row, counts)
+
+  # Apply all pending clicks, log their events and update rollups in one transaction
+  def flush(self):
+    with self._flush_lock:
+      with self._lock:
+        counts, owners, log = self._counts, self._owners, self._log
+        self._counts, self._owners, self._log, self._events = {}, {}, [], 0
+      if not counts:
+        return 0
+      if not self._write(counts, log):
+        # Put clicks back so the next flush retries them
+        self._restore(counts, owners, log)
+        return 0
+      self.flushes += 1
+      return sum(counts.values())
+
+  # Write out pending clicks before a job reads click counts, False if clicks of other workers can't be seen
+  # Clicks that couldn't be written stay pending, in snapshot()
+  def drain(self):
+    self.flush()
+    return True
+
+  # Write url_id -> clicks counts and their events to storage, False if it failed
+  def _write(self, counts, log):
+    try:
+      write_clicks(self.storage, counts, log)
+    except StorageError as e:
+      print(e) # Log error to server only
+      return False
+    return True
+
+  # Put clicks back in this worker's buffer
+  def _restore(self, counts, owners, log):
+    with self._lock:
+      for url_id, count in counts.items():
+        self._counts[url_id] = self._counts.get(url_id, 0) + count
+        self._owners.setdefault(url_id, owners.get(url_id))
+        self._events += count
+      # Events of the failed flush came first, the newest ones are dropped past max_events
+      self._log = log + self._log
+      if len(self._log) > self.max_events:
+        self.dropped_events += len(self._log) - self.max_events
+        del self._log[self.max_events:]
+
+  # Start background flusher, called on first click
+  def start(self):
+    with self._flush_lock:
+      if self._thread is not None:
+        return
+      self._thread = threading.Thread(target=self._run, name='click-flusher', daemon=True)
+      self._thread.start()
+    atexit.register(self.stop)
+
+  def _run(self):
+    while not self._stopping:
+      self._wake.wait(self.flush_interval)
+      self._wake.clear()
+      self.flush()
+
+  # Stop flusher and write out whatever is still pending (on shutdown)
+  def stop(self):
+    self._stopping = True
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join(timeout=5)
+    self.flush()
+
+# Click counters shared by all workers, kept in the shared tier with atomic increments
+# Each worker's flusher drains a batch of counters and events to the DB; clicks counted while
+# the tier is down stay in the worker's own buffer, so nothing is lost when it goes away
+class SharedClickBuffer(ClickBuffer):
+  def __init__(self, storage, tier, flush_interval=1.0, flush_threshold=500, batch_size=1000,
+               max_events=MAX_BUFFERED_EVENTS):
+    super().__init__(storage, flush_interval, flush_threshold, max_events)
+    self.tier = tier
+    self.batch_size = batch_size
+    # Set of URL ids with pending clicks, and hashes of URL owners and pending clicks per user
+    self._dirty = tier.key('clicks', 'dirty')
+    self._owner_key = tier.key('clicks', 'owners')
+    self._user_key = tier.key('clicks', 'users')
+    self._events_key = tier.key('clicks', 'events')
+
+  def _count_key(self, url_id):
+    return self.tier.key('clicks', url_id)
+
+  # Count a click in the tier, in one round trip
+  def record(self, url_id, user_id=None, referrer=None, user_agent=None):
+    event = click_event(url_id, referrer, user_agent)
+    def count(client):
+      pipe = client.pipeline()
+      pipe.incr(self._count_key(url_id))
+      pipe.sadd(self._dirty, url_id)
+      if user_id is not None:
+        pipe.hset(self._owner_key, url_id, user_id)
+        pipe.hincrby(self._user_key, user_id, 1)
+      pipe.rpush(self._events_key, json.dumps(event))
+      return pipe.execute()[-1]
+    try:
+      events = self.tier.run(count)
+    except TierDown:
+      self._buffer(event, user_id)
+      return
+    if self._thread is None:
+      self.start()
+    if events >= self.flush_threshold:
+      self._wake.set()
+
+  def pending(self, url_id):
+    try:
+      shared = int(self.tier.run(lambda client: client.get(self._count_key(url_id))) or 0)
+    except TierDown:
+      shared = 0
+    return super().pending(url_id) + shared
+
+  def pending_for_user(self, user_id):
+    try:
+      shared = int(self.tier.run(lambda client: client.hget(self._user_key, user_id)) or 0)
+    except TierDown:
+      shared = 0
+    return super().pending_for_user(user_id) + shared
+
+  def snapshot(self):
+    counts = super().snapshot()
+    def pending(client):
+      url_ids = sorted(client.smembers(self._dirty))
+      return zip(url_ids, client.mget([self._count_key(url_id) for url_id in url_ids]) if url_ids else [])
+    try:
+      for url_id, count in self.tier.run(pending):
+        counts[int(url_id)] = counts.get(int(url_id), 0) + int(count or 0)
+    except TierDown:
+      pass
+    return counts
+
+  # Flush this worker's own clicks, then drain one batch from the tier
+  def flush(self):
+    flushed = super().flush()
+    try:
+      counts, owners, log = self.tier.run(self._take)
+    except TierDown:
+      return flushed
+    if not counts and not log:
+      return flushed
+    if not self._write(counts, log):
+      self._give_back(counts, owners, log)
+      return flushed
+    # Clicks are in the DB now, stop counting them as pending per user
+    by_user = {}
+    for url_id, count in counts.items():
+      if owners.get(url_id) is not None:
+        by_user[owners[url_id]] = by_user.get(owners[url_id], 0) + count
+    def settle(client):
+      pipe = client.pipeline()
+      for user_id, count in by_user.items():
+        pipe.hincrby(self._user_key, user_id, -count)
+      pipe.execute()
+    try:
+      if by_user:
+        self.tier.run(settle)
+    except TierDown:
+      pass
+    self.flushes += 1
+    return flushed + sum(counts.values())
+
+  # Flush until the tier's pending set is drained (at most the batches pending when called, so a steady stream
+  # of new clicks can't keep it going), False if the tier is down and other workers' clicks can't be seen
+  def drain(self):
+    try:
+      pending = len(self.tier.run(lambda client: client.smembers(self._dirty)))
+      for _ in range(pending // self.batch_size + 1):
+        if not self.flush():
+          break
+      # Flushes don't raise if the tier goes away, make sure snapshot() will still see it
+      self.tier.run(lambda client: client.ping())
+    except TierDown:
+      return False
+    return True
+
+  # Atomically take a batch of counters (get and reset) and events off the tier
+  def _take(self, client):
+    url_ids = client.spop(self._dirty, self.batch_size)
+    pipe = client.pipeline()
+    for url_id in url_ids:
+      pipe.get(self._count_key(url_id))
+      pipe.delete(self._count_key(url_id))
+      pipe.hget(self._owner_key, url_id)
+    pipe.lrange(self._events_key, 0, self.batch_size - 1)
+    pipe.ltrim(self._events_key, self.batch_size, -1)
+    results = pipe.execute()
+    counts = {}
+    owners = {}
+    for index, url_id in enumerate(url_ids):
+      count, _, owner = results[index * 3:index * 3 + 3]
+      if count and int(count):
+        counts[int(url_id)] = int(count)
+        owners[int(url_id)] = int(owner) if owner is not None else None
+    log = [tuple(json.loads(event)) for event in results[-2]]
+    return counts, owners, log
+
+  # Put drained clicks back in the tier after a failed DB write, or in this worker's buffer if the tier is gone too
+  def _give_back(self, counts, owners, log):
+    def give_back(client):
+      pipe = client.pipeline()
+      for url_id, count in counts.items():
+        pipe.incrby(self._count_key(url_id), count)
+        pipe.sadd(self._dirty, url_id)
+        if owners.get(url_id) is not None:
+          pipe.hset(self._owner_key, url_id, owners[url_id])
+      if log:
+        pipe.lpush(self._events_key, *[json.dumps(event) for event in reversed(log)])
+      pipe.execute()
+    try:
+      self.tier.run(give_back)
+    except TierDown:
+      # Pending per user counters in the tier will be off until they're drained again, display only
+      self._restore(counts, owners, log)
+
+# Statuses of the primary's click endpoint for batches that will never be accepted: invalid batch, wrong token,
+# no token set on the primary
+REJECTED_STATUSES = (400, 401, 403, 404)
+
+# Clicks counted on a redirect replica (see snapshot.py), sent to the primary node's click endpoint in batches
+# (POST /api/v1/replica/clicks, authenticated with the token both nodes share), which writes them like a flush
+# Batches the primary can't take right now are kept and retried, batches it rejects (REJECTED_STATUSES) are dropped
+class RemoteClickBuffer(ClickBuffer):
+  def __init__(self, primary_url, token, timeout=5.0, flush_interval=1.0, flush_threshold=500,
+               max_events=MAX_BUFFERED_EVENTS):
+    super().__init__(None, flush_interval, flush_threshold, max_events)
+    self.endpoint = primary_url.rstrip('/') + '/api/v1/replica/clicks'
+    self.token = token
+    self.timeout = timeout
+
+  def _write(self, counts, log):
+    body = json.dumps({'clicks': sorted(counts.items()), 'events': log}).encode('utf-8')
+    request = urllib.request.Request(self.endpoint, data=body, method='POST',
+                                     headers={'Content-Type': 'application/json',
+                                              'Authorization': 'Bearer ' + (self.token or '')})
+    try:
+      with urllib.request.urlopen(request, timeout=self.timeout):
+        return True
+    except urllib.error.HTTPError as e:
+      if e.code not in REJECTED_STATUSES:
+        print(e) # Log error to server only
+        return False
+      # Batches the primary refuses (invalid, or token wrong or not set there) would never go through,
+      # drop them instead of retrying them forever with every later click added on top
+      print(f'Primary refused clicks ({e}), check REPLICA_TOKEN on both nodes, batch dropped') # Log to server only
+      self.dropped_events += len(log)
+      return True
+    except OSError as e:
+      print(e) # Log error to server only
+      return False
+
+# Write url_id -> clicks counts and their click events to storage in one transaction, with their rollups
+# Raises StorageError if it failed
+def write_clicks(storage, counts, log):
+  hourly, daily = rollup(log)
+  # Sorted by URL so concurrent flushes of several workers lock rows in the same order
+  clicks_by_url = [(count, url_id) for url_id, count in sorted(counts.items())]
+  storage.apply_clicks(clicks_by_url, log, hourly, daily)
+
+# (counts, events) of a click batch sent by a replica as {"clicks": [[url_id, clicks], ...], "events": [event, ...]},
+# None if it isn't valid
+def parse_click_batch(data):
+  if not isinstance(data, dict) or not isinstance(data.get('clicks'), list) or not isinstance(data.get('events'), list):
+    return None
+  counts = {}
+  for item in data['clicks']:
+    if not isinstance(item, list) or len(item) != 2 or not all(type(value) is int and value > 0 for value in item):
+      return None
+    counts[item[0]] = counts.get(item[0], 0) + item[1]
+  events = []
+  for item in data['events']:
+    if (not isinstance(item, list) or len(item) != 4 or type(item[0]) is not int or not isinstance(item[1], str)
+        or not all(value is None or isinstance(value, str) for value in item[2:])):
+      return None
+    try:
+      datetime.strptime(item[1], CLICKED_AT_FORMAT)
+    except ValueError:
+      return None
+    events.append((item[0], item[1], item[2][:MAX_HEADER_LENGTH] if item[2] else None,
+                   item[3][:MAX_HEADER_LENGTH] if item[3] else None))
+  return counts, events
+
+# Click event tuple (url_id, clicked_at, referrer, user_agent), headers cut to MAX_HEADER_LENGTH
+def click_event(url_id, referrer=None, user_agent=None):
+  return (url_id, datetime.utcnow().strftime(CLICKED_AT_FORMAT),
+          referrer[:MAX_HEADER_LENGTH] if referrer else None,
+          user_agent[:MAX_HEADER_LENGTH] if user_agent else None)
+
+# Copy URL row into dict with pending clicks added
+def with_clicks(row, counts):
+  return dict(row, clicks=(row['clicks'] or 0) + counts.get(row['id'], 0))
+
+# Aggregate a batch of click events into (url_id, bucket, clicks) rows per hour and per day
+def rollup(events):
+  hourly = {}
+  daily = {}
+  for url_id, clicked_at, _, _ in events:
+    hour = (url_id, clicked_at[:13] + ':00')
+    day = (url_id, clicked_at[:10])
+    hourly[hour] = hourly.get(hour, 0) + 1
+    daily[day] = daily.get(day, 0) + 1
+  return ([(url_id, bucket, clicks) for (url_id, bucket), clicks in hourly.items()],
+          [(url_id, bucket, clicks) for (url_id, bucket), clicks in daily.items()])
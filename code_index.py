@@ -0,0 +1,327 @@
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from cache import MISSING
+from storage import StorageError
+from utils import decode_code, DEFAULT_ALPHABET, DEFAULT_LENGTH
+
+# Memory-mapped index of redirect data by short code, read before the DB on redirects (see Storage.get_link)
+# Codes of the configured length and alphabet are packed into 64-bit keys (utils.decode_code), other codes
+# (e.g. legacy random ones) aren't indexed and are looked up in the DB.
+#
+# Index file: header, sorted array of keys, array of fixed-width records in key order, then a blob of the
+# original URLs the records point into. Lookups binary search the keys in place, the file is opened read-only
+# and shared, so every worker process on the host uses the same page cache copy.
+#
+# Links created or deleted since the index was built are appended to a delta log (<path>.delta) by the worker
+# that wrote them, each worker reads new delta entries at most every check_interval seconds.
+# Rebuilding (flask urls index) writes a new index from the DB and starts a new delta log.
+# Workers keep the delta entries they read in memory, up to max_delta of them: past that they drop them, send
+# lookups to the DB and one of them (holding <path>.lock) rebuilds the index, which every worker then loads.
+# All workers writing links must share the files, i.e. run on one host
+
+INDEX_MAGIC = b'CIDX'
+INDEX_VERSION = 1
+# Magic, version, code length, link count, creation time, alphabet (padded)
+HEADER = struct.Struct('<4sHHQQ64s')
+# Keys start at a 64-bit aligned offset after the header
+KEYS_OFFSET = 128
+# id, user_id, expires_at (-1 for None), cache_max_age, redirect_status, URL offset in blob, URL length
+RECORD = struct.Struct('<qqqiHQI')
+# Delta entry: operation, key, then the record fields but URL offset, followed by the URL
+DELTA = struct.Struct('<BQqqqiHI')
+DELTA_PUT = 1
+DELTA_DELETE = 2
+# Delta entries a worker keeps in memory before the index is rebuilt
+MAX_DELTA = 100000
+# Seconds between rebuild attempts of a worker while its delta is over max_delta
+REBUILD_INTERVAL = 60
+
+# Packed record fields of a URL row, None values stored as -1
+def pack_fields(url_row):
+  return (url_row['id'], -1 if url_row['user_id'] is None else url_row['user_id'],
+          -1 if url_row['expires_at'] is None else url_row['expires_at'],
+          url_row['cache_max_age'], url_row['redirect_status'])
+
+# Redirect data row (like Storage.get_link) of packed record fields
+def unpack_fields(url_id, user_id, expires_at, cache_max_age, redirect_status, original_url):
+  return {'id': url_id, 'original_url': original_url, 'user_id': None if user_id < 0 else user_id,
+          'redirect_status': redirect_status, 'cache_max_age': cache_max_age,
+          'expires_at': None if expires_at < 0 else expires_at}
+
+# Raise ValueError if codes of alphabet and length can't be indexed: keys must fit in 64 bits,
+# the alphabet in the header
+def check_code_format(alphabet, length):
+  if len(alphabet) ** length > 1 << 64:
+    raise ValueError(f'Code index needs codes of at most 64 bits, {length} characters of a {len(alphabet)} '
+                     f'character alphabet are too many (lower SHORT_CODE_LENGTH or unset CODE_INDEX)')
+  if len(alphabet.encode('utf-8')) > 64:
+    raise ValueError('Code index needs an alphabet of at most 64 bytes')
+
+# Key of a code, None if it can't be indexed
+def code_key(code, alphabet=DEFAULT_ALPHABET, length=DEFAULT_LENGTH):
+  if len(code) != length:
+    return None
+  return decode_code(code, alphabet)
+
+# Write an index of all links of storage at path, then start a new delta log
+# Entries logged while it's built are kept in the new log, replaying them over the new index is harmless
+# Returns number of links indexed
+def build_code_index(storage, path, alphabet=DEFAULT_ALPHABET, length=DEFAULT_LENGTH, batch_size=10000):
+  check_code_format(alphabet, length)
+  # Writers open the log by name for every append, so from here on they write to a new log
+  delta = path + '.delta'
+  if os.path.exists(delta):
+    os.replace(delta, delta + '.old')
+  entries = []
+  after_id = 0
+  while True:
+    rows = storage.link_batch(after_id, batch_size)
+    if not rows:
+      break
+    for row in rows:
+      key = code_key(row['shortened_url'], alphabet, length)
+      if key is not None:
+        entries.append((key, pack_fields(row), row['original_url'].encode('utf-8')))
+    after_id = rows[-1]['id']
+  entries.sort(key=lambda entry: entry[0])
+  temporary = path + '.tmp'
+  with open(temporary, 'wb') as file:
+    file.write(HEADER.pack(INDEX_MAGIC, INDEX_VERSION, length, len(entries), int(time.time()),
+                           alphabet.encode('utf-8')).ljust(KEYS_OFFSET, b'\0'))
+    # Native (little-endian) 64-bit keys, so readers can search the array in place
+    file.write(array('Q', [entry[0] for entry in entries]).tobytes())
+    offset = 0
+    for _, fields, url in entries:
+      file.write(RECORD.pack(*fields, offset, len(url)))
+      offset += len(url)
+    for _, _, url in entries:
+      file.write(url)
+    file.flush()
+    os.fsync(file.fileno())
+  os.replace(temporary, path)
+  if os.path.exists(delta + '.old'):
+    os.remove(delta + '.old')
+  return len(entries)
+
+# Reader and delta log writer of a code index at path, one per worker process
+class CodeIndex:
+  def __init__(self, path, alphabet=DEFAULT_ALPHABET, length=DEFAULT_LENGTH, check_interval=1, max_delta=MAX_DELTA,
+               rebuild=None):
+    if sys.byteorder != 'little':
+      raise ValueError('Code index needs a little-endian host')
+    check_code_format(alphabet, length)
+    self.path = path
+    self.alphabet = alphabet
+    self.length = length
+    self.check_interval = check_interval
+    self.max_delta = max_delta
+    # Function rebuilding the index (build_code_index of the DB), None to wait for "flask urls index"
+    self.rebuild = rebuild
+    self.links = 0
+    self.created_at = None
+    self.loads = 0
+    self.rebuilds = 0
+    self._lock = threading.Lock()
+    self._checked_at = 0
+    self._file = None
+    self._mmap = None
+    self._keys = ()
+    self._records_offset = 0
+    self._blob_offset = 0
+    # key -> row or None (deleted) of entries read from the delta log
+    self._delta = {}
+    self._delta_file = None
+    self._delta_inode = None
+    # Delta outgrew max_delta, lookups go to the DB until a rebuilt index is loaded
+    self._overflowed = False
+    self._rebuilding = False
+    self._rebuild_started = None
+
+  # Redirect data row of code, MISSING if it was deleted, None if the index doesn't know it (ask the DB)
+  def get(self, code):
+    key = code_key(code, self.alphabet, self.length)
+    if key is None:
+      return None
+    with self._lock:
+      self._refresh()
+      if self._overflowed:
+        return None
+      if key in self._delta:
+        url_row = self._delta[key]
+        return MISSING if url_row is None else url_row
+      position = bisect.bisect_left(self._keys, key)
+      if position == len(self._keys) or self._keys[position] != key:
+        return None
+      *fields, url_offset, url_length = RECORD.unpack_from(self._mmap, self._records_offset + position * RECORD.size)
+      start = self._blob_offset + url_offset
+      return unpack_fields(*fields, self._mmap[start:start + url_length].decode('utf-8'))
+
+  # Log created links (rows with shortened_url and redirect data) and deleted codes
+  def log(self, rows=(), deleted=()):
+    entries = []
+    updates = {}
+    for row in rows:
+      key = code_key(row['shortened_url'], self.alphabet, self.length)
+      if key is not None:
+        url = row['original_url'].encode('utf-8')
+        entries.append(DELTA.pack(DELTA_PUT, key, *pack_fields(row), len(url)) + url)
+        updates[key] = unpack_fields(*pack_fields(row), row['original_url'])
+    for code in deleted:
+      key = code_key(code, self.alphabet, self.length)
+      if key is not None:
+        entries.append(DELTA.pack(DELTA_DELETE, key, 0, 0, 0, 0, 0, 0))
+        updates[key] = None
+    if not entries:
+      return
+    # One write of an O_APPEND file, so entries of concurrent workers don't interleave
+    fd = os.open(self.path + '.delta', os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+      os.write(fd, b''.join(entries))
+    finally:
+      os.close(fd)
+    # This worker sees its own changes right away, others on their next delta read
+    with self._lock:
+      if not self._overflowed:
+        self._delta.update(updates)
+        self._bound_delta()
+
+  # Load a new index file and read new delta entries, at most every check_interval seconds
+  def _refresh(self):
+    now = time.monotonic()
+    if now - self._checked_at < self.check_interval:
+      return
+    self._checked_at = now
+    try:
+      stat = os.stat(self.path)
+      if (stat.st_ino, stat.st_mtime_ns) != self._file:
+        self._load((stat.st_ino, stat.st_mtime_ns))
+      if self._overflowed:
+        self._start_rebuild()
+      else:
+        self._read_delta()
+        self._bound_delta()
+    except (OSError, ValueError) as e:
+      if self._mmap is not None:
+        print(e) # Log error to server only, the loaded index is still used
+
+  def _load(self, file):
+    with open(self.path, 'rb') as handle:
+      index = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, length, count, created_at, alphabet = HEADER.unpack_from(index)
+    if (magic, version) != (INDEX_MAGIC, INDEX_VERSION) or (alphabet.rstrip(b'\0').decode('utf-8'), length) != (
+        self.alphabet, self.length):
+      index.close()
+      raise ValueError(f'Code index {self.path} was built for another code format, rebuild it')
+    old = self._mmap
+    self._mmap, self._file = index, file
+    self._keys = memoryview(index)[KEYS_OFFSET:KEYS_OFFSET + count * 8].cast('Q')
+    self._records_offset = KEYS_OFFSET + count * 8
+    self._blob_offset = self._records_offset + count * RECORD.size
+    self.links, self.created_at = count, created_at
+    self.loads += 1
+    # Entries of the old delta log are in the new index, start over with the current log
+    self._delta = {}
+    self._overflowed = False
+    self._rebuild_started = None
+    if self._delta_file is not None:
+      self._delta_file.close()
+    self._delta_file = self._delta_inode = None
+    if old is not None:
+      try:
+        old.close()
+      except BufferError:
+        pass # Still referenced by a lookup's memoryview, released with it
+
+  # Apply delta entries appended since last read, switching to a new log once the old one is read to its end
+  def _read_delta(self):
+    delta = self.path + '.delta'
+    if self._delta_file is None:
+      # A log rotated away by a rebuild that hasn't replaced the index yet is read first
+      for candidate in (delta + '.old', delta):
+        if os.path.exists(candidate):
+          self._open_delta(candidate)
+          break
+      else:
+        return
+    while True:
+      self._apply(self._delta_file)
+      try:
+        inode = os.stat(delta).st_ino
+      except FileNotFoundError:
+        return
+      if inode == self._delta_inode:
+        return
+      self._delta_file.close()
+      self._open_delta(delta)
+
+  def _open_delta(self, name):
+    self._delta_file = open(name, 'rb')
+    self._delta_inode = os.fstat(self._delta_file.fileno()).st_ino
+
+  def _apply(self, file):
+    data = file.read()
+    offset = 0
+    while offset + DELTA.size <= len(data):
+      operation, key, *fields, url_length = DELTA.unpack_from(data, offset)
+      end = offset + DELTA.size + url_length
+      if end > len(data):
+        break
+      if operation == DELTA_PUT:
+        self._delta[key] = unpack_fields(*fields, data[offset + DELTA.size:end].decode('utf-8'))
+      else:
+        self._delta[key] = None
+      offset = end
+    # Entry still being written, read again from its start next time
+    file.seek(offset - len(data), os.SEEK_CUR)
+
+  # Drop the delta once it holds more than max_delta entries, and start a rebuild that folds it into the index
+  def _bound_delta(self):
+    if len(self._delta) <= self.max_delta:
+      return
+    self._delta = {}
+    self._overflowed = True
+    if self._delta_file is not None:
+      self._delta_file.close()
+    self._delta_file = self._delta_inode = None
+    self._start_rebuild()
+
+  # Rebuild in the background, retried every REBUILD_INTERVAL seconds until a new index is loaded
+  def _start_rebuild(self):
+    now = time.monotonic()
+    if self.rebuild is None or self._rebuilding or (
+        self._rebuild_started is not None and now - self._rebuild_started < REBUILD_INTERVAL):
+      return
+    self._rebuilding = True
+    self._rebuild_started = now
+    threading.Thread(target=self._rebuild, name='code-index-rebuild', daemon=True).start()
+
+  # Rebuild the index, unless another worker on the host already is
+  def _rebuild(self):
+    try:
+      with open(self.path + '.lock', 'w') as lock:
+        try:
+          fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          return
+        self.rebuild()
+        self.rebuilds += 1
+    except (OSError, StorageError) as e:
+      print(e) # Log error to server only, lookups stay with the DB until the index is rebuilt
+    finally:
+      self._rebuilding = False
+
+  def close(self):
+    with self._lock:
+      if self._delta_file is not None:
+        self._delta_file.close()
+      self._keys = ()
+      if self._mmap is not None:
+        self._mmap.close()
+        self._mmap = None
@@ -0,0 +1,111 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Default tuning for SQLite connections, can be overridden through app config
+DEFAULT_CONFIG = {
+  'SQLITE_JOURNAL_MODE': 'WAL',
+  'SQLITE_SYNCHRONOUS': 'NORMAL',
+  # Lets the purge job give freed pages back a few at a time, applies to new DB files (`flask db vacuum` converts old ones)
+  'SQLITE_AUTO_VACUUM': 'INCREMENTAL',
+  # Negative value means KiB instead of pages (16MB page cache per connection)
+  'SQLITE_CACHE_SIZE': -16000,
+  # Memory-map up to 256MB of the database file
+  'SQLITE_MMAP_SIZE': 268435456,
+  'SQLITE_BUSY_TIMEOUT': 5000,
+  # Number of compiled statements kept per connection
+  'SQLITE_STATEMENT_CACHE': 256,
+  # Number of idle connections kept open in the pool
+  'SQLITE_POOL_SIZE': 8,
+}
+
+# Pool of reusable SQLite connections
+class ConnectionPool:
+  def __init__(self, path, journal_mode='WAL', synchronous='NORMAL', cache_size=-16000,
+               mmap_size=268435456, busy_timeout=5000, statement_cache=256, pool_size=8, auto_vacuum='INCREMENTAL'):
+    self.path = path
+    self.auto_vacuum = auto_vacuum
+    self.journal_mode = journal_mode
+    self.synchronous = synchronous
+    self.cache_size = cache_size
+    self.mmap_size = mmap_size
+    self.busy_timeout = busy_timeout
+    self.statement_cache = statement_cache
+    self.pool_size = pool_size
+    self._idle = queue.LifoQueue(maxsize=pool_size)
+    self._lock = threading.Lock()
+    self._closed = False
+    self.created = 0
+
+  # Open and tune a new connection
+  def connect(self):
+    # Connections are handed between threads by the pool but only used by one thread at a time
+    conn = sqlite3.connect(self.path, cached_statements=self.statement_cache, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout)}")
+    # Only takes effect before the first table is created
+    conn.execute(f"PRAGMA auto_vacuum = {self.auto_vacuum}")
+    conn.execute(f"PRAGMA journal_mode = {self.journal_mode}")
+    conn.execute(f"PRAGMA synchronous = {self.synchronous}")
+    conn.execute(f"PRAGMA cache_size = {int(self.cache_size)}")
+    conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+    with self._lock:
+      self.created += 1
+    return conn
+
+  # Take an idle connection from the pool or open a new one
+  def acquire(self):
+    try:
+      return self._idle.get_nowait()
+    except queue.Empty:
+      return self.connect()
+
+  # Give a connection back to the pool, closing it if the pool is full
+  def release(self, conn):
+    # Never hand out a connection with a half-done transaction
+    if conn.in_transaction:
+      conn.rollback()
+    if self._closed:
+      conn.close()
+      return
+    try:
+      self._idle.put_nowait(conn)
+    except queue.Full:
+      conn.close()
+
+  # Number of idle connections
+  def idle(self):
+    return self._idle.qsize()
+
+  # Context manager for code running outside of a request (CLI, background threads)
+  @contextmanager
+  def connection(self):
+    conn = self.acquire()
+    try:
+      yield conn
+    finally:
+      self.release(conn)
+
+  # Close all idle connections
+  def close(self):
+    self._closed = True
+    while True:
+      try:
+        self._idle.get_nowait().close()
+      except queue.Empty:
+        break
+
+# Create the app's pool from app config
+def create_pool(app):
+  for key, value in DEFAULT_CONFIG.items():
+    app.config.setdefault(key, value)
+  return ConnectionPool(app.config['DATABASE'],
+                        journal_mode=app.config['SQLITE_JOURNAL_MODE'],
+                        synchronous=app.config['SQLITE_SYNCHRONOUS'],
+                        cache_size=app.config['SQLITE_CACHE_SIZE'],
+                        mmap_size=app.config['SQLITE_MMAP_SIZE'],
+                        busy_timeout=app.config['SQLITE_BUSY_TIMEOUT'],
+                        statement_cache=app.config['SQLITE_STATEMENT_CACHE'],
+                        pool_size=app.config['SQLITE_POOL_SIZE'],
+                        auto_vacuum=app.config['SQLITE_AUTO_VACUUM'])
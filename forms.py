@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm, RecaptchaField
+from wtforms import Form
 from flask_wtf.recaptcha.validators import Recaptcha
-from wtforms import EmailField, StringField, SubmitField, PasswordField, TelField, URLField, SearchField, ValidationError
-from wtforms.validators import DataRequired, Email, URL, EqualTo, Length, Optional
+from wtforms import (EmailField, StringField, SubmitField, PasswordField, TelField, URLField, SearchField, SelectField,
+                     IntegerField, ValidationError)
+from wtforms.validators import DataRequired, Email, URL, EqualTo, Length, Optional, NumberRange
+from links import DEFAULT_REDIRECT_STATUS, MAX_CACHE_MAX_AGE
 
 # Custom password validator
 def complex_password(form, field):
@@ -78,12 +81,26 @@ class ProfileForm(FlaskForm):
       validators=[Recaptcha(message='Please check the security Recaptcha field!')])
   submit = SubmitField('Update')
 
+# Rules for original URLs, shared by the create form and bulk/API imports
+def original_url_validators():
+  return [URL(message='Invalid URL!')]
+
 class CreateURLForm(FlaskForm):
   class Meta:
     csrf = True
   """Create URL Form"""
-  original_url = URLField('Enter your original URL', validators=[
-      URL(message='Invalid URL!')])
+  original_url = URLField('Enter your original URL', validators=original_url_validators())
+  redirect_status = SelectField('Redirect type', coerce=int, default=DEFAULT_REDIRECT_STATUS, choices=[
+      (302, 'Temporary (302) - every click is counted'),
+      (307, 'Temporary, keeps request method (307) - every click is counted'),
+      (301, 'Permanent (301) - cached by browsers, repeat clicks may not be counted'),
+      (308, 'Permanent, keeps request method (308) - cached by browsers, repeat clicks may not be counted')])
+  cache_max_age = IntegerField('Cache for (seconds, blank for default, 0 to never cache)', validators=[
+      Optional(),
+      NumberRange(min=0, max=MAX_CACHE_MAX_AGE, message='Cache time must be between %(min)d and %(max)d seconds!')])
+  expires_in = SelectField('Expires', coerce=int, default=0, choices=[
+      (0, 'Never'), (3600, 'In 1 hour'), (86400, 'In 1 day'), (604800, 'In 1 week'), (2592000, 'In 30 days'),
+      (31536000, 'In 1 year')])
   recaptcha = RecaptchaField(
       validators=[Recaptcha(message='Please check the security Recaptcha field!')])
   submit = SubmitField('Create')
@@ -94,4 +111,15 @@ class SearchForm(FlaskForm):
   """Create URL Form"""
   q = SearchField('Search for URLs', validators=[
     Length(max=50, min=2, message='Search term must be between %(min)d and %(max)d characters long!'),
-    DataRequired(message='Please enter search term!')])
\ No newline at end of file
+    DataRequired(message='Please enter search term!')])
+
+class OriginalURLForm(Form):
+  """Original URL validation outside of a request form (bulk import, API)"""
+  original_url = URLField('Original URL', validators=original_url_validators())
+
+# Validate original URL with the same rules as CreateURLForm, returns first error or None
+def original_url_error(original_url):
+  form = OriginalURLForm(data={'original_url': original_url})
+  if form.validate():
+    return None
+  return form.original_url.errors[0]
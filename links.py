@@ -0,0 +1,85 @@
+import time
+from cache import MISSING
+
+# Redirect status of a link: temporary redirects (302, 307) send every click back here to be counted,
+# permanent ones (301, 308) let browsers and CDNs cache the redirect for the link's cache_max_age
+# 307/308 keep the request method and body, 301/302 may turn them into a GET
+REDIRECT_STATUSES = (302, 307, 301, 308)
+PERMANENT_STATUSES = (301, 308)
+DEFAULT_REDIRECT_STATUS = 302
+# Longest cache lifetime a link can ask for, in seconds (one year)
+MAX_CACHE_MAX_AGE = 31536000
+
+# Longest lifetime a link can be given at creation, in seconds (ten years)
+MAX_EXPIRES_IN = 10 * 31536000
+
+# Redirect status and cache lifetime of a new link, cache_max_age None means the default of its status:
+# default_max_age for permanent redirects, 0 (not cached) for temporary ones
+def link_policy(redirect_status=None, cache_max_age=None, default_max_age=0):
+  redirect_status = redirect_status or DEFAULT_REDIRECT_STATUS
+  if cache_max_age is None:
+    cache_max_age = default_max_age if redirect_status in PERMANENT_STATUSES else 0
+  return redirect_status, cache_max_age
+
+# Validation error of a link policy given through the API, None if valid
+def link_policy_error(redirect_status, cache_max_age):
+  if redirect_status is not None and (type(redirect_status) is not int or redirect_status not in REDIRECT_STATUSES):
+    return 'Redirect status must be one of ' + ', '.join(map(str, REDIRECT_STATUSES)) + '!'
+  if cache_max_age is not None and (type(cache_max_age) is not int or not 0 <= cache_max_age <= MAX_CACHE_MAX_AGE):
+    return f'Cache max age must be between 0 and {MAX_CACHE_MAX_AGE} seconds!'
+  return None
+
+# Validation error of a link lifetime given through the API, None if valid
+def expires_in_error(expires_in):
+  if expires_in is not None and (type(expires_in) is not int or not 0 < expires_in <= MAX_EXPIRES_IN):
+    return f'Expiry must be between 1 and {MAX_EXPIRES_IN} seconds!'
+  return None
+
+# Expiry time (epoch seconds) of a link created now that lives for expires_in seconds, None if it never expires
+def link_expiry(expires_in, now=None):
+  if not expires_in:
+    return None
+  return int(now if now is not None else time.time()) + expires_in
+
+# Whether URL row's link has expired (it's answered with 410 until the purge job deletes it)
+def is_expired(url_row, now=None):
+  expires_at = url_row['expires_at'] if 'expires_at' in url_row.keys() else None
+  return expires_at is not None and expires_at <= (now if now is not None else time.time())
+
+# (redirect_status, cache_max_age) of a URL row
+def row_policy(url_row):
+  # Rows cached by workers running an older version have no policy columns
+  if 'redirect_status' not in url_row.keys():
+    return DEFAULT_REDIRECT_STATUS, 0
+  return url_row['redirect_status'], url_row['cache_max_age']
+
+# Status code and Cache-Control header value of a link's redirect
+# Links with no cache lifetime are never stored, so each click reaches the app (and is counted)
+def redirect_policy(url_row):
+  redirect_status, cache_max_age = row_policy(url_row)
+  # Never cached past the link's expiry
+  expires_at = url_row['expires_at'] if 'expires_at' in url_row.keys() else None
+  if expires_at is not None:
+    cache_max_age = min(cache_max_age, max(int(expires_at - time.time()), 0))
+  if cache_max_age > 0:
+    return redirect_status, f'public, max-age={cache_max_age}'
+  return redirect_status, 'no-store'
+
+# Query redirect data of short URL after a cache miss, caching the result (a 404 too)
+# Returns row (id, original_url, user_id, redirect_status, cache_max_age, expires_at) or None if short URL doesn't exist
+def load_link(cache, storage, shortened_url):
+  url_row = storage.get_link(shortened_url)
+  if url_row:
+    cache.set(shortened_url, url_row)
+  else:
+    cache.set_missing(shortened_url)
+  return url_row
+
+# Get redirect data of short URL through cache, storage is only queried on a cache miss
+def find_link(cache, storage, shortened_url):
+  url_row = cache.get(shortened_url)
+  if url_row is MISSING:
+    return None
+  if url_row is None:
+    url_row = load_link(cache, storage, shortened_url)
+  return url_row
@@ -0,0 +1,236 @@
+import ipaddress
+import re
+import threading
+import time
+from bisect import bisect_left
+from functools import lru_cache
+
+# Process metrics (counters, histograms, gauges read at scrape time) rendered in Prometheus text format
+# Each worker process keeps its own values, scrape every worker (e.g. one target per worker port)
+
+# Histogram buckets in seconds, from sub-millisecond cache hits to slow requests
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Prometheus label value escaping
+def escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+  pairs = [f'{name}="{escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def format_value(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+  kind = 'counter'
+
+  def __init__(self, name, help, labelnames=()):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def inc(self, *labels, amount=1):
+    with self._lock:
+      self._values[labels] = self._values.get(labels, 0) + amount
+
+  def samples(self):
+    with self._lock:
+      values = dict(self._values)
+    for labels, value in sorted(values.items()):
+      yield self.name, format_labels(self.labelnames, labels), value
+
+class Histogram:
+  kind = 'histogram'
+
+  def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+    # labels -> [count per bucket..., sum]
+    self._values = {}
+    self._lock = threading.Lock()
+
+  def observe(self, value, *labels):
+    with self._lock:
+      entry = self._values.get(labels)
+      if entry is None:
+        entry = self._values[labels] = [0] * len(self.buckets) + [0.0]
+      entry[bisect_left(self.buckets, value)] += 1
+      entry[-1] += value
+
+  def samples(self):
+    with self._lock:
+      values = {labels: list(entry) for labels, entry in self._values.items()}
+    for labels, entry in sorted(values.items()):
+      cumulative = 0
+      for bound, count in zip(self.buckets, entry):
+        cumulative += count
+        yield self.name + '_bucket', format_labels(self.labelnames, labels, [('le', format_value(bound))]), cumulative
+      yield self.name + '_sum', format_labels(self.labelnames, labels), entry[-1]
+      yield self.name + '_count', format_labels(self.labelnames, labels), cumulative
+
+# Metric whose values are read from function() at scrape time, as (labels tuple, value) pairs
+# Used for values other objects already keep (cache stats, pool sizes)
+class Collected:
+  def __init__(self, name, help, labelnames, function, kind='gauge'):
+    self.name = name
+    self.help = help
+    self.labelnames = tuple(labelnames)
+    self.function = function
+    self.kind = kind
+
+  def samples(self):
+    for labels, value in self.function():
+      yield self.name, format_labels(self.labelnames, labels), value
+
+class Registry:
+  def __init__(self):
+    self._metrics = []
+
+  def counter(self, name, help, labelnames=()):
+    return self._register(Counter(name, help, labelnames))
+
+  def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return self._register(Histogram(name, help, labelnames, buckets))
+
+  def collected(self, name, help, labelnames, function, kind='gauge'):
+    return self._register(Collected(name, help, labelnames, function, kind))
+
+  def _register(self, metric):
+    self._metrics.append(metric)
+    return metric
+
+  # All metrics in Prometheus text exposition format
+  def render(self):
+    lines = []
+    for metric in self._metrics:
+      try:
+        samples = list(metric.samples())
+      except Exception as e:
+        print(e) # Log error to server only, other metrics are still served
+        continue
+      lines.append(f'# HELP {metric.name} {metric.help}')
+      lines.append(f'# TYPE {metric.name} {metric.kind}')
+      for name, labels, value in samples:
+        lines.append(f'{name}{labels} {format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+# Networks of "<address or CIDR network>,..." config, e.g. "127.0.0.1,10.0.0.0/8", empty for none
+def parse_networks(value):
+  return [ipaddress.ip_network(part.strip(), strict=False) for part in (value or '').split(',') if part.strip()]
+
+# Whether address (None if unknown) is in one of networks
+def address_in(address, networks):
+  try:
+    address = ipaddress.ip_address(address or '')
+  except ValueError:
+    return False
+  return any(address in network for network in networks)
+
+# Cache stats (LRUCache, or SharedCache with its tier counters) of {name: cache}, read at scrape time
+def register_caches(registry, caches):
+  def stats():
+    return [(name, cache.stats()) for name, cache in caches.items()]
+  registry.collected('shortener_cache_lookups_total', 'Cache lookups by result.', ['cache', 'result'],
+                     lambda: [((name, result), s[result]) for name, s in stats()
+                              for result in ('hits', 'negative_hits', 'misses')], kind='counter')
+  registry.collected('shortener_cache_removals_total', 'Entries removed from cache by reason.', ['cache', 'reason'],
+                     lambda: [((name, reason), s[reason]) for name, s in stats()
+                              for reason in ('evictions', 'expirations', 'invalidations')], kind='counter')
+  registry.collected('shortener_cache_entries', 'Entries held in cache (in this worker).', ['cache'],
+                     lambda: [((name,), s['size']) for name, s in stats()])
+  registry.collected('shortener_cache_hit_ratio', 'Share of cache lookups answered from cache since start.', ['cache'],
+                     lambda: [((name,), s['hit_ratio']) for name, s in stats()])
+  registry.collected('shortener_shared_cache_lookups_total', 'Shared tier lookups after a local miss, by result.',
+                     ['cache', 'result'],
+                     lambda: [((name, result), s['shared_' + result]) for name, s in stats()
+                              if 'shared_hits' in s for result in ('hits', 'misses')], kind='counter')
+
+# Connection pool counters of a storage backend, read at scrape time
+def register_pool(registry, storage):
+  registry.collected('shortener_db_pool_connections_opened_total', 'Connections opened by the pool.', [],
+                     lambda: [((), storage.pool_stats()['opened'])], kind='counter')
+  registry.collected('shortener_db_pool_idle_connections', 'Connections idle in the pool.', [],
+                     lambda: [((), storage.pool_stats()['idle'])])
+
+# Short label of a query: its statement type and first table, e.g. "SELECT users"
+# Keeps label count bounded whatever the parameters, full SQL only goes to the slow query log
+@lru_cache(maxsize=1024)
+def query_label(sql):
+  words = sql.split(None, 1)
+  if not words:
+    return 'unknown'
+  statement = words[0].upper()
+  table = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?([A-Za-z_][A-Za-z0-9_]*)', sql, re.IGNORECASE)
+  return f'{statement} {table.group(1)}' if table and statement != 'PRAGMA' else statement
+
+# DB metrics of one storage backend, shared by its instrumented connections
+class QueryMetrics:
+  def __init__(self, registry, slow_query_seconds=0):
+    self.slow_query_seconds = slow_query_seconds
+    self.queries = registry.histogram('shortener_db_query_duration_seconds',
+                                      'Time spent executing queries, by statement type and table.', ['query'])
+    self.commits = registry.counter('shortener_db_commits_total', 'Transactions committed.')
+    self.errors = registry.counter('shortener_db_errors_total', 'Queries or connections that failed.')
+    self.connections = registry.counter('shortener_db_connections_acquired_total',
+                                        'Connections taken from the pool (once per request at most).')
+
+  def observe(self, sql, seconds):
+    self.queries.observe(seconds, query_label(sql))
+    if self.slow_query_seconds and seconds >= self.slow_query_seconds:
+      print(f'Slow query ({seconds * 1000:.1f}ms): {" ".join(sql.split())}') # Log to server only
+
+# Driver connection or cursor wrapper timing execute/executemany, anything else is passed through
+class Instrumented:
+  def __init__(self, target, metrics):
+    self._target = target
+    self._metrics = metrics
+
+  def __getattr__(self, name):
+    return getattr(self._target, name)
+
+  def __setattr__(self, name, value):
+    if name.startswith('_'):
+      object.__setattr__(self, name, value)
+    else:
+      setattr(self._target, name, value)
+
+  def execute(self, sql, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+      return self._target.execute(sql, *args, **kwargs)
+    finally:
+      self._metrics.observe(sql, time.perf_counter() - started)
+
+  def executemany(self, sql, *args, **kwargs):
+    started = time.perf_counter()
+    try:
+      return self._target.executemany(sql, *args, **kwargs)
+    finally:
+      self._metrics.observe(sql, time.perf_counter() - started)
+
+# Connection whose cursors are timed too and whose commits are counted
+class InstrumentedConnection(Instrumented):
+  def cursor(self, *args, **kwargs):
+    return InstrumentedCursor(self._target.cursor(*args, **kwargs), self._metrics)
+
+  def commit(self):
+    self._target.commit()
+    self._metrics.commits.inc()
+
+class InstrumentedCursor(Instrumented):
+  def __iter__(self):
+    return iter(self._target)
+
+  def __enter__(self):
+    self._target.__enter__()
+    return self
+
+  def __exit__(self, *exc):
+    return self._target.__exit__(*exc)
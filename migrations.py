@@ -0,0 +1,182 @@
+import time
+from datetime import datetime
+from search_index import create_index
+from user_stats import rebuild_user_stats
+
+# Ordered schema migrations as (version, name, function) tuples
+MIGRATIONS = []
+
+# Register a migration function in registry (SQLite MIGRATIONS by default), versions must be unique and increasing
+def migration(version, name, registry=MIGRATIONS):
+  def register(function):
+    if registry and registry[-1][0] >= version:
+      raise ValueError(f'Migration {version} registered out of order')
+    registry.append((version, name, function))
+    return function
+  return register
+
+# Tables created before migrations existed use IF NOT EXISTS, so older DBs upgrade cleanly
+
+@migration(1, 'create users and urls tables')
+def create_users_urls(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL,
+                    fname TEXT NOT NULL,
+                    lname TEXT NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    phone TEXT NULL,
+                    website TEXT,
+                    last_login DATETIME DEFAULT NULL,
+                    last_failed_login DATETIME DEFAULT NULL,
+                    failed_login_attempts INTEGER DEFAULT 0
+                  )""")
+  conn.execute("""CREATE TABLE IF NOT EXISTS urls (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    original_url TEXT NOT NULL,
+                    shortened_url TEXT UNIQUE NOT NULL,
+                    user_id INTEGER REFERENCES users(id),
+                    clicks INTEGER DEFAULT 0
+                  )""")
+
+@migration(2, 'create click events and rollup tables')
+def create_click_tables(conn):
+  # Append-only click events log
+  conn.execute("""CREATE TABLE IF NOT EXISTS click_events (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url_id INTEGER NOT NULL,
+                    clicked_at DATETIME NOT NULL,
+                    referrer TEXT,
+                    user_agent TEXT
+                  )""")
+  # Hourly and daily click rollups, read by the stats page instead of raw events
+  conn.execute("""CREATE TABLE IF NOT EXISTS click_stats_hourly (
+                    url_id INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    clicks INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (url_id, bucket)
+                  ) WITHOUT ROWID""")
+  conn.execute("""CREATE TABLE IF NOT EXISTS click_stats_daily (
+                    url_id INTEGER NOT NULL,
+                    bucket TEXT NOT NULL,
+                    clicks INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (url_id, bucket)
+                  ) WITHOUT ROWID""")
+
+@migration(3, 'create short code sequence')
+def create_code_sequence(conn):
+  # Workers reserve blocks of ids from it
+  conn.execute("""CREATE TABLE IF NOT EXISTS code_sequence (
+                    name TEXT PRIMARY KEY,
+                    next_value INTEGER NOT NULL DEFAULT 0
+                  )""")
+
+@migration(4, 'create full-text search index')
+def create_search_index(conn):
+  create_index(conn)
+
+@migration(5, 'add urls per user indexes')
+def add_user_indexes(conn):
+  # Covers COUNT/SUM(clicks) per user and listing a user's URLs by clicks
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_user_clicks ON urls (user_id, clicks)")
+  conn.execute("ANALYZE")
+
+@migration(6, 'add urls per user recency index')
+def add_user_recency_index(conn):
+  # Entries are ordered by (user_id, rowid), for listing a user's most recent URLs
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_user ON urls (user_id)")
+
+@migration(7, 'create materialized user stats')
+def create_user_stats(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id INTEGER PRIMARY KEY,
+                    url_count INTEGER NOT NULL DEFAULT 0,
+                    total_clicks INTEGER NOT NULL DEFAULT 0
+                  )""")
+  rebuild_user_stats(conn)
+
+@migration(8, 'create api keys')
+def create_api_keys(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS api_keys (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER NOT NULL REFERENCES users(id),
+                    key_hash TEXT UNIQUE NOT NULL,
+                    name TEXT,
+                    created_at DATETIME NOT NULL
+                  )""")
+
+@migration(9, 'create login attempt counters')
+def create_login_attempts(conn):
+  # Attempts per throttle key (account or client IP) in the current fixed window, and in the one before it
+  conn.execute("""CREATE TABLE IF NOT EXISTS login_attempts (
+                    throttle_key TEXT PRIMARY KEY,
+                    window_start INTEGER NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    previous INTEGER NOT NULL
+                  )""")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_login_attempts_window ON login_attempts (window_start)")
+
+@migration(10, 'add redirect policy of urls')
+def add_redirect_policy(conn):
+  conn.execute("ALTER TABLE urls ADD COLUMN redirect_status INTEGER NOT NULL DEFAULT 302")
+  conn.execute("ALTER TABLE urls ADD COLUMN cache_max_age INTEGER NOT NULL DEFAULT 0")
+
+@migration(11, 'add expiry and creation time of urls')
+def add_url_expiry(conn):
+  # Epoch seconds, NULL for links that never expire
+  conn.execute("ALTER TABLE urls ADD COLUMN expires_at INTEGER")
+  # Epoch seconds, 0 for links created before this column existed until migration 12 backfills them
+  conn.execute("ALTER TABLE urls ADD COLUMN created_at INTEGER NOT NULL DEFAULT 0")
+  # Partial indexes read by the purge job only, so they stay small
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_expires ON urls (expires_at) WHERE expires_at IS NOT NULL")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_unclicked ON urls (created_at) WHERE clicks = 0")
+
+@migration(12, 'backfill creation time of urls')
+def backfill_url_creation_time(conn):
+  # Links older than the created_at column count as created now, so the unclicked purge gives them the full
+  # PURGE_UNCLICKED_DAYS instead of deleting them all on its first run
+  conn.execute("UPDATE urls SET created_at = ? WHERE created_at = 0", (int(time.time()),))
+
+@migration(13, 'add click events index of urls')
+def add_click_events_index(conn):
+  # Recent click events of a URL, checked by the unclicked purge for each candidate
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_click_events_url ON click_events (url_id, clicked_at)")
+
+# Make sure version table exists
+def ensure_version_table(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at DATETIME NOT NULL
+                  )""")
+  conn.commit()
+
+# Highest applied migration version, 0 for a new DB
+def current_version(conn):
+  ensure_version_table(conn)
+  return conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+# Migrations not applied yet
+def pending_migrations(conn):
+  version = current_version(conn)
+  return [m for m in MIGRATIONS if m[0] > version]
+
+# Apply pending migrations up to target version (all by default), each in its own transaction
+# Returns list of applied (version, name)
+def upgrade(conn, target=None):
+  applied = []
+  for version, name, function in pending_migrations(conn):
+    if target is not None and version > target:
+      break
+    conn.execute("BEGIN")
+    try:
+      function(conn)
+      conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                   (version, name, datetime.utcnow()))
+      conn.commit()
+    except Exception:
+      conn.rollback()
+      raise
+    applied.append((version, name))
+  return applied
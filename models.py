@@ -1,5 +1,8 @@
 from flask_login import UserMixin
 
+# User fields carried in session snapshot (password hash never leaves the server)
+SNAPSHOT_FIELDS = ('id', 'username', 'fname', 'lname', 'email', 'phone', 'website')
+
 # User Model
 class User(UserMixin):
   def __init__(self, id, username, password, fname, lname, email, phone, website):
@@ -11,3 +14,17 @@ class User(UserMixin):
     self.email = email
     self.phone = phone
     self.website = website
+
+  # Create User from users table row
+  @classmethod
+  def from_row(cls, row):
+    return cls(row['id'], row['username'], row['password'], row['fname'], row['lname'], row['email'], row['phone'], row['website'])
+
+  # Create User from session snapshot, without password hash
+  @classmethod
+  def from_snapshot(cls, snapshot):
+    return cls(snapshot['id'], snapshot['username'], None, snapshot['fname'], snapshot['lname'], snapshot['email'], snapshot['phone'], snapshot['website'])
+
+  # Plain dict of public user fields, stored in the signed session cookie
+  def to_snapshot(self):
+    return {field: getattr(self, field) for field in SNAPSHOT_FIELDS}
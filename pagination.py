@@ -0,0 +1,58 @@
+# Sort orders for a user's URL listing: ORDER BY, keyset condition and key of a row
+# Backed by idx_urls_user (user_id, id) and idx_urls_user_clicks (user_id, clicks, id)
+URL_SORTS = {
+  'recent': ("ORDER BY id DESC", "id < ?", lambda row: (row['id'],)),
+  'clicks': ("ORDER BY clicks DESC, id DESC", "(clicks, id) < (?, ?)", lambda row: (row['clicks'], row['id'])),
+}
+DEFAULT_SORT = 'recent'
+
+# Encode keyset position as page token
+def encode_token(key):
+  return '_'.join(str(value) for value in key)
+
+# Decode page token into keyset position, None if token is invalid for sort
+def decode_token(token, sort):
+  try:
+    key = tuple(int(value) for value in token.split('_'))
+  except (AttributeError, ValueError):
+    return None
+  if len(key) != len(URL_SORTS[sort][2]({'id': 0, 'clicks': 0})):
+    return None
+  return key
+
+# One page of keyset paginated rows
+# Rows are fetched when the page is created, inside the storage connection that ran the query, so DB errors
+# are raised there as StorageError (not later while a template renders or streams it). A page holds at most limit rows
+# Query must select limit + 1 rows, the extra row only tells that a next page exists
+class Page:
+  def __init__(self, cursor, limit, key, transform=None):
+    rows = cursor.fetchall()
+    self._transform = transform
+    self.limit = limit
+    # Token of next page, None on the last page
+    self.next_page = encode_token(key(rows[limit - 1])) if len(rows) > limit else None
+    self._rows = rows[:limit]
+
+  def __bool__(self):
+    return bool(self._rows)
+
+  def __iter__(self):
+    for row in self._rows:
+      yield self._transform(row) if self._transform else row
+
+# Run a user's URL listing query for one page, placeholder is the DB driver's parameter marker
+def user_urls_page(cursor, user_id, sort, after, limit, transform=None, placeholder='?'):
+  if sort not in URL_SORTS:
+    sort = DEFAULT_SORT
+  order, condition, key = URL_SORTS[sort]
+  condition = condition.replace('?', placeholder)
+  query = f"SELECT * FROM urls WHERE user_id = {placeholder}"
+  params = [user_id]
+  position = decode_token(after, sort) if after else None
+  if position:
+    query += " AND " + condition
+    params.extend(position)
+  query += f" {order} LIMIT {placeholder}"
+  params.append(limit + 1)
+  cursor.execute(query, params)
+  return Page(cursor, limit, key, transform)
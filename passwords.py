@@ -0,0 +1,47 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Raised when all hashing workers are busy and the wait queue is full, answered with 429 so clients retry later
+class HasherBusy(Exception):
+  pass
+
+# Password hashing and checking on a bounded pool of threads (bcrypt releases the GIL while hashing)
+# At most workers hashes run at once and queue_size more wait, so a burst of logins can't take
+# every request thread and CPU core away from redirects, requests over the limit fail fast with HasherBusy
+class PasswordHasher:
+  def __init__(self, bcrypt, log_rounds=12, workers=2, queue_size=8):
+    self.bcrypt = bcrypt
+    self.log_rounds = log_rounds
+    self.capacity = workers + queue_size
+    self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+    self._lock = threading.Lock()
+    self.in_flight = 0
+    self.rejected = 0
+
+  # Run function(*args) on the pool and wait for its result, raising HasherBusy if the pool is full
+  def _run(self, function, *args):
+    with self._lock:
+      if self.in_flight >= self.capacity:
+        self.rejected += 1
+        raise HasherBusy()
+      self.in_flight += 1
+    try:
+      return self._executor.submit(function, *args).result()
+    finally:
+      with self._lock:
+        self.in_flight -= 1
+
+  def check(self, password_hash, password):
+    return self._run(self.bcrypt.check_password_hash, password_hash, password)
+
+  def generate(self, password):
+    return self._run(self.bcrypt.generate_password_hash, password, self.log_rounds).decode('utf-8')
+
+  # Whether hash was made with a different cost than the configured one (e.g. after BCRYPT_LOG_ROUNDS changed)
+  def needs_rehash(self, password_hash):
+    # bcrypt hashes look like $2b$12$<salt and hash>
+    parts = password_hash.split('$')
+    return len(parts) < 4 or not parts[2].isdigit() or int(parts[2]) != self.log_rounds
+
+  def close(self):
+    self._executor.shutdown(wait=False)
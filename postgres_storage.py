@@ -0,0 +1,507 @@
+import re
+import time
+from datetime import datetime, timedelta
+from migrations import migration
+from pagination import user_urls_page
+from search_index import url_location, page_token, parse_page_token
+from storage import Storage, StorageError, CodeCollision
+
+try:
+  import psycopg
+  from psycopg.rows import dict_row
+  from psycopg_pool import ConnectionPool
+except ImportError:
+  psycopg = None
+
+# Default pool settings, can be overridden through app config
+DEFAULT_CONFIG = {
+  # Connections kept open and upper bound of connections per worker process
+  'POSTGRES_POOL_MIN_SIZE': 1,
+  'POSTGRES_POOL_MAX_SIZE': 10,
+  # Seconds a request waits for a free connection before failing
+  'POSTGRES_POOL_TIMEOUT': 30,
+  # Executions before a query is prepared server-side, None when behind PgBouncer in transaction mode
+  'POSTGRES_PREPARE_THRESHOLD': 5,
+}
+
+# Ordered schema migrations of PostgreSQL DBs, same shape as migrations.MIGRATIONS
+PG_MIGRATIONS = []
+
+@migration(1, 'create users and urls tables', PG_MIGRATIONS)
+def create_users_urls(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS users (
+                    id BIGSERIAL PRIMARY KEY,
+                    username TEXT UNIQUE NOT NULL,
+                    password TEXT NOT NULL,
+                    fname TEXT NOT NULL,
+                    lname TEXT NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    phone TEXT NULL,
+                    website TEXT,
+                    last_login TIMESTAMP DEFAULT NULL,
+                    last_failed_login TIMESTAMP DEFAULT NULL,
+                    failed_login_attempts INTEGER DEFAULT 0
+                  )""")
+  conn.execute("""CREATE TABLE IF NOT EXISTS urls (
+                    id BIGSERIAL PRIMARY KEY,
+                    original_url TEXT NOT NULL,
+                    shortened_url TEXT UNIQUE NOT NULL,
+                    user_id BIGINT REFERENCES users(id),
+                    clicks BIGINT DEFAULT 0
+                  )""")
+  # Listing a user's URLs by recency and by clicks
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_user ON urls (user_id, id)")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_user_clicks ON urls (user_id, clicks, id)")
+
+@migration(2, 'create click events and rollup tables', PG_MIGRATIONS)
+def create_click_tables(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS click_events (
+                    id BIGSERIAL PRIMARY KEY,
+                    url_id BIGINT NOT NULL,
+                    clicked_at TIMESTAMP NOT NULL,
+                    referrer TEXT,
+                    user_agent TEXT
+                  )""")
+  for table in ('click_stats_hourly', 'click_stats_daily'):
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS {table} (
+                       url_id BIGINT NOT NULL,
+                       bucket TEXT NOT NULL,
+                       clicks BIGINT NOT NULL DEFAULT 0,
+                       PRIMARY KEY (url_id, bucket)
+                     )""")
+
+@migration(3, 'create short code sequence', PG_MIGRATIONS)
+def create_code_sequence(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS code_sequence (
+                    name TEXT PRIMARY KEY,
+                    next_value BIGINT NOT NULL DEFAULT 0
+                  )""")
+
+@migration(4, 'create full-text search index', PG_MIGRATIONS)
+def create_search_index(conn):
+  # Weighted document per URL: username (A), hostname and path words (B), full URL (D)
+  conn.execute("""CREATE TABLE IF NOT EXISTS url_search (
+                    url_id BIGINT PRIMARY KEY REFERENCES urls(id) ON DELETE CASCADE,
+                    document TSVECTOR NOT NULL
+                  )""")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_url_search_document ON url_search USING GIN (document)")
+
+@migration(5, 'create materialized user stats', PG_MIGRATIONS)
+def create_user_stats(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS user_stats (
+                    user_id BIGINT PRIMARY KEY,
+                    url_count BIGINT NOT NULL DEFAULT 0,
+                    total_clicks BIGINT NOT NULL DEFAULT 0
+                  )""")
+
+@migration(6, 'create api keys', PG_MIGRATIONS)
+def create_api_keys(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS api_keys (
+                    id BIGSERIAL PRIMARY KEY,
+                    user_id BIGINT NOT NULL REFERENCES users(id),
+                    key_hash TEXT UNIQUE NOT NULL,
+                    name TEXT,
+                    created_at TIMESTAMP NOT NULL
+                  )""")
+
+@migration(7, 'create login attempt counters', PG_MIGRATIONS)
+def create_login_attempts(conn):
+  conn.execute("""CREATE TABLE IF NOT EXISTS login_attempts (
+                    throttle_key TEXT PRIMARY KEY,
+                    window_start BIGINT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    previous INTEGER NOT NULL
+                  )""")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_login_attempts_window ON login_attempts (window_start)")
+
+@migration(8, 'add redirect policy of urls', PG_MIGRATIONS)
+def add_redirect_policy(conn):
+  conn.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS redirect_status SMALLINT NOT NULL DEFAULT 302")
+  conn.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS cache_max_age INTEGER NOT NULL DEFAULT 0")
+
+@migration(9, 'add expiry and creation time of urls', PG_MIGRATIONS)
+def add_url_expiry(conn):
+  conn.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS expires_at BIGINT")
+  conn.execute("ALTER TABLE urls ADD COLUMN IF NOT EXISTS created_at BIGINT NOT NULL DEFAULT 0")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_expires ON urls (expires_at) WHERE expires_at IS NOT NULL")
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_urls_unclicked ON urls (created_at) WHERE clicks = 0")
+
+@migration(10, 'backfill creation time of urls', PG_MIGRATIONS)
+def backfill_url_creation_time(conn):
+  # Links older than the created_at column count as created now, see migrations.backfill_url_creation_time
+  conn.execute("UPDATE urls SET created_at = %s WHERE created_at = 0", (int(time.time()),))
+
+@migration(11, 'add click events index of urls', PG_MIGRATIONS)
+def add_click_events_index(conn):
+  conn.execute("CREATE INDEX IF NOT EXISTS idx_click_events_url ON click_events (url_id, clicked_at)")
+
+# Never clicked links past their unclicked age, see storage.UNCLICKED_URLS
+UNCLICKED_URLS = """clicks = 0 AND created_at < %s AND (expires_at IS NULL OR expires_at > %s)
+                    AND redirect_status NOT IN (301, 308) AND cache_max_age = 0
+                    AND NOT EXISTS (SELECT 1 FROM click_events WHERE url_id = urls.id AND clicked_at >= %s)"""
+
+# Search document of a URL, parameters are username, location and original_url
+SEARCH_DOCUMENT = """setweight(to_tsvector('simple', %s), 'A')
+                     || setweight(to_tsvector('simple', %s), 'B')
+                     || setweight(to_tsvector('simple', %s), 'D')"""
+
+# Add to a user's counters, creating the row if needed
+INCREMENT_USER_STATS = """INSERT INTO user_stats (user_id, url_count, total_clicks) VALUES (%s, %s, %s)
+                          ON CONFLICT (user_id) DO UPDATE
+                          SET url_count = user_stats.url_count + EXCLUDED.url_count,
+                              total_clicks = user_stats.total_clicks + EXCLUDED.total_clicks"""
+
+# Turn user input into a tsquery: every word must match as a prefix
+def tsquery_expression(search_query):
+  words = re.findall(r'\w+', search_query)
+  if not words:
+    return None
+  return ' & '.join("'" + word + "':*" for word in words)
+
+# PostgreSQL storage, pooled connections from psycopg_pool
+# Pool is per worker process, put PgBouncer in front to share server connections between many workers
+class PostgresStorage(Storage):
+  def __init__(self, url, min_size=1, max_size=10, timeout=30, prepare_threshold=5):
+    if psycopg is None:
+      raise RuntimeError('PostgreSQL storage needs psycopg: pip install "psycopg[binary,pool]"')
+    self.errors = (psycopg.Error,)
+    self.pool = ConnectionPool(url, min_size=min_size, max_size=max_size, timeout=timeout, open=True,
+                               kwargs={'row_factory': dict_row, 'prepare_threshold': prepare_threshold})
+
+  def acquire(self):
+    return self.pool.getconn()
+
+  # Reads leave a transaction open, end it before handing the connection back (pool discards broken ones)
+  def release(self, conn):
+    if conn.info.transaction_status == psycopg.pq.TransactionStatus.INTRANS:
+      conn.rollback()
+    self.pool.putconn(conn)
+
+  def close(self):
+    self.pool.close()
+
+  # Connections opened by the pool and idle in it
+  def pool_stats(self):
+    stats = self.pool.get_stats()
+    return {'opened': stats.get('connections_num', 0), 'idle': stats.get('pool_available', 0)}
+
+  def translate(self, error):
+    if isinstance(error, psycopg.errors.UniqueViolation) and 'shortened_url' in (error.diag.constraint_name or ''):
+      return CodeCollision(str(error))
+    return StorageError(str(error))
+
+  # Schema
+
+  def _ensure_version_table(self, conn):
+    conn.execute("""CREATE TABLE IF NOT EXISTS schema_version (
+                      version INTEGER PRIMARY KEY,
+                      name TEXT NOT NULL,
+                      applied_at TIMESTAMP NOT NULL
+                    )""")
+    conn.commit()
+
+  def _pending_migrations(self, conn):
+    self._ensure_version_table(conn)
+    version = conn.execute("SELECT COALESCE(MAX(version), 0) AS version FROM schema_version").fetchone()['version']
+    conn.commit()
+    return version, [m for m in PG_MIGRATIONS if m[0] > version]
+
+  # Apply pending migrations up to target version, each in its own transaction
+  def migrate(self, target=None):
+    applied = []
+    with self.connection(shared=False) as conn:
+      for version, name, function in self._pending_migrations(conn)[1]:
+        if target is not None and version > target:
+          break
+        with conn.transaction():
+          function(conn)
+          conn.execute("INSERT INTO schema_version (version, name, applied_at) VALUES (%s, %s, %s)",
+                       (version, name, datetime.utcnow()))
+        applied.append((version, name))
+    return applied
+
+  def schema_status(self):
+    with self.connection(shared=False) as conn:
+      version, pending = self._pending_migrations(conn)
+      return version, [(version, name) for version, name, _ in pending]
+
+  # Users
+
+  def get_user(self, user_id):
+    with self.connection() as conn:
+      return conn.execute("SELECT * FROM users WHERE id = %s LIMIT 1", (user_id,)).fetchone()
+
+  def get_user_by_username(self, username):
+    with self.connection() as conn:
+      return conn.execute("SELECT * FROM users WHERE username = %s LIMIT 1", (username,)).fetchone()
+
+  def create_user(self, username, password, fname, lname, email, phone, website):
+    with self.connection() as conn:
+      query = """INSERT INTO users (username, password, fname, lname, email, phone, website)
+                 VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+      conn.execute(query, (username, password, fname, lname, email, phone, website))
+      conn.commit()
+
+  def update_user(self, username, fname, lname, email, phone, website):
+    with self.connection() as conn:
+      query = "UPDATE users SET fname=%s, lname=%s, email=%s, phone=%s, website=%s WHERE username=%s"
+      conn.execute(query, (fname, lname, email, phone, website, username))
+      conn.commit()
+
+  # Replace password hash, e.g. rehashed with a new cost
+  def update_password(self, user_id, password):
+    with self.connection() as conn:
+      conn.execute("UPDATE users SET password = %s WHERE id = %s", (password, user_id))
+      conn.commit()
+
+  def record_login(self, user_id, when):
+    with self.connection() as conn:
+      conn.execute("UPDATE users SET last_login = %s WHERE id = %s", (when, user_id))
+      conn.commit()
+
+  # Login throttling
+
+  # Count a login attempt against every key in one atomic statement, counters are kept per fixed window
+  # (window_start, in epoch seconds) along with the previous window's count, for sliding window estimates
+  # Returns {key: (attempts, previous)} including this attempt
+  def count_login_attempts(self, keys, window_start, window):
+    with self.connection() as conn:
+      values = ', '.join(['(%s, %s, 1, 0)'] * len(keys))
+      query = f"""INSERT INTO login_attempts (throttle_key, window_start, attempts, previous) VALUES {values}
+                  ON CONFLICT (throttle_key) DO UPDATE SET
+                    previous = CASE WHEN login_attempts.window_start = excluded.window_start THEN login_attempts.previous
+                                    WHEN login_attempts.window_start = excluded.window_start - %s THEN login_attempts.attempts
+                                    ELSE 0 END,
+                    attempts = CASE WHEN login_attempts.window_start = excluded.window_start
+                                    THEN login_attempts.attempts + 1 ELSE 1 END,
+                    window_start = excluded.window_start
+                  RETURNING throttle_key, attempts, previous"""
+      params = [value for key in keys for value in (key, window_start)] + [window]
+      rows = conn.execute(query, params).fetchall()
+      conn.commit()
+      return {row['throttle_key']: (row['attempts'], row['previous']) for row in rows}
+
+  def clear_login_attempts(self, key):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM login_attempts WHERE throttle_key = %s", (key,))
+      conn.commit()
+
+  # Drop counters not updated since before window_start
+  def purge_login_attempts(self, window_start):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM login_attempts WHERE window_start < %s", (window_start,))
+      conn.commit()
+
+  # API keys
+
+  def add_api_key(self, user_id, key_hash, name=None):
+    with self.connection() as conn:
+      query = "INSERT INTO api_keys (user_id, key_hash, name, created_at) VALUES (%s, %s, %s, %s)"
+      conn.execute(query, (user_id, key_hash, name, datetime.utcnow()))
+      conn.commit()
+
+  def delete_api_key(self, key_id):
+    with self.connection() as conn:
+      cursor = conn.execute("DELETE FROM api_keys WHERE id = %s", (key_id,))
+      conn.commit()
+      return cursor.rowcount > 0
+
+  def api_key_user(self, key_hash):
+    with self.connection() as conn:
+      query = """SELECT users.id, users.username
+                 FROM api_keys
+                 JOIN users ON api_keys.user_id = users.id
+                 WHERE api_keys.key_hash = %s LIMIT 1"""
+      return conn.execute(query, (key_hash,)).fetchone()
+
+  # URLs
+
+  def reserve_ids(self, name, size):
+    with self.connection(shared=False) as conn:
+      query = """INSERT INTO code_sequence (name, next_value) VALUES (%s, %s)
+                 ON CONFLICT (name) DO UPDATE SET next_value = code_sequence.next_value + EXCLUDED.next_value
+                 RETURNING next_value"""
+      end = conn.execute(query, (name, size)).fetchone()['next_value']
+      conn.commit()
+      return end
+
+  def query_link(self, shortened_url):
+    with self.connection() as conn:
+      query = """SELECT id, original_url, user_id, redirect_status, cache_max_age, expires_at
+                 FROM urls WHERE shortened_url = %s LIMIT 1"""
+      return conn.execute(query, (shortened_url,)).fetchone()
+
+  def link_batch(self, after_id, limit):
+    with self.connection() as conn:
+      query = """SELECT id, shortened_url, original_url, user_id, redirect_status, cache_max_age, expires_at
+                 FROM urls WHERE id > %s ORDER BY id LIMIT %s"""
+      return conn.execute(query, (after_id, limit)).fetchall()
+
+  def get_user_url(self, shortened_url, user_id):
+    with self.connection() as conn:
+      query = "SELECT * FROM urls WHERE shortened_url = %s AND user_id = %s LIMIT 1"
+      return conn.execute(query, (shortened_url, user_id)).fetchone()
+
+  def create_urls(self, user_id, username, urls, redirect_status=302, cache_max_age=0, expires_at=None):
+    created_at = int(time.time())
+    with self.connection() as conn:
+      with conn.cursor() as cursor:
+        query = """INSERT INTO urls (original_url, shortened_url, user_id, redirect_status, cache_max_age, expires_at,
+                                     created_at)
+                   VALUES (%s, %s, %s, %s, %s, %s, %s)"""
+        cursor.executemany(query, [(original_url, code, user_id, redirect_status, cache_max_age, expires_at, created_at)
+                                   for original_url, code in urls])
+        cursor.executemany(f"""INSERT INTO url_search (url_id, document)
+                               SELECT id, {SEARCH_DOCUMENT} FROM urls WHERE shortened_url = %s""",
+                           [(username, url_location(original_url), original_url, code) for original_url, code in urls])
+        cursor.execute(INCREMENT_USER_STATS, (user_id, len(urls), 0))
+      rows = self._created_links(conn, urls)
+      conn.commit()
+    self._index(rows)
+
+  def _created_links(self, conn, urls):
+    if self.code_index is None:
+      return []
+    query = """SELECT id, shortened_url, original_url, user_id, redirect_status, cache_max_age, expires_at
+               FROM urls WHERE shortened_url = ANY(%s)"""
+    return conn.execute(query, ([code for _, code in urls],)).fetchall()
+
+  # Search entry goes with the URL through ON DELETE CASCADE
+  def delete_url(self, url_row):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM urls WHERE id = %s", (url_row['id'],))
+      conn.execute(INCREMENT_USER_STATS, (url_row['user_id'], -1, -(url_row['clicks'] or 0)))
+      conn.execute("DELETE FROM click_stats_hourly WHERE url_id = %s", (url_row['id'],))
+      conn.execute("DELETE FROM click_stats_daily WHERE url_id = %s", (url_row['id'],))
+      conn.commit()
+    self._index(deleted=[url_row['shortened_url']])
+
+  # Rows being purged by another worker are skipped, search entries go through ON DELETE CASCADE
+  def purge_urls(self, now, unclicked_before=None, limit=500, keep=()):
+    with self.connection(shared=False) as conn:
+      query = """DELETE FROM urls WHERE id IN (
+                   SELECT id FROM urls WHERE expires_at <= %s LIMIT %s FOR UPDATE SKIP LOCKED)
+                 RETURNING id, shortened_url, user_id, clicks"""
+      rows = conn.execute(query, (now, limit)).fetchall()
+      if unclicked_before is not None and len(rows) < limit:
+        query = f"""DELETE FROM urls WHERE id IN (
+                      SELECT id FROM urls WHERE {UNCLICKED_URLS} AND NOT (id = ANY(%s))
+                      LIMIT %s FOR UPDATE SKIP LOCKED)
+                    RETURNING id, shortened_url, user_id, clicks"""
+        clicked_since = datetime.utcfromtimestamp(unclicked_before)
+        rows += conn.execute(query, (unclicked_before, now, clicked_since, list(keep), limit - len(rows))).fetchall()
+      ids = [row['id'] for row in rows]
+      conn.execute("DELETE FROM click_stats_hourly WHERE url_id = ANY(%s)", (ids,))
+      conn.execute("DELETE FROM click_stats_daily WHERE url_id = ANY(%s)", (ids,))
+      removed = {}
+      for row in rows:
+        urls, clicks = removed.get(row['user_id'], (0, 0))
+        removed[row['user_id']] = (urls + 1, clicks + (row['clicks'] or 0))
+      with conn.cursor() as cursor:
+        cursor.executemany(INCREMENT_USER_STATS, [(user_id, -urls, -clicks) for user_id, (urls, clicks) in removed.items()])
+      conn.commit()
+    codes = [row['shortened_url'] for row in rows]
+    self._index(deleted=codes)
+    return codes
+
+  # Refresh planner stats of urls, dead rows are reclaimed by autovacuum (VACUUM can't run in a transaction)
+  def compact(self, pages=1000):
+    with self.connection(shared=False) as conn:
+      conn.execute("ANALYZE urls")
+      conn.commit()
+
+  def vacuum(self):
+    with self.connection(shared=False) as conn:
+      conn.commit()
+      conn.autocommit = True
+      try:
+        conn.execute("VACUUM (ANALYZE) urls")
+      finally:
+        conn.autocommit = False
+
+  def user_urls_page(self, user_id, sort, after, limit, transform=None):
+    with self.connection() as conn:
+      return user_urls_page(conn.cursor(), user_id, sort, after, limit, transform, placeholder='%s')
+
+  # Best ranked URLs first, rank is negated ts_rank so pages use the same tokens as SQLite's bm25
+  def search_urls(self, search_query, limit=20, after=None):
+    expression = tsquery_expression(search_query)
+    if expression is None:
+      return [], None
+    position = parse_page_token(after) if after else None
+    query = """SELECT urls.id, urls.shortened_url, urls.original_url, urls.clicks, urls.user_id, users.username,
+                      found.rank
+               FROM (SELECT url_id, (-ts_rank(document, query))::float8 AS rank
+                     FROM url_search, to_tsquery('simple', %s) AS query
+                     WHERE document @@ query) AS found
+               JOIN urls ON urls.id = found.url_id
+               JOIN users ON urls.user_id = users.id"""
+    params = [expression]
+    if position:
+      query += " WHERE (found.rank, urls.id) > (%s, %s)"
+      params.extend(position)
+    query += " ORDER BY found.rank, urls.id LIMIT %s"
+    # Fetch one extra row to know if there is a next page
+    params.append(limit + 1)
+    with self.connection() as conn:
+      rows = conn.execute(query, params).fetchall()
+    if len(rows) > limit:
+      rows = rows[:limit]
+      return rows, page_token(rows[-1])
+    return rows, None
+
+  # Stats
+
+  def user_stats(self, user_id):
+    with self.connection() as conn:
+      row = conn.execute("SELECT url_count, total_clicks FROM user_stats WHERE user_id = %s", (user_id,)).fetchone()
+      return (row['url_count'], row['total_clicks']) if row else (0, 0)
+
+  def rebuild_user_stats(self):
+    with self.connection(shared=False) as conn:
+      # Block URL and click writes so none lands between delete and insert
+      conn.execute("LOCK TABLE urls IN SHARE MODE")
+      conn.execute("DELETE FROM user_stats")
+      conn.execute("""INSERT INTO user_stats (user_id, url_count, total_clicks)
+                      SELECT user_id, COUNT(*), COALESCE(SUM(clicks), 0)
+                      FROM urls
+                      WHERE user_id IS NOT NULL
+                      GROUP BY user_id""")
+      conn.commit()
+
+  # Clicks
+
+  # Counters and rollups are written with one statement each from arrays, events are streamed with COPY
+  def apply_clicks(self, clicks_by_url, events, hourly, daily):
+    clicks = [count for count, _ in clicks_by_url]
+    url_ids = [url_id for _, url_id in clicks_by_url]
+    with self.connection(shared=False) as conn:
+      conn.execute("""UPDATE urls SET clicks = urls.clicks + batch.clicks
+                      FROM unnest(%s::bigint[], %s::bigint[]) AS batch (url_id, clicks)
+                      WHERE urls.id = batch.url_id""", (url_ids, clicks))
+      # URLs deleted meanwhile are skipped, like their counter update
+      conn.execute("""UPDATE user_stats SET total_clicks = user_stats.total_clicks + added.clicks
+                      FROM (SELECT urls.user_id, SUM(batch.clicks) AS clicks
+                            FROM unnest(%s::bigint[], %s::bigint[]) AS batch (url_id, clicks)
+                            JOIN urls ON urls.id = batch.url_id
+                            GROUP BY urls.user_id) AS added
+                      WHERE user_stats.user_id = added.user_id""", (url_ids, clicks))
+      with conn.cursor() as cursor:
+        with cursor.copy("COPY click_events (url_id, clicked_at, referrer, user_agent) FROM STDIN") as copy:
+          for event in events:
+            copy.write_row(event)
+      for table, rows in (('click_stats_hourly', hourly), ('click_stats_daily', daily)):
+        conn.execute(f"""INSERT INTO {table} (url_id, bucket, clicks)
+                         SELECT * FROM unnest(%s::bigint[], %s::text[], %s::bigint[])
+                         ON CONFLICT (url_id, bucket) DO UPDATE SET clicks = {table}.clicks + EXCLUDED.clicks""",
+                     ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]))
+      conn.commit()
+
+  def url_click_stats(self, url_id, hours=48, days=30):
+    now = datetime.utcnow()
+    with self.connection() as conn:
+      query_hourly = "SELECT bucket, clicks FROM click_stats_hourly WHERE url_id = %s AND bucket >= %s ORDER BY bucket DESC"
+      hourly = conn.execute(query_hourly, (url_id, (now - timedelta(hours=hours)).strftime('%Y-%m-%d %H:00'))).fetchall()
+      query_daily = "SELECT bucket, clicks FROM click_stats_daily WHERE url_id = %s AND bucket >= %s ORDER BY bucket DESC"
+      daily = conn.execute(query_daily, (url_id, (now - timedelta(days=days)).strftime('%Y-%m-%d'))).fetchall()
+      return hourly, daily
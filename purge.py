@@ -0,0 +1,77 @@
+import atexit
+import threading
+import time
+from storage import StorageError
+
+# Background job deleting expired links (and, if enabled, links never clicked after unclicked_age seconds)
+# Run it in one process only: clicks still buffered in other workers (without a shared tier) aren't seen,
+# and link_cache.invalidate only drops this worker's entries, see PURGE_UNCLICKED_DAYS in app.py
+# Works in small transactions with a pause between them, so redirects are never blocked for long,
+# then compacts the DB (incremental vacuum / ANALYZE) if anything was deleted
+class LinkPurger:
+  def __init__(self, storage, link_cache, click_buffer, interval=3600, batch_size=500, unclicked_age=0,
+               pause=0.05):
+    self.storage = storage
+    self.link_cache = link_cache
+    self.click_buffer = click_buffer
+    self.interval = interval
+    self.batch_size = batch_size
+    self.unclicked_age = unclicked_age
+    self.pause = pause
+    self._wake = threading.Event()
+    self._lock = threading.Lock()
+    self._stopping = False
+    self._thread = None
+    self.purged = 0
+
+  # Delete everything currently purgeable, batch by batch, returns number of deleted links
+  def run_once(self):
+    now = int(time.time())
+    unclicked_before = now - self.unclicked_age if self.unclicked_age else None
+    keep = ()
+    if unclicked_before is not None:
+      # Write out pending clicks (every worker's, with a shared tier) so links clicked just now don't look
+      # unclicked, and keep links whose clicks are still pending. Without the tier only expired links go
+      if self.click_buffer.drain():
+        keep = list(self.click_buffer.snapshot())
+      else:
+        unclicked_before = None
+    deleted = 0
+    while not self._stopping:
+      codes = self.storage.purge_urls(now, unclicked_before, self.batch_size, keep)
+      for code in codes:
+        self.link_cache.invalidate(code)
+      deleted += len(codes)
+      if len(codes) < self.batch_size:
+        break
+      # Let queued writers (click flushes, new links) in between batches
+      time.sleep(self.pause)
+    if deleted:
+      self.storage.compact()
+    self.purged += deleted
+    return deleted
+
+  # Start background purging, called on first request of the purge worker, first run after one interval
+  def start(self):
+    with self._lock:
+      if self._thread is not None:
+        return
+      self._thread = threading.Thread(target=self._run, name='link-purger', daemon=True)
+      self._thread.start()
+    atexit.register(self.stop)
+
+  def _run(self):
+    while not self._stopping:
+      self._wake.wait(self.interval)
+      if self._stopping:
+        break
+      try:
+        self.run_once()
+      except StorageError as e:
+        print(e) # Log error to server only, retried next interval
+
+  def stop(self):
+    self._stopping = True
+    self._wake.set()
+    if self._thread is not None:
+      self._thread.join(timeout=5)
@@ -0,0 +1,90 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from shared_tier import TierDown
+from throttle import estimate, retry_after
+
+# Request rate limits per client and route group ("budget"), as token buckets: a client may send up to
+# capacity requests at once, then one more every period / capacity seconds
+# Clients are keyed by IP, user or API key (see app.rate_limit), refused requests get a 429 with Retry-After
+
+# Budget "<requests>/<seconds>" from config as (capacity, period), None for an empty value (no limit)
+def parse_budget(value):
+  if not value:
+    return None
+  requests, _, seconds = value.partition('/')
+  capacity, period = int(requests), float(seconds or 1)
+  if capacity <= 0 or period <= 0:
+    raise ValueError(f'Invalid rate limit {value!r}, expected "<requests>/<seconds>"')
+  return capacity, period
+
+# Token buckets kept in this worker, the least recently used are dropped past maxsize
+# (a dropped bucket comes back full, only clients idle for a while are ever dropped under normal load)
+class RateLimiter:
+  def __init__(self, budgets, maxsize=100000):
+    # Budget name -> (capacity, period)
+    self.budgets = budgets
+    self.maxsize = maxsize
+    # (budget, client) -> (tokens, updated at)
+    self._buckets = OrderedDict()
+    self._lock = threading.Lock()
+    self.limited = 0
+
+  # Take a token from client's bucket of budget
+  # Returns None if the request may go ahead, or seconds until the client may try again
+  def take(self, budget, client):
+    capacity, period = self.budgets[budget]
+    rate = capacity / period
+    now = time.monotonic()
+    with self._lock:
+      tokens, updated_at = self._buckets.pop((budget, client), (capacity, now))
+      tokens = min(capacity, tokens + (now - updated_at) * rate)
+      wait = None
+      if tokens >= 1:
+        tokens -= 1
+      else:
+        wait = math.ceil((1 - tokens) / rate)
+        self.limited += 1
+      self._buckets[(budget, client)] = (tokens, now)
+      if len(self._buckets) > self.maxsize:
+        self._buckets.popitem(last=False)
+    return wait
+
+# Limits counted in the shared tier, so a client's budget holds across all workers
+# Buckets are approximated with sliding windows of capacity requests per period (see throttle.estimate),
+# one counter per client and window, incremented and read with its predecessor in one MULTI/EXEC
+# Falls back to this worker's own buckets (local) while the tier is down
+class SharedRateLimiter:
+  def __init__(self, tier, budgets, maxsize=100000):
+    self.tier = tier
+    self.budgets = budgets
+    self.local = RateLimiter(budgets, maxsize)
+    self._limited = 0
+
+  # Requests refused, by the tier's counters or by the local buckets
+  @property
+  def limited(self):
+    return self._limited + self.local.limited
+
+  def take(self, budget, client):
+    capacity, period = self.budgets[budget]
+    window = max(1, int(period))
+    now = time.time()
+    window_start = int(now) - int(now) % window
+    key = self.tier.key('rate', budget, client, window_start)
+    def count(redis):
+      pipe = redis.pipeline()
+      pipe.incr(key)
+      pipe.expire(key, 2 * window)
+      pipe.get(self.tier.key('rate', budget, client, window_start - window))
+      return pipe.execute()
+    try:
+      requests, _, previous = self.tier.run(count)
+    except TierDown:
+      return self.local.take(budget, client)
+    requests, previous = int(requests), int(previous or 0)
+    if estimate(requests - 1, previous, now - window_start, window) < capacity:
+      return None
+    self._limited += 1
+    return max(1, math.ceil(retry_after(requests, previous, window, capacity + 1) - (now - window_start)))
@@ -0,0 +1,108 @@
+import re
+from urllib.parse import urlsplit
+
+# FTS5 index over URLs, rowid is urls.id
+# Columns: full original URL, its hostname and path split into words, owner's username
+CREATE_INDEX = """CREATE VIRTUAL TABLE IF NOT EXISTS urls_fts USING fts5(
+                    original_url,
+                    location,
+                    username,
+                    tokenize = 'unicode61'
+                  )"""
+
+# Ranking weights per column: matches in hostname/path and username count more than in query strings
+RANK = 'bm25(1.0, 2.0, 4.0)'
+
+# Rows indexed per batch when rebuilding
+REBUILD_CHUNK = 1000
+
+# Hostname and path of URL as plain words
+def url_location(original_url):
+  parts = urlsplit(original_url)
+  host = parts.hostname or ''
+  if host.startswith('www.'):
+    host = host[4:]
+  return ' '.join(filter(None, re.split(r'[^\w]+', host + ' ' + parts.path)))
+
+# Create index and rank configuration, filling it from urls if it's new
+def create_index(conn):
+  exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'urls_fts'").fetchone()
+  conn.execute(CREATE_INDEX)
+  conn.execute("INSERT INTO urls_fts (urls_fts, rank) VALUES ('rank', ?)", (RANK,))
+  if not exists:
+    rebuild_index(conn)
+
+# Rebuild whole index from urls table
+def rebuild_index(conn):
+  conn.execute("DELETE FROM urls_fts")
+  cursor = conn.execute("""SELECT urls.id, urls.original_url, users.username
+                           FROM urls
+                           JOIN users ON urls.user_id = users.id""")
+  while True:
+    rows = cursor.fetchmany(REBUILD_CHUNK)
+    if not rows:
+      break
+    conn.executemany("INSERT INTO urls_fts (rowid, original_url, location, username) VALUES (?, ?, ?, ?)",
+                     [(row[0], row[1], url_location(row[1]), row[2]) for row in rows])
+
+# Add URL to index, called in the same transaction as the urls INSERT
+def index_url(cursor, url_id, original_url, username):
+  query = "INSERT INTO urls_fts (rowid, original_url, location, username) VALUES (?, ?, ?, ?)"
+  cursor.execute(query, (url_id, original_url, url_location(original_url), username))
+
+# Remove URL from index, called in the same transaction as the urls DELETE
+def unindex_url(cursor, url_id):
+  cursor.execute("DELETE FROM urls_fts WHERE rowid = ?", (url_id,))
+
+# Turn user input into an FTS5 query: every word must match as a prefix
+def match_expression(search_query):
+  words = re.findall(r'\w+', search_query)
+  if not words:
+    return None
+  return ' '.join('"' + word + '"*' for word in words)
+
+# Encode position of the last result of a page
+def page_token(row):
+  return repr(row['rank']) + '_' + str(row['id'])
+
+# Decode page token, None if invalid
+def parse_page_token(token):
+  try:
+    rank, url_id = token.rsplit('_', 1)
+    return float(rank), int(url_id)
+  except (AttributeError, ValueError):
+    return None
+
+# Best ranked URLs matching search query, one page after given token
+# Returns rows and token of the next page (None on last page)
+def search_urls(cursor, search_query, limit=20, after=None):
+  expression = match_expression(search_query)
+  if expression is None:
+    return [], None
+  position = parse_page_token(after) if after else None
+  query = """SELECT urls.id, urls.shortened_url, urls.original_url, urls.clicks, urls.user_id, users.username,
+                    urls_fts.rank AS rank
+             FROM urls_fts
+             JOIN urls ON urls.id = urls_fts.rowid
+             JOIN users ON urls.user_id = users.id
+             WHERE urls_fts MATCH ?"""
+  params = [expression]
+  if position:
+    query += " AND (urls_fts.rank > ? OR (urls_fts.rank = ? AND urls.id > ?))"
+    params.extend((position[0], position[0], position[1]))
+  query += " ORDER BY urls_fts.rank, urls.id LIMIT ?"
+  # Fetch one extra row to know if there is a next page
+  params.append(limit + 1)
+  cursor.execute(query, params)
+  rows = cursor.fetchall()
+  if len(rows) > limit:
+    rows = rows[:limit]
+    return rows, page_token(rows[-1])
+  return rows, None
+
+# Add many new URLs to index by short code, as (original_url, username, shortened_url) tuples
+def index_urls_by_code(conn, urls):
+  query = """INSERT INTO urls_fts (rowid, original_url, location, username)
+             SELECT id, original_url, ?, ? FROM urls WHERE shortened_url = ?"""
+  conn.executemany(query, [(url_location(original_url), username, shortened_url)
+                           for original_url, username, shortened_url in urls])
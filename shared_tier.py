@@ -0,0 +1,333 @@
+import fnmatch
+import threading
+import time
+from cache import LRUCache, MISSING
+
+# Optional tier shared by all workers, spoken to with the Redis protocol (REDIS_URL)
+# memory:// gives an in-process stand-in with the same commands, for tests and single process runs
+# Every call goes through SharedTier.run, which stops calling a failing server for a while so
+# callers fall back to their local/DB path instead of waiting on timeouts
+
+try:
+  import redis
+except ImportError:
+  redis = None
+
+# Clock of MemoryRedis expiries (its expire() takes a "time" argument like redis-py's, shadowing the module)
+_monotonic = time.monotonic
+
+# Raised by SharedTier.run when the server can't be reached, callers fall back to the DB
+class TierDown(Exception):
+  pass
+
+# In-memory stand-in for a Redis server, covers the commands used by this app
+# Values are kept as strings, like a client with decode_responses=True
+class MemoryRedis:
+  def __init__(self):
+    self._data = {}
+    self._expires = {}
+    self._lock = threading.RLock()
+    # Set to True to simulate an unreachable server
+    self.down = False
+
+  def _check(self):
+    if self.down:
+      raise ConnectionError('Shared tier is down')
+
+  def _get(self, name, default=None):
+    expires_at = self._expires.get(name)
+    if expires_at is not None and expires_at <= _monotonic():
+      self._data.pop(name, None)
+      self._expires.pop(name, None)
+    return self._data.get(name, default)
+
+  def _set(self, name, value, ex=None):
+    self._data[name] = value
+    if ex:
+      self._expires[name] = _monotonic() + ex
+    else:
+      self._expires.pop(name, None)
+
+  def ping(self):
+    self._check()
+    return True
+
+  def get(self, name):
+    with self._lock:
+      self._check()
+      return self._get(name)
+
+  def set(self, name, value, ex=None):
+    with self._lock:
+      self._check()
+      self._set(name, str(value), ex)
+      return True
+
+  def mget(self, names):
+    with self._lock:
+      self._check()
+      return [self._get(name) for name in names]
+
+  def delete(self, *names):
+    with self._lock:
+      self._check()
+      count = 0
+      for name in names:
+        if self._get(name) is not None:
+          count += 1
+        self._data.pop(name, None)
+        self._expires.pop(name, None)
+      return count
+
+  def incr(self, name, amount=1):
+    with self._lock:
+      self._check()
+      value = int(self._get(name, 0)) + amount
+      self._data[name] = str(value)
+      return value
+
+  incrby = incr
+
+  def expire(self, name, time):
+    with self._lock:
+      self._check()
+      if self._get(name) is None:
+        return False
+      self._expires[name] = _monotonic() + time
+      return True
+
+  def ttl(self, name):
+    with self._lock:
+      self._check()
+      if self._get(name) is None:
+        return -2
+      expires_at = self._expires.get(name)
+      return int(expires_at - _monotonic() + 0.999) if expires_at else -1
+
+  def sadd(self, name, *values):
+    with self._lock:
+      self._check()
+      members = self._data.setdefault(name, set())
+      added = len(set(map(str, values)) - members)
+      members.update(map(str, values))
+      return added
+
+  def smembers(self, name):
+    with self._lock:
+      self._check()
+      return set(self._get(name, set()))
+
+  def spop(self, name, count=None):
+    with self._lock:
+      self._check()
+      members = self._get(name, set())
+      popped = [members.pop() for _ in range(min(count if count is not None else 1, len(members)))]
+      if not members:
+        self._data.pop(name, None)
+      if count is None:
+        return popped[0] if popped else None
+      return popped
+
+  def hset(self, name, key, value):
+    with self._lock:
+      self._check()
+      self._data.setdefault(name, {})[str(key)] = str(value)
+      return 1
+
+  def hget(self, name, key):
+    with self._lock:
+      self._check()
+      return self._get(name, {}).get(str(key))
+
+  def hdel(self, name, *keys):
+    with self._lock:
+      self._check()
+      fields = self._get(name, {})
+      return sum(fields.pop(str(key), None) is not None for key in keys)
+
+  def hincrby(self, name, key, amount=1):
+    with self._lock:
+      self._check()
+      fields = self._data.setdefault(name, {})
+      value = int(fields.get(str(key), 0)) + amount
+      fields[str(key)] = str(value)
+      return value
+
+  def rpush(self, name, *values):
+    with self._lock:
+      self._check()
+      items = self._data.setdefault(name, [])
+      items.extend(map(str, values))
+      return len(items)
+
+  def lpush(self, name, *values):
+    with self._lock:
+      self._check()
+      items = self._data.setdefault(name, [])
+      for value in values:
+        items.insert(0, str(value))
+      return len(items)
+
+  def lrange(self, name, start, end):
+    with self._lock:
+      self._check()
+      items = self._get(name, [])
+      return items[start:] if end == -1 else items[start:end + 1]
+
+  def ltrim(self, name, start, end):
+    with self._lock:
+      self._check()
+      items = self._get(name, [])
+      self._data[name] = items[start:] if end == -1 else items[start:end + 1]
+      return True
+
+  def keys(self, pattern='*'):
+    with self._lock:
+      self._check()
+      return [name for name in list(self._data) if self._get(name) is not None and fnmatch.fnmatchcase(name, pattern)]
+
+  def flushall(self):
+    with self._lock:
+      self._check()
+      self._data.clear()
+      self._expires.clear()
+      return True
+
+  # Commands queued and run together under the lock, like a MULTI/EXEC transaction
+  def pipeline(self, transaction=True):
+    return MemoryPipeline(self)
+
+class MemoryPipeline:
+  def __init__(self, server):
+    self._server = server
+    self._commands = []
+
+  def __getattr__(self, name):
+    command = getattr(self._server, name)
+    def queue(*args, **kwargs):
+      self._commands.append((command, args, kwargs))
+      return self
+    return queue
+
+  def execute(self):
+    with self._server._lock:
+      self._server._check()
+      results = [command(*args, **kwargs) for command, args, kwargs in self._commands]
+    self._commands = []
+    return results
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self._commands = []
+
+# Create shared tier client from URL: memory:// for the in-process stand-in, redis:// or rediss:// otherwise
+def connect(url, timeout=0.25):
+  if url.startswith('memory://'):
+    return MemoryRedis()
+  if redis is None:
+    raise RuntimeError('Shared tier needs the redis client: pip install redis')
+  return redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout, decode_responses=True)
+
+# Shared tier client guarded by a circuit breaker
+# After a failure the tier is skipped for retry_interval seconds, so a dead server costs one timeout, not one per call
+class SharedTier:
+  def __init__(self, client, prefix='shortener:', retry_interval=5.0):
+    self.client = client
+    self.prefix = prefix
+    self.retry_interval = retry_interval
+    self.errors = (OSError,) + ((redis.RedisError,) if redis else ())
+    self._down_until = 0.0
+    self.failures = 0
+
+  # Prefixed key name
+  def key(self, *parts):
+    return self.prefix + ':'.join(str(part) for part in parts)
+
+  @property
+  def available(self):
+    return time.monotonic() >= self._down_until
+
+  # Run function(client), raising TierDown if the tier is (or was recently) unreachable
+  def run(self, function):
+    if not self.available:
+      raise TierDown()
+    try:
+      return function(self.client)
+    except self.errors as e:
+      self.failures += 1
+      if self.available:
+        print(f'Shared tier unavailable, using DB for {self.retry_interval}s: {e}') # Log error to server only
+      self._down_until = time.monotonic() + self.retry_interval
+      raise TierDown() from e
+
+# Two-level cache: a small per-worker LRU in front of the shared tier
+# Same interface as LRUCache, values are stored in the tier as strings made by dumps/loads
+# Invalidations reach other workers once their local entry expires (local_ttl)
+class SharedCache:
+  # Stored in the tier for keys known not to exist
+  NEGATIVE = '-'
+
+  def __init__(self, tier, namespace, dumps, loads, maxsize=10000, ttl=300, negative_ttl=30, local_ttl=5):
+    self.tier = tier
+    self.namespace = namespace
+    self.dumps = dumps
+    self.loads = loads
+    self.ttl = ttl
+    self.negative_ttl = negative_ttl
+    self.local = LRUCache(maxsize=maxsize, ttl=min(ttl, local_ttl), negative_ttl=min(negative_ttl, local_ttl))
+    self.shared_hits = 0
+    self.shared_misses = 0
+
+  def _key(self, key):
+    return self.tier.key(self.namespace, key)
+
+  # Get cached value, MISSING for a cached negative entry, or default if not cached (or tier is down)
+  def get(self, key, default=None):
+    value = self.local.get(key)
+    if value is not None:
+      return value
+    try:
+      raw = self.tier.run(lambda client: client.get(self._key(key)))
+    except TierDown:
+      return default
+    if raw is None:
+      self.shared_misses += 1
+      return default
+    self.shared_hits += 1
+    value = MISSING if raw == self.NEGATIVE else self.loads(raw)
+    self.local.set(key, value)
+    return value
+
+  def set(self, key, value, ttl=None):
+    if ttl is None:
+      ttl = self.negative_ttl if value is MISSING else self.ttl
+    self.local.set(key, value)
+    raw = self.NEGATIVE if value is MISSING else self.dumps(value)
+    try:
+      self.tier.run(lambda client: client.set(self._key(key), raw, ex=ttl))
+    except TierDown:
+      pass
+
+  def set_missing(self, key):
+    self.set(key, MISSING)
+
+  def invalidate(self, key):
+    self.local.invalidate(key)
+    try:
+      self.tier.run(lambda client: client.delete(self._key(key)))
+    except TierDown:
+      pass
+
+  # Clear local entries only, shared entries expire by TTL
+  def clear(self):
+    self.local.clear()
+
+  def __len__(self):
+    return len(self.local)
+
+  def stats(self):
+    stats = self.local.stats()
+    stats.update(shared_hits=self.shared_hits, shared_misses=self.shared_misses, tier_failures=self.tier.failures)
+    return stats
@@ -0,0 +1,123 @@
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import quote
+from storage import StorageError
+
+# Read-only copy of the redirect data of all links, so redirect replicas can serve links without the primary's DB
+# It's a SQLite file with one WITHOUT ROWID table keyed by short code, so a lookup is a single B-tree search.
+# The primary writes it into a temporary file and moves that over the old one (flask urls snapshot <path>),
+# then the file is copied to replicas (shared volume, rsync...). Replicas switch to each new file as it appears.
+
+# Links read from storage per query while writing a snapshot
+SNAPSHOT_BATCH_SIZE = 10000
+
+# Write redirect data of all links of storage to a snapshot file at path, replacing it atomically
+# Expired links are kept, so replicas answer them with 410 like the primary until they're purged
+# Returns number of links written
+def write_snapshot(storage, path, batch_size=SNAPSHOT_BATCH_SIZE):
+  temporary = path + '.tmp'
+  if os.path.exists(temporary):
+    os.remove(temporary)
+  conn = sqlite3.connect(temporary)
+  try:
+    # Nothing reads the file before it's complete, no need for a journal or syncs along the way
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    conn.execute("""CREATE TABLE links (
+                      shortened_url TEXT PRIMARY KEY,
+                      id INTEGER NOT NULL,
+                      original_url TEXT NOT NULL,
+                      user_id INTEGER,
+                      redirect_status INTEGER NOT NULL,
+                      cache_max_age INTEGER NOT NULL,
+                      expires_at INTEGER
+                    ) WITHOUT ROWID""")
+    conn.execute("CREATE TABLE snapshot (created_at INTEGER NOT NULL, links INTEGER NOT NULL)")
+    created_at = int(time.time())
+    count = 0
+    after_id = 0
+    while True:
+      rows = storage.link_batch(after_id, batch_size)
+      if not rows:
+        break
+      conn.executemany("INSERT INTO links VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       [(row['shortened_url'], row['id'], row['original_url'], row['user_id'], row['redirect_status'],
+                         row['cache_max_age'], row['expires_at']) for row in rows])
+      count += len(rows)
+      after_id = rows[-1]['id']
+    conn.execute("INSERT INTO snapshot (created_at, links) VALUES (?, ?)", (created_at, count))
+    conn.commit()
+    # Codes arrive in id order, not key order, repack the half empty pages that leaves
+    conn.execute("VACUUM")
+  except BaseException:
+    conn.close()
+    os.remove(temporary)
+    raise
+  conn.close()
+  os.replace(temporary, path)
+  return count
+
+# Link lookups (get_link, like a storage backend) answered from a snapshot file
+# Checks for a new file at most every check_interval seconds and switches to it, the file is opened
+# immutable, so reads need no locks on it, a new snapshot is a new file and never changes this one.
+# Keeps serving the loaded snapshot if the file goes missing or can't be read
+class LinkSnapshot:
+  def __init__(self, path, check_interval=5):
+    self.path = path
+    self.check_interval = check_interval
+    self.created_at = None
+    self.links = 0
+    self.loads = 0
+    self._conn = None
+    self._file = None
+    self._checked_at = 0
+    self._lock = threading.Lock()
+
+  # Connection to the newest snapshot, called with lock held
+  def _current(self):
+    now = time.monotonic()
+    if self._conn is not None and now - self._checked_at < self.check_interval:
+      return self._conn
+    self._checked_at = now
+    try:
+      stat = os.stat(self.path)
+      file = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+      if file != self._file:
+        self._load(file)
+    except (OSError, sqlite3.Error) as e:
+      if self._conn is None:
+        raise StorageError(f'Link snapshot {self.path} unavailable: {e}') from e
+      print(e) # Log error to server only, the loaded snapshot is still served
+    return self._conn
+
+  def _load(self, file):
+    conn = sqlite3.connect('file:' + quote(os.path.abspath(self.path)) + '?mode=ro&immutable=1', uri=True,
+                           check_same_thread=False)
+    try:
+      conn.row_factory = sqlite3.Row
+      created_at, links = conn.execute("SELECT created_at, links FROM snapshot").fetchone()
+    except sqlite3.Error:
+      conn.close()
+      raise
+    if self._conn is not None:
+      self._conn.close()
+    self._conn, self._file = conn, file
+    self.created_at, self.links = created_at, links
+    self.loads += 1
+
+  # Redirect data (id, original_url, user_id, redirect_status, cache_max_age, expires_at) of short URL, None if not found
+  def get_link(self, shortened_url):
+    with self._lock:
+      try:
+        return self._current().execute("""SELECT id, original_url, user_id, redirect_status, cache_max_age, expires_at
+                                          FROM links WHERE shortened_url = ?""", (shortened_url,)).fetchone()
+      except sqlite3.Error as e:
+        raise StorageError(str(e)) from e
+
+  def close(self):
+    with self._lock:
+      if self._conn is not None:
+        self._conn.close()
+        self._conn = None
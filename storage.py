@@ -0,0 +1,414 @@
+import atexit
+import json
+import sqlite3
+import struct
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from flask import g, has_app_context
+import db
+import migrations
+from cache import MISSING
+from metrics import InstrumentedConnection
+from pagination import user_urls_page
+from search_index import unindex_url, search_urls, index_urls_by_code
+from user_stats import increment_user_stats, add_clicks_by_url, get_user_stats, rebuild_user_stats
+
+# Storage backends hold all SQL of users, urls and clicks, routes only call their methods
+# Backend is picked from DATABASE: a postgresql:// URL or a SQLite file path
+
+# Any DB failure, raised by backends instead of driver specific errors
+class StorageError(Exception):
+  pass
+
+# Short code already used (i.e. by a legacy random code), insert can be retried with new codes
+class CodeCollision(StorageError):
+  pass
+
+# Base storage: connection handling shared by backends
+# Subclasses set errors (driver exception types) and implement acquire, release, close and translate
+class Storage:
+  errors = ()
+  # metrics.QueryMetrics timing every query, None to run queries on bare driver connections
+  metrics = None
+  # code_index.CodeIndex answering link lookups before the DB and logging link writes, None to always query
+  code_index = None
+
+  # Redirect data (id, original_url, user_id, redirect_status, cache_max_age, expires_at) of short URL, None if not found
+  # Taken from the code index if it knows the code, queried otherwise
+  def get_link(self, shortened_url):
+    if self.code_index is not None:
+      url_row = self.code_index.get(shortened_url)
+      if url_row is not None:
+        return None if url_row is MISSING else url_row
+    return self.query_link(shortened_url)
+
+  # Log links written by a transaction that just committed in the code index (rows with shortened_url), if any
+  def _index(self, rows=(), deleted=()):
+    if self.code_index is not None:
+      try:
+        self.code_index.log(rows, deleted)
+      except (OSError, struct.error) as e:
+        print(e) # Log error to server only, lookups of these codes may be stale until the index is rebuilt
+
+  # Connection to run queries with, driver errors are rolled back and raised as StorageError
+  # In an app context the same connection is reused until teardown, unless shared is False
+  # (e.g. reserving code ids, which commits and must not commit the caller's transaction)
+  @contextmanager
+  def connection(self, shared=True):
+    bound = shared and has_app_context()
+    try:
+      if bound:
+        if 'storage_conn' not in g:
+          g.storage_conn = self._acquire()
+        conn = g.storage_conn
+      else:
+        conn = self._acquire()
+    except self.errors as e:
+      self._failed()
+      raise self.translate(e) from e
+    try:
+      yield InstrumentedConnection(conn, self.metrics) if self.metrics else conn
+    except self.errors as e:
+      self._failed()
+      try:
+        conn.rollback()
+      except self.errors:
+        pass # Broken connection, the pool discards it
+      raise self.translate(e) from e
+    finally:
+      if not bound:
+        self.release(conn)
+
+  def _acquire(self):
+    conn = self.acquire()
+    if self.metrics:
+      self.metrics.connections.inc()
+    return conn
+
+  def _failed(self):
+    if self.metrics:
+      self.metrics.errors.inc()
+
+  # Return app context connection, registered as teardown handler
+  def teardown(self, exception=None):
+    conn = g.pop('storage_conn', None)
+    if conn is not None:
+      self.release(conn)
+
+# Links never clicked, created before the unclicked age (parameters: created before, now, clicked since)
+# Permanent or cacheable redirects are never candidates, browsers and proxies answer their repeat clicks
+# without counting them. Links with click events since then are kept too, whatever their count says
+UNCLICKED_URLS = """clicks = 0 AND created_at < ? AND (expires_at IS NULL OR expires_at > ?)
+                    AND redirect_status NOT IN (301, 308) AND cache_max_age = 0
+                    AND NOT EXISTS (SELECT 1 FROM click_events WHERE url_id = urls.id AND clicked_at >= ?)"""
+
+# SQLite storage, pooled connections from db.ConnectionPool
+class SQLiteStorage(Storage):
+  errors = (sqlite3.Error,)
+
+  def __init__(self, pool):
+    self.pool = pool
+
+  def acquire(self):
+    return self.pool.acquire()
+
+  def release(self, conn):
+    self.pool.release(conn)
+
+  def close(self):
+    self.pool.close()
+
+  # Connections opened by the pool and idle in it
+  def pool_stats(self):
+    return {'opened': self.pool.created, 'idle': self.pool.idle()}
+
+  def translate(self, error):
+    if isinstance(error, sqlite3.IntegrityError) and 'shortened_url' in str(error):
+      return CodeCollision(str(error))
+    return StorageError(str(error))
+
+  # Schema
+
+  # Apply pending migrations, returns list of applied (version, name)
+  def migrate(self, target=None):
+    with self.connection(shared=False) as conn:
+      return migrations.upgrade(conn, target)
+
+  # Current schema version and pending (version, name) migrations
+  def schema_status(self):
+    with self.connection(shared=False) as conn:
+      return (migrations.current_version(conn),
+              [(version, name) for version, name, _ in migrations.pending_migrations(conn)])
+
+  # Users
+
+  def get_user(self, user_id):
+    with self.connection() as conn:
+      return conn.execute("SELECT * FROM users WHERE id = ? LIMIT 1", (user_id,)).fetchone()
+
+  def get_user_by_username(self, username):
+    with self.connection() as conn:
+      return conn.execute("SELECT * FROM users WHERE username = ? LIMIT 1", (username,)).fetchone()
+
+  def create_user(self, username, password, fname, lname, email, phone, website):
+    with self.connection() as conn:
+      query = "INSERT INTO users (username, password, fname, lname, email, phone, website) VALUES (?, ?, ?, ?, ?, ?, ?)"
+      conn.execute(query, (username, password, fname, lname, email, phone, website))
+      conn.commit()
+
+  def update_user(self, username, fname, lname, email, phone, website):
+    with self.connection() as conn:
+      query = "UPDATE users SET fname=?, lname=?, email=?, phone=?, website=? WHERE username=?"
+      conn.execute(query, (fname, lname, email, phone, website, username))
+      conn.commit()
+
+  # Replace password hash, e.g. rehashed with a new cost
+  def update_password(self, user_id, password):
+    with self.connection() as conn:
+      conn.execute("UPDATE users SET password = ? WHERE id = ?", (password, user_id))
+      conn.commit()
+
+  def record_login(self, user_id, when):
+    with self.connection() as conn:
+      conn.execute("UPDATE users SET last_login = ? WHERE id = ?", (when, user_id))
+      conn.commit()
+
+  # Login throttling
+
+  # Count a login attempt against every key in one atomic statement, counters are kept per fixed window
+  # (window_start, in epoch seconds) along with the previous window's count, for sliding window estimates
+  # Returns {key: (attempts, previous)} including this attempt
+  def count_login_attempts(self, keys, window_start, window):
+    with self.connection() as conn:
+      values = ', '.join(['(?, ?, 1, 0)'] * len(keys))
+      query = f"""INSERT INTO login_attempts (throttle_key, window_start, attempts, previous) VALUES {values}
+                  ON CONFLICT (throttle_key) DO UPDATE SET
+                    previous = CASE WHEN login_attempts.window_start = excluded.window_start THEN login_attempts.previous
+                                    WHEN login_attempts.window_start = excluded.window_start - ? THEN login_attempts.attempts
+                                    ELSE 0 END,
+                    attempts = CASE WHEN login_attempts.window_start = excluded.window_start
+                                    THEN login_attempts.attempts + 1 ELSE 1 END,
+                    window_start = excluded.window_start
+                  RETURNING throttle_key, attempts, previous"""
+      params = [value for key in keys for value in (key, window_start)] + [window]
+      rows = conn.execute(query, params).fetchall()
+      conn.commit()
+      return {row['throttle_key']: (row['attempts'], row['previous']) for row in rows}
+
+  def clear_login_attempts(self, key):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM login_attempts WHERE throttle_key = ?", (key,))
+      conn.commit()
+
+  # Drop counters not updated since before window_start
+  def purge_login_attempts(self, window_start):
+    with self.connection() as conn:
+      conn.execute("DELETE FROM login_attempts WHERE window_start < ?", (window_start,))
+      conn.commit()
+
+  # API keys
+
+  def add_api_key(self, user_id, key_hash, name=None):
+    with self.connection() as conn:
+      query = "INSERT INTO api_keys (user_id, key_hash, name, created_at) VALUES (?, ?, ?, ?)"
+      conn.execute(query, (user_id, key_hash, name, datetime.utcnow()))
+      conn.commit()
+
+  # Delete API key by id, returns True if it existed
+  def delete_api_key(self, key_id):
+    with self.connection() as conn:
+      cursor = conn.execute("DELETE FROM api_keys WHERE id = ?", (key_id,))
+      conn.commit()
+      return cursor.rowcount > 0
+
+  # User row (id, username) owning API key hash, None if unknown
+  def api_key_user(self, key_hash):
+    with self.connection() as conn:
+      query = """SELECT users.id, users.username
+                 FROM api_keys
+                 JOIN users ON api_keys.user_id = users.id
+                 WHERE api_keys.key_hash = ? LIMIT 1"""
+      return conn.execute(query, (key_hash,)).fetchone()
+
+  # URLs
+
+  # Reserve size ids from named sequence, returns end of reserved range
+  def reserve_ids(self, name, size):
+    with self.connection(shared=False) as conn:
+      query = """INSERT INTO code_sequence (name, next_value) VALUES (?, ?)
+                 ON CONFLICT (name) DO UPDATE SET next_value = next_value + excluded.next_value
+                 RETURNING next_value"""
+      end = conn.execute(query, (name, size)).fetchone()[0]
+      conn.commit()
+      return end
+
+  def query_link(self, shortened_url):
+    with self.connection() as conn:
+      query = """SELECT id, original_url, user_id, redirect_status, cache_max_age, expires_at
+                 FROM urls WHERE shortened_url = ? LIMIT 1"""
+      return conn.execute(query, (shortened_url,)).fetchone()
+
+  # Redirect data of up to limit URLs with id above after_id, in id order (see snapshot.write_snapshot)
+  def link_batch(self, after_id, limit):
+    with self.connection() as conn:
+      query = """SELECT id, shortened_url, original_url, user_id, redirect_status, cache_max_age, expires_at
+                 FROM urls WHERE id > ? ORDER BY id LIMIT ?"""
+      return conn.execute(query, (after_id, limit)).fetchall()
+
+  # Short URL row if owned by user, None otherwise
+  def get_user_url(self, shortened_url, user_id):
+    with self.connection() as conn:
+      query = "SELECT * FROM urls WHERE shortened_url = ? AND user_id = ? LIMIT 1"
+      return conn.execute(query, (shortened_url, user_id)).fetchone()
+
+  # Insert (original_url, shortened_url) pairs of user in one transaction, with search index and stats
+  # All URLs get the same redirect policy (see links.redirect_policy) and expiry time (epoch seconds, None for never)
+  # Raises CodeCollision if a code is already used, nothing is inserted then
+  def create_urls(self, user_id, username, urls, redirect_status=302, cache_max_age=0, expires_at=None):
+    created_at = int(time.time())
+    with self.connection() as conn:
+      query = """INSERT INTO urls (original_url, shortened_url, user_id, redirect_status, cache_max_age, expires_at, created_at)
+                 VALUES (?, ?, ?, ?, ?, ?, ?)"""
+      conn.executemany(query, [(original_url, code, user_id, redirect_status, cache_max_age, expires_at, created_at)
+                               for original_url, code in urls])
+      index_urls_by_code(conn, [(original_url, username, code) for original_url, code in urls])
+      increment_user_stats(conn.cursor(), user_id, urls=len(urls))
+      rows = self._created_links(conn, urls)
+      conn.commit()
+    self._index(rows)
+
+  # Delete URL row with its search entry and click rollups, and remove it from owner's stats
+  def delete_url(self, url_row):
+    with self.connection() as conn:
+      cursor = conn.cursor()
+      cursor.execute("DELETE FROM urls WHERE id = ?", (url_row['id'],))
+      unindex_url(cursor, url_row['id'])
+      increment_user_stats(cursor, url_row['user_id'], urls=-1, clicks=-(url_row['clicks'] or 0))
+      cursor.execute("DELETE FROM click_stats_hourly WHERE url_id = ?", (url_row['id'],))
+      cursor.execute("DELETE FROM click_stats_daily WHERE url_id = ?", (url_row['id'],))
+      conn.commit()
+    self._index(deleted=[url_row['shortened_url']])
+
+  # Redirect data of URLs just inserted by create_urls, read in its transaction, only if there's a code index to log them in
+  def _created_links(self, conn, urls):
+    if self.code_index is None:
+      return []
+    query = f"""SELECT id, shortened_url, original_url, user_id, redirect_status, cache_max_age, expires_at
+                 FROM urls WHERE shortened_url IN ({', '.join('?' * len(urls))})"""
+    return conn.execute(query, [code for _, code in urls]).fetchall()
+
+  # Delete up to limit URLs expired at now, or never clicked and created before unclicked_before (if given),
+  # with their search entries, click rollups and share of owners' stats, in one transaction
+  # Returns short codes of deleted URLs
+  def purge_urls(self, now, unclicked_before=None, limit=500, keep=()):
+    with self.connection(shared=False) as conn:
+      # Take the write lock first, so rows can't change between reading and deleting them
+      conn.execute("BEGIN IMMEDIATE")
+      columns = "SELECT id, shortened_url, user_id, clicks FROM urls"
+      rows = conn.execute(f"{columns} WHERE expires_at <= ? LIMIT ?", (now, limit)).fetchall()
+      if unclicked_before is not None and len(rows) < limit:
+        query = f"""{columns} WHERE {UNCLICKED_URLS} AND id NOT IN (SELECT value FROM json_each(?)) LIMIT ?"""
+        clicked_since = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(unclicked_before))
+        params = (unclicked_before, now, clicked_since, json.dumps(list(keep)), limit - len(rows))
+        rows += conn.execute(query, params).fetchall()
+      cursor = conn.cursor()
+      ids = [(row['id'],) for row in rows]
+      cursor.executemany("DELETE FROM urls WHERE id = ?", ids)
+      for row in rows:
+        unindex_url(cursor, row['id'])
+      cursor.executemany("DELETE FROM click_stats_hourly WHERE url_id = ?", ids)
+      cursor.executemany("DELETE FROM click_stats_daily WHERE url_id = ?", ids)
+      removed = {}
+      for row in rows:
+        urls, clicks = removed.get(row['user_id'], (0, 0))
+        removed[row['user_id']] = (urls + 1, clicks + (row['clicks'] or 0))
+      for user_id, (urls, clicks) in removed.items():
+        increment_user_stats(cursor, user_id, urls=-urls, clicks=-clicks)
+      conn.commit()
+    codes = [row['shortened_url'] for row in rows]
+    self._index(deleted=codes)
+    return codes
+
+  # Give pages freed by deletes back to the file system (a few at a time) and refresh query planner stats
+  # Pages are only freed if the DB uses auto_vacuum=INCREMENTAL, see db.DEFAULT_CONFIG and `flask db vacuum`
+  def compact(self, pages=1000):
+    with self.connection(shared=False) as conn:
+      conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+      conn.execute("PRAGMA optimize")
+
+  # Rebuild DB file, switching it to auto_vacuum=INCREMENTAL, blocks all writers while it runs
+  def vacuum(self):
+    with self.connection(shared=False) as conn:
+      conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+      conn.execute("VACUUM")
+
+  # One keyset page of user's URLs, see pagination.Page
+  def user_urls_page(self, user_id, sort, after, limit, transform=None):
+    with self.connection() as conn:
+      return user_urls_page(conn.cursor(), user_id, sort, after, limit, transform)
+
+  # One page of URLs matching search query, returns rows and next page token
+  def search_urls(self, search_query, limit=20, after=None):
+    with self.connection() as conn:
+      return search_urls(conn.cursor(), search_query, limit, after)
+
+  # Stats
+
+  # User's counters as (url_count, total_clicks)
+  def user_stats(self, user_id):
+    with self.connection() as conn:
+      return get_user_stats(conn.cursor(), user_id)
+
+  # Recompute all user counters from urls table
+  def rebuild_user_stats(self):
+    with self.connection(shared=False) as conn:
+      # Hold the write lock so no URL or click lands between delete and insert
+      conn.execute("BEGIN IMMEDIATE")
+      rebuild_user_stats(conn)
+      conn.commit()
+
+  # Clicks
+
+  # Write a batch of buffered clicks in one transaction
+  # clicks_by_url: (clicks, url_id), events: (url_id, clicked_at, referrer, user_agent),
+  # hourly/daily: (url_id, bucket, clicks) rollups of events
+  def apply_clicks(self, clicks_by_url, events, hourly, daily):
+    with self.connection(shared=False) as conn:
+      conn.executemany("UPDATE urls SET clicks = clicks + ? WHERE id = ?", clicks_by_url)
+      add_clicks_by_url(conn, clicks_by_url)
+      conn.executemany("INSERT INTO click_events (url_id, clicked_at, referrer, user_agent) VALUES (?, ?, ?, ?)", events)
+      conn.executemany("""INSERT INTO click_stats_hourly (url_id, bucket, clicks) VALUES (?, ?, ?)
+                          ON CONFLICT (url_id, bucket) DO UPDATE SET clicks = clicks + excluded.clicks""", hourly)
+      conn.executemany("""INSERT INTO click_stats_daily (url_id, bucket, clicks) VALUES (?, ?, ?)
+                          ON CONFLICT (url_id, bucket) DO UPDATE SET clicks = clicks + excluded.clicks""", daily)
+      conn.commit()
+
+  # Clicks of URL per hour in last hours and per day in last days, newest first, read from rollups only
+  def url_click_stats(self, url_id, hours=48, days=30):
+    now = datetime.utcnow()
+    with self.connection() as conn:
+      query_hourly = "SELECT bucket, clicks FROM click_stats_hourly WHERE url_id = ? AND bucket >= ? ORDER BY bucket DESC"
+      hourly = conn.execute(query_hourly, (url_id, (now - timedelta(hours=hours)).strftime('%Y-%m-%d %H:00'))).fetchall()
+      query_daily = "SELECT bucket, clicks FROM click_stats_daily WHERE url_id = ? AND bucket >= ? ORDER BY bucket DESC"
+      daily = conn.execute(query_daily, (url_id, (now - timedelta(days=days)).strftime('%Y-%m-%d'))).fetchall()
+      return hourly, daily
+
+# Create storage backend from app config, releasing app context connections on teardown
+def create_storage(app):
+  url = app.config['DATABASE']
+  if url and url.startswith(('postgres://', 'postgresql://')):
+    # psycopg is only needed (and imported) when running on PostgreSQL
+    from postgres_storage import PostgresStorage, DEFAULT_CONFIG
+    for key, value in DEFAULT_CONFIG.items():
+      app.config.setdefault(key, value)
+    storage = PostgresStorage(url,
+                              min_size=app.config['POSTGRES_POOL_MIN_SIZE'],
+                              max_size=app.config['POSTGRES_POOL_MAX_SIZE'],
+                              timeout=app.config['POSTGRES_POOL_TIMEOUT'],
+                              prepare_threshold=app.config['POSTGRES_PREPARE_THRESHOLD'])
+  else:
+    storage = SQLiteStorage(db.create_pool(app))
+  app.teardown_appcontext(storage.teardown)
+  atexit.register(storage.close)
+  return storage
@@ -0,0 +1,75 @@
+import os
+import pytest
+from flask import Flask
+from storage import create_storage
+from shared_tier import SharedTier, connect
+
+# Storage tests run against each backend: SQLite in a temporary file, and PostgreSQL at TEST_POSTGRES_URL
+# or, if that isn't set, a throwaway local server started with pgserver (pip install pgserver).
+# PostgreSQL tests are skipped when neither is available
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+  url = os.environ.get('TEST_POSTGRES_URL')
+  if url:
+    yield url
+    return
+  pgserver = pytest.importorskip('pgserver', reason='set TEST_POSTGRES_URL or install pgserver')
+  server = pgserver.get_server(str(tmp_path_factory.mktemp('postgres')), cleanup_mode='stop')
+  yield server.get_uri()
+  server.cleanup()
+
+# Drop everything earlier tests created, every test starts from an empty schema
+def reset_postgres(url):
+  import psycopg
+  with psycopg.connect(url, autocommit=True) as conn:
+    conn.execute("DROP SCHEMA public CASCADE")
+    conn.execute("CREATE SCHEMA public")
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def app(request, tmp_path):
+  if request.param == 'sqlite':
+    url = str(tmp_path / 'test.db')
+  else:
+    url = request.getfixturevalue('postgres_url')
+    reset_postgres(url)
+  app = Flask(__name__)
+  app.config['DATABASE'] = url
+  return app
+
+# Migrated storage backend, used within an app context like in a request (one connection per test)
+@pytest.fixture
+def storage(app):
+  storage = create_storage(app)
+  storage.migrate()
+  with app.app_context():
+    yield storage
+  storage.close()
+
+# Shared tier on the in-process stand-in (memory://), set tier.client.down to simulate an outage
+@pytest.fixture
+def tier():
+  return SharedTier(connect('memory://'), prefix='test:', retry_interval=0)
+
+@pytest.fixture
+def user_id(storage):
+  storage.create_user('alice', 'hash', 'Al', 'Ice', 'a@example.com', None, None)
+  return storage.get_user_by_username('alice')['id']
+
+# The app module, configured from the environment when it's imported: SQLite in a temporary directory,
+# no shared tier, clicks only flushed by tests. Imported once per run, tests of its routes share its DB
+@pytest.fixture(scope='session')
+def shortener(tmp_path_factory):
+  os.environ['DATABASE_URL'] = str(tmp_path_factory.mktemp('app') / 'app.db')
+  os.environ.setdefault('SECRET_KEY', 'test')
+  os.environ.setdefault('BCRYPT_LOG_ROUNDS', '4')
+  os.environ.setdefault('CLICK_FLUSH_INTERVAL_MS', '3600000')
+  # Every test client logs in from the same address
+  os.environ.setdefault('LOGIN_IP_MAX_ATTEMPTS', '1000')
+  # Clients behind one proxy, tests can set their address in X-Forwarded-For
+  os.environ['TRUSTED_PROXY_HOPS'] = '1'
+  os.environ.pop('REDIS_URL', None)
+  import app as shortener
+  shortener.app.config.update(TESTING=True)
+  shortener.create_db()
+  return shortener
@@ -0,0 +1,231 @@
+import itertools
+import json
+import re
+import time
+import pytest
+
+# Routes of the app module (see conftest.shortener), each test logged in as a user of its own
+
+PASSWORD = 'Passw0rd!'
+USER_NUMBERS = itertools.count()
+
+@pytest.fixture
+def username():
+  return f'user{next(USER_NUMBERS)}'
+
+# Post a form with the CSRF token of its page (forms require one even when testing)
+def post(client, url, data):
+  token = re.search(r'name="csrf_token" type="hidden" value="([^"]+)"', client.get(url).get_data(as_text=True))
+  return client.post(url, data=dict(data, csrf_token=token.group(1)))
+
+# Client logged in as username
+@pytest.fixture
+def client(shortener, username):
+  client = shortener.app.test_client()
+  response = post(client, '/register', dict(username=username, email=f'{username}@example.com', fname='Al',
+                                            lname='Ice', password=PASSWORD, repeat_password=PASSWORD))
+  assert response.status_code == 302
+  assert post(client, '/login', dict(username=username, password=PASSWORD)).status_code == 302
+  return client
+
+# Create a short URL through the form, returns its code
+def shorten(client, url):
+  assert post(client, '/shorten', {'original_url': url}).status_code == 302
+  codes = re.findall(r'href="([a-z0-9]{6})" target', client.get('/my-urls').get_data(as_text=True))
+  return codes[0]
+
+def test_deleted_link_stops_redirecting(client, shortener):
+  code = shorten(client, 'https://www.python.org/')
+  response = client.get('/' + code)
+  assert response.status_code == 302 and response.headers['Location'] == 'https://www.python.org/'
+  assert shortener.link_cache.get(code)['original_url'] == 'https://www.python.org/'
+  assert client.get('/' + code + '/delete').status_code == 302
+  assert client.get('/' + code).status_code == 404
+
+def test_url_stats_page(client, shortener):
+  code = shorten(client, 'https://stats.example.com/')
+  for _ in range(2):
+    client.get('/' + code)
+  shortener.click_buffer.flush()
+  page = client.get(f'/{code}/stats').get_data(as_text=True)
+  assert 'Total Clicks: 2' in page and 'No clicks recorded yet' not in page
+  # Only the owner sees them
+  assert shortener.app.test_client().get(f'/{code}/stats').status_code == 302
+
+def test_search(client):
+  code = shorten(client, 'https://search-me.example.com/page')
+  assert code in client.get('/search?q=search-me').get_data(as_text=True)
+
+def test_db_status_command(shortener):
+  output = shortener.app.test_cli_runner().invoke(args=['db', 'status']).output
+  assert output.startswith('Current version: ') and 'Pending' not in output
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_my_urls_pages(client, shortener, monkeypatch, stream):
+  monkeypatch.setitem(shortener.app.config, 'LISTING_PAGE_SIZE', 1)
+  monkeypatch.setitem(shortener.app.config, 'STREAM_LISTINGS', stream)
+  first = shorten(client, 'https://first.example.com/')
+  second = shorten(client, 'https://second.example.com/')
+  page = client.get('/my-urls').get_data(as_text=True)
+  assert second in page and first not in page
+  after = re.search(r'after=([0-9_]+)', page).group(1)
+  page = client.get('/my-urls?after=' + after).get_data(as_text=True)
+  assert first in page and 'Next page' not in page
+
+def test_dashboard_counts_pending_clicks(client):
+  code = shorten(client, 'https://dashboard.example.com/')
+  client.get('/' + code)
+  page = re.sub(r'\s+', ' ', client.get('/').get_data(as_text=True))
+  assert '<td>URLs</td> <td>1</td>' in page and '<td>Total Clicks</td> <td>1</td>' in page
+
+@pytest.mark.parametrize('snapshot', [False, True])
+def test_profile_edit_refreshes_cached_user(client, shortener, username, monkeypatch, snapshot):
+  monkeypatch.setitem(shortener.app.config, 'USER_SESSION_SNAPSHOT', snapshot)
+  assert 'First Name: Al<' in client.get('/profile').get_data(as_text=True)
+  response = post(client, '/profile/edit', dict(email=f'{username}@example.com', fname='Alice', lname='Ice',
+                                                phone='', website='https://alice.example.com/'))
+  assert response.status_code == 302
+  assert 'First Name: Alice<' in client.get('/profile').get_data(as_text=True)
+  with client.session_transaction() as session:
+    assert ('user_snapshot' in session) == snapshot
+
+def test_bulk_import(client, shortener, username, tmp_path):
+  runner = shortener.app.test_cli_runner()
+  key = runner.invoke(args=['apikey', 'create', username]).output.strip()
+  response = client.post('/api/v1/links/bulk', data='"https://bulk.example.com/"\n"nope"\n',
+                         headers={'X-API-Key': key, 'Content-Type': 'application/x-ndjson'})
+  results = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+  assert [result['line'] for result in results] == [2, 1] and 'shortened_url' in results[1]
+  assert client.get('/' + results[1]['shortened_url']).headers['Location'] == 'https://bulk.example.com/'
+  path = tmp_path / 'urls.csv'
+  path.write_text('url\nhttps://csv.example.com/\n')
+  output = runner.invoke(args=['urls', 'import', str(path), '--user', username]).output
+  assert json.loads(output)['original_url'] == 'https://csv.example.com/'
+
+def test_api(client, shortener, username):
+  key = shortener.app.test_cli_runner().invoke(args=['apikey', 'create', username]).output.strip()
+  headers = {'X-API-Key': key}
+  response = client.post('/api/v1/links', json={'original_url': 'https://api.example.com/'}, headers=headers)
+  assert response.status_code == 201
+  code = response.json['shortened_url']
+  response = client.get('/api/v1/links/' + code, headers={'Authorization': 'Bearer ' + key})
+  assert response.json['original_url'] == 'https://api.example.com/'
+  assert client.get('/api/v1/links/' + code, headers=dict(headers, **{'If-None-Match': response.headers['ETag']})).status_code == 304
+  assert [link['shortened_url'] for link in client.get('/api/v1/links', headers=headers).json['links']] == [code]
+  assert client.get(f'/api/v1/links/{code}/stats', headers=headers).json['clicks'] == 0
+  assert client.post('/api/v1/links', json={'original_url': 'nope'}, headers=headers).status_code == 400
+  assert client.get('/api/v1/links/nosuch', headers=headers).status_code == 404
+  assert client.get('/api/v1/links', headers={'X-API-Key': 'wrong'}).status_code == 401
+  assert client.get('/api/v1/links').status_code == 401
+
+def test_metrics_page(shortener, monkeypatch):
+  client = shortener.app.test_client()
+  client.get('/login')
+  # Not public by default
+  assert client.get('/metrics').status_code == 404
+  monkeypatch.setitem(shortener.app.config, 'METRICS_TOKEN', 'scrape')
+  assert client.get('/metrics').status_code == 401
+  page = client.get('/metrics', headers={'Authorization': 'Bearer scrape'}).get_data(as_text=True)
+  assert 'shortener_responses_total{endpoint="login",method="GET",status="200"}' in page
+  assert 'shortener_db_query_duration_seconds_count' in page
+
+def test_metrics_page_for_scrapers_of_allowed_networks(shortener, monkeypatch):
+  monkeypatch.setattr(shortener, 'metrics_networks', shortener.parse_networks('10.0.0.0/8'))
+  client = shortener.app.test_client()
+  assert client.get('/metrics', headers={'X-Forwarded-For': '10.1.2.3'}).status_code == 200
+  assert client.get('/metrics', headers={'X-Forwarded-For': '198.51.100.1'}).status_code == 404
+
+def test_login_rehashes_password_of_old_cost(client, shortener, username, monkeypatch):
+  storage = shortener.storage
+  with shortener.app.app_context():
+    assert storage.get_user_by_username(username)['password'].startswith('$2b$04$')
+  monkeypatch.setattr(shortener.password_hasher, 'log_rounds', 5)
+  client.get('/logout')
+  assert post(client, '/login', dict(username=username, password=PASSWORD)).status_code == 302
+  with shortener.app.app_context():
+    assert storage.get_user_by_username(username)['password'].startswith('$2b$05$')
+
+def test_login_throttled_per_account(client, shortener, username, monkeypatch):
+  monkeypatch.setattr(shortener.login_throttle, 'max_attempts', 2)
+  client.get('/logout')
+  statuses = [post(client, '/login', dict(username=username, password='wrong')).status_code for _ in range(3)]
+  assert statuses == [200, 200, 429]
+  # Even the right password waits
+  response = post(client, '/login', dict(username=username, password=PASSWORD))
+  assert response.status_code == 429 and int(response.headers['Retry-After']) > 0
+
+def failed_login(client, ip):
+  client.environ_base['HTTP_X_FORWARDED_FOR'] = ip
+  return post(client, '/login', dict(username=f'nobody{next(USER_NUMBERS)}', password='wrong')).status_code
+
+def test_login_ip_limit_counts_forwarded_clients(shortener, monkeypatch):
+  monkeypatch.setattr(shortener.login_throttle, 'max_ip_attempts', 2)
+  client = shortener.app.test_client()
+  assert [failed_login(client, '203.0.113.1') for _ in range(3)] == [200, 200, 429]
+  # Another client behind the same proxy has its own count
+  assert failed_login(client, '203.0.113.2') == 200
+
+def test_redirect_policy_of_links(client, shortener, username):
+  key = shortener.app.test_cli_runner().invoke(args=['apikey', 'create', username]).output.strip()
+  response = client.post('/api/v1/links', json={'original_url': 'https://permanent.example.com/', 'redirect_status': 301,
+                                                'cache_max_age': 60}, headers={'X-API-Key': key})
+  response = client.get('/' + response.json['shortened_url'])
+  assert response.status_code == 301 and response.headers['Cache-Control'] == 'public, max-age=60'
+  response = client.get('/' + shorten(client, 'https://temporary.example.com/'))
+  assert response.status_code == 302 and response.headers['Cache-Control'] == 'no-store'
+
+def test_expired_link_is_gone(client, shortener, username):
+  storage = shortener.storage
+  with shortener.app.app_context():
+    user_row = storage.get_user_by_username(username)
+    storage.create_urls(user_row['id'], username, [('https://expired.example.com/', 'gone01')],
+                        expires_at=int(time.time()) - 10)
+  assert client.get('/gone01').status_code == 410
+
+def test_replica_clicks(client, shortener, monkeypatch):
+  code = shorten(client, 'https://replica.example.com/')
+  with shortener.app.app_context():
+    url_id = shortener.storage.get_link(code)['id']
+  batch = {'clicks': [[url_id, 2]], 'events': [[url_id, '2024-01-01 10:05:00', None, None]] * 2}
+  assert client.post('/api/v1/replica/clicks', json=batch).status_code == 404
+  monkeypatch.setitem(shortener.app.config, 'REPLICA_TOKEN', 'replica')
+  assert client.post('/api/v1/replica/clicks', json=batch).status_code == 401
+  headers = {'Authorization': 'Bearer replica'}
+  assert client.post('/api/v1/replica/clicks', json={'clicks': 1}, headers=headers).status_code == 400
+  assert client.post('/api/v1/replica/clicks', json=batch, headers=headers).json == {'clicks': 2, 'events': 2}
+  assert 'Total Clicks: 2' in client.get(f'/{code}/stats').get_data(as_text=True)
+
+def test_missing_code_gets_static_page(shortener):
+  response = shortener.app.test_client().get('/nosuch')
+  assert response.status_code == 404 and response.data == shortener.STATIC_PAGES[404]
+
+def test_static_error_pages_are_the_same_for_users(client, shortener):
+  response = client.get('/nosuch')
+  assert response.status_code == 404 and response.data == shortener.STATIC_PAGES[404]
+  assert b'href="/login"' not in response.data and b'href="/logout"' not in response.data
+  assert b'href="/static/' in response.data
+
+def test_redirect_rate_limit_per_client(client, shortener, monkeypatch):
+  code = shorten(client, 'https://limited.example.com/')
+  monkeypatch.setitem(shortener.rate_budgets, 'redirect', (2, 60))
+  def redirect(ip):
+    return client.get('/' + code, environ_base={'REMOTE_ADDR': ip})
+  assert [redirect('198.51.100.1').status_code for _ in range(2)] == [302, 302]
+  response = redirect('198.51.100.1')
+  assert response.status_code == 429 and response.data == shortener.STATIC_PAGES[429]
+  assert int(response.headers['Retry-After']) > 0
+  assert redirect('198.51.100.2').status_code == 302
+
+def test_visitor_home_page_is_cached(shortener, monkeypatch):
+  # Rendered by the first visitor's request, under the path the app is served at
+  monkeypatch.setattr(shortener, 'STATIC_PAGES', {404: shortener.STATIC_PAGES[404]})
+  monkeypatch.setattr(shortener, 'STATIC_PAGE_ETAGS', {})
+  client = shortener.app.test_client()
+  response = client.get('/', base_url='http://localhost/s/')
+  assert b'href="/s/search"' in response.data
+  assert response.data == shortener.STATIC_PAGES['index'] and 'Cookie' in response.headers['Vary']
+  assert client.get('/', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+
+def test_dashboard_is_rendered_for_users(client):
+  response = client.get('/')
+  assert b'My Dashboard' in response.data and 'ETag' not in response.headers
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+
+# Redirects served by the ASGI entry point (asgi.py), on the app module of conftest.shortener
+
+@pytest.fixture(scope='module')
+def asgi(shortener):
+  import asgi
+  return asgi
+
+@pytest.fixture(scope='module')
+def code(shortener):
+  storage = shortener.storage
+  with shortener.app.app_context():
+    storage.create_user('asgi', 'hash', 'Al', 'Ice', 'asgi@example.com', None, None)
+    storage.create_urls(storage.get_user_by_username('asgi')['id'], 'asgi', [('https://asgi.example.com/ü', 'asgi01')])
+  return 'asgi01'
+
+# Run ASGI app for one request, returns status, headers and body
+def call(asgi, path, method='GET', client=('10.0.0.1', 1234), headers=()):
+  scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method, 'scheme': 'http',
+           'path': path, 'raw_path': path.encode(), 'root_path': '', 'query_string': b'', 'client': client,
+           'server': ('localhost', 80), 'headers': [(b'host', b'localhost'), *headers]}
+  messages = []
+
+  async def receive():
+    return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+  async def send(message):
+    messages.append(message)
+
+  asyncio.run(asgi.application(scope, receive, send))
+  start = messages[0]
+  body = b''.join(message.get('body', b'') for message in messages[1:])
+  return start['status'], {key.decode(): value.decode() for key, value in start['headers']}, body
+
+def test_redirect(asgi, code, shortener):
+  status, headers, _ = call(asgi, '/' + code)
+  assert status == 302 and headers['location'] == 'https://asgi.example.com/%C3%BC'
+  with shortener.app.app_context():
+    url_id = shortener.storage.get_link(code)['id']
+  # Click counted like by the Flask route
+  assert shortener.click_buffer.pending(url_id) == 1
+  assert call(asgi, '/' + code, method='HEAD')[0] == 302
+
+def test_unknown_code_gets_static_404(asgi, code):
+  status, headers, body = call(asgi, '/nosuch')
+  assert status == 404 and int(headers['content-length']) == len(body) > 0
+
+def test_other_routes_handed_to_flask(asgi):
+  status, headers, body = call(asgi, '/login')
+  assert status == 200 and b'csrf_token' in body
+
+def test_client_ip(asgi):
+  scope = {'client': ('10.0.0.1', 1234), 'headers': [(b'x-forwarded-for', b'203.0.113.9, 10.0.0.2')]}
+  # One trusted proxy (see conftest.shortener): the address it saw, whatever the client put before it
+  assert asgi.client_ip(scope) == '10.0.0.2'
+  assert asgi.client_ip(dict(scope, headers=[])) == '10.0.0.1'
+
+def test_redirect_rate_limit_counts_forwarded_clients(asgi, code, shortener, monkeypatch):
+  monkeypatch.setitem(shortener.rate_budgets, 'redirect', (2, 60))
+  def redirect(ip):
+    status, headers, _ = call(asgi, '/' + code, headers=[(b'x-forwarded-for', ip.encode())])
+    return status
+  assert [redirect('198.51.100.11') for _ in range(3)] == [302, 302, 429]
+  assert redirect('198.51.100.12') == 302
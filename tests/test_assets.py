@@ -0,0 +1,23 @@
+import json
+from assets import minify_css, minify_js, build_assets, load_manifest, manifest_path
+
+def test_minify_css():
+  css = '/* header */\na:hover ,  b > c {\n  color:  red;\n  content: " a  { b } ";\n}\n'
+  assert minify_css(css) == 'a:hover,b>c{color:red;content:" a  { b } "}'
+
+def test_minify_js():
+  js = '// comment\nfunction f() {\n    return "// kept";\n}\n\n'
+  assert minify_js(js) == 'function f() {\nreturn "// kept";\n}'
+
+def test_build_assets(tmp_path):
+  (tmp_path / 'css').mkdir()
+  (tmp_path / 'css' / 'style.css').write_text('body {\n  margin: 0;\n}\n')
+  (tmp_path / 'logo.png').write_bytes(b'png')
+  manifest = build_assets(str(tmp_path))
+  built = manifest['css/style.css']
+  assert list(manifest) == ['css/style.css'] and built.startswith('dist/css/style.') and built.endswith('.css')
+  assert (tmp_path / built).read_text() == 'body{margin:0}'
+  assert load_manifest(manifest_path(str(tmp_path))) == manifest
+  # Same content, same name; rebuilding skips the built files
+  assert build_assets(str(tmp_path)) == manifest
+  assert json.loads((tmp_path / 'dist' / 'manifest.json').read_text()) == manifest
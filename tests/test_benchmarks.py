@@ -0,0 +1,21 @@
+import pytest
+from benchmarks.run import percentile, summarize
+from benchmarks.seed import seed, username, zipf_weights
+from utils import ShortCodeAllocator
+
+def test_zipf_weights():
+  assert zipf_weights(3, 1) == pytest.approx([1, 1.5, 1.5 + 1 / 3])
+
+def test_summarize():
+  assert percentile([1, 2, 3, 4], 50) == 2 and percentile([1, 2, 3, 4], 99) == 4
+  summary = summarize([0.003, 0.001, 0.002], 1, 2.0)
+  assert (summary['requests'], summary['errors'], summary['p50_ms'], summary['max_ms']) == (3, 1, 2.0, 3.0)
+  assert summary['throughput_rps'] == 1.5
+  assert summarize([], 2, 1.0) == {'requests': 0, 'errors': 2}
+
+def test_seed(storage):
+  context = seed(storage, ShortCodeAllocator(storage, block_size=50), 'hash', users=3, urls=40, clicks=200)
+  assert context['usernames'] == [username(index) for index in range(3)]
+  assert len(set(context['codes'])) == 40
+  counts = [storage.user_stats(storage.get_user_by_username(name)['id']) for name in context['usernames']]
+  assert sum(urls for urls, _ in counts) == 40 and sum(clicks for _, clicks in counts) == 200
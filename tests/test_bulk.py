@@ -0,0 +1,38 @@
+import io
+from api_keys import create_api_key, hash_api_key
+from bulk import read_csv, read_ndjson, import_urls
+from utils import ShortCodeAllocator
+
+def test_read_csv():
+  lines = io.StringIO('name,url\npython, https://www.python.org/ \n\nshort\n')
+  assert list(read_csv(lines)) == [(2, 'https://www.python.org/'), (4, None)]
+  assert list(read_csv(['https://a.example.com', 'https://b.example.com'])) == [(1, 'https://a.example.com'),
+                                                                               (2, 'https://b.example.com')]
+
+def test_read_ndjson():
+  lines = ['"https://a.example.com"', '{"url": "https://b.example.com"}', '', 'not json', '{"name": 1}']
+  assert list(read_ndjson(lines)) == [(1, 'https://a.example.com'), (2, 'https://b.example.com'), (4, None), (5, None)]
+
+def test_import_reports_every_line(storage, user_id):
+  allocator = ShortCodeAllocator(storage, block_size=10)
+  records = [(1, 'https://a.example.com'), (2, 'not a url'), (3, None), (4, 'https://b.example.com'),
+             (5, 'https://c.example.com')]
+  created = []
+  results = list(import_urls(storage, user_id, 'alice', allocator, records, chunk_size=2, on_created=created.append))
+  assert [result['line'] for result in results] == [2, 3, 1, 4, 5]
+  assert all('error' in result for result in results[:2])
+  assert created == [result['shortened_url'] for result in results[2:]]
+  assert storage.get_link(created[2])['original_url'] == 'https://c.example.com'
+  assert storage.user_stats(user_id) == (3, 0)
+
+def test_import_retries_codes_taken_by_legacy_links(storage, user_id):
+  storage.create_urls(user_id, 'alice', [('https://legacy.example.com', 'aaaaaa')])
+  allocator = ShortCodeAllocator(storage, block_size=10)
+  results = list(import_urls(storage, user_id, 'alice', allocator, [(1, 'https://a.example.com')]))
+  assert results[0]['shortened_url'] != 'aaaaaa'
+  assert storage.get_link('aaaaaa')['original_url'] == 'https://legacy.example.com'
+
+def test_api_keys(storage, user_id):
+  key = create_api_key(storage, user_id, 'ci')
+  assert storage.api_key_user(hash_api_key(key))['username'] == 'alice'
+  assert storage.api_key_user(hash_api_key('other')) is None
@@ -0,0 +1,67 @@
+import time
+import pytest
+from cache import LRUCache, MISSING
+from links import find_link
+
+# Clock of cache entries, moved by hand
+@pytest.fixture
+def clock(monkeypatch):
+  now = [1000.0]
+  monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+  return now
+
+def test_least_recently_used_entries_are_evicted():
+  cache = LRUCache(maxsize=2)
+  cache.set('a', 1)
+  cache.set('b', 2)
+  assert cache.get('a') == 1
+  cache.set('c', 3)
+  assert cache.get('b') is None and cache.get('a') == 1 and cache.get('c') == 3
+  assert cache.stats()['evictions'] == 1
+
+def test_entries_expire(clock):
+  cache = LRUCache(ttl=10, negative_ttl=2)
+  cache.set('abc', 1)
+  cache.set_missing('nosuch')
+  clock[0] += 3
+  assert cache.get('abc') == 1 and cache.get('nosuch') is None
+  clock[0] += 8
+  assert cache.get('abc', 'default') == 'default'
+  assert cache.stats()['expirations'] == 2 and len(cache) == 0
+
+def test_negative_entries():
+  cache = LRUCache()
+  cache.set_missing('nosuch')
+  assert cache.get('nosuch') is MISSING
+  assert cache.get('other') is None
+  stats = cache.stats()
+  assert (stats['negative_hits'], stats['misses'], stats['hit_ratio']) == (1, 1, 0.5)
+
+def test_invalidate_drops_entries():
+  cache = LRUCache()
+  cache.set('abc', 1)
+  cache.set_missing('nosuch')
+  cache.invalidate('abc')
+  cache.invalidate('nosuch')
+  cache.invalidate('unknown')
+  assert cache.get('abc') is None and cache.get('nosuch') is None
+  assert cache.stats()['invalidations'] == 2
+
+def test_zero_size_or_ttl_caches_nothing():
+  for cache in (LRUCache(maxsize=0), LRUCache(ttl=0, negative_ttl=0)):
+    cache.set('abc', 1)
+    cache.set_missing('nosuch')
+    assert len(cache) == 0
+
+def test_find_link_queries_storage_once_per_code():
+  class Storage:
+    queries = 0
+    def get_link(self, shortened_url):
+      self.queries += 1
+      return {'id': 1, 'original_url': 'https://example.com'} if shortened_url == 'abc123' else None
+  storage = Storage()
+  cache = LRUCache()
+  for _ in range(2):
+    assert find_link(cache, storage, 'abc123')['original_url'] == 'https://example.com'
+    assert find_link(cache, storage, 'nosuch') is None
+  assert storage.queries == 2
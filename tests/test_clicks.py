@@ -0,0 +1,120 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import pytest
+from clicks import ClickBuffer, RemoteClickBuffer, parse_click_batch, rollup, write_clicks
+from storage import StorageError
+
+class FailingStorage:
+  def apply_clicks(self, *args):
+    raise StorageError('database is locked')
+
+def create_link(storage, user_id):
+  storage.create_urls(user_id, 'alice', [('https://example.com', 'abc123')])
+  return storage.get_link('abc123')['id']
+
+def test_flush_writes_counts_and_events(storage, user_id):
+  url_id = create_link(storage, user_id)
+  buffer = ClickBuffer(storage, flush_interval=3600)
+  for _ in range(3):
+    buffer.record(url_id, user_id, referrer='https://referrer.example')
+  assert buffer.pending(url_id) == 3 and buffer.pending_for_user(user_id) == 3
+  assert buffer.flush() == 3
+  assert buffer.pending(url_id) == 0 and buffer.flushes == 1
+  assert storage.get_user_url('abc123', user_id)['clicks'] == 3
+  assert buffer.flush() == 0
+  buffer.stop()
+
+def test_pending_clicks_are_added_to_rows(storage, user_id):
+  url_id = create_link(storage, user_id)
+  buffer = ClickBuffer(storage, flush_interval=3600)
+  buffer.record(url_id, user_id)
+  row = storage.get_user_url('abc123', user_id)
+  assert buffer.apply([row])[0]['clicks'] == 1
+  assert buffer.applier()(row)['clicks'] == 1
+  buffer.stop()
+
+def test_threshold_wakes_flusher(storage, user_id):
+  url_id = create_link(storage, user_id)
+  buffer = ClickBuffer(storage, flush_interval=3600, flush_threshold=2)
+  buffer.record(url_id, user_id)
+  buffer.record(url_id, user_id)
+  # Pending counts are taken before they're written, wait for the write
+  deadline = time.monotonic() + 5
+  while storage.get_user_url('abc123', user_id)['clicks'] < 2 and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert storage.get_user_url('abc123', user_id)['clicks'] == 2 and buffer.pending(url_id) == 0
+  buffer.stop()
+
+def test_failed_flush_keeps_clicks():
+  buffer = ClickBuffer(FailingStorage(), flush_interval=3600)
+  buffer.record(1, 7)
+  buffer.record(1, 7)
+  assert buffer.flush() == 0
+  assert buffer.pending(1) == 2 and buffer.pending_for_user(7) == 2
+  assert buffer.flushes == 0
+  buffer._stopping = True
+
+def test_failed_flushes_keep_counts_but_cap_events():
+  buffer = ClickBuffer(FailingStorage(), flush_interval=3600, max_events=3)
+  for _ in range(2):
+    buffer.record(1, 7)
+  assert buffer.flush() == 0
+  for _ in range(3):
+    buffer.record(1, 7)
+  assert buffer.flush() == 0
+  assert buffer.pending(1) == 5
+  assert len(buffer._log) == 3 and buffer.dropped_events == 2
+  buffer._stopping = True
+
+def test_rollup_buckets_events_per_hour_and_day():
+  events = [(1, '2024-01-01 10:05:00', None, None), (1, '2024-01-01 10:55:00', None, None),
+            (1, '2024-01-01 11:00:00', None, None), (2, '2024-01-02 00:00:00', None, None)]
+  hourly, daily = rollup(events)
+  assert sorted(hourly) == [(1, '2024-01-01 10:00', 2), (1, '2024-01-01 11:00', 1), (2, '2024-01-02 00:00', 1)]
+  assert sorted(daily) == [(1, '2024-01-01', 3), (2, '2024-01-02', 1)]
+
+def test_click_events_roll_up(storage, user_id):
+  url_id = create_link(storage, user_id)
+  now = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())
+  write_clicks(storage, {url_id: 2}, [(url_id, now, 'https://referrer.example', 'agent'), (url_id, now, None, None)])
+  assert storage.get_user_url('abc123', user_id)['clicks'] == 2
+  with storage.connection() as conn:
+    assert conn.execute("SELECT COUNT(*) AS events FROM click_events").fetchone()["events"] == 2
+  hourly, daily = storage.url_click_stats(url_id)
+  assert [row['clicks'] for row in hourly] == [2] and [row['clicks'] for row in daily] == [2]
+
+def test_parse_click_batch():
+  batch = {'clicks': [[1, 2], [1, 1], [2, 1]], 'events': [[1, '2024-01-01 10:05:00', 'https://referrer.example', None]]}
+  assert parse_click_batch(batch) == ({1: 3, 2: 1}, [(1, '2024-01-01 10:05:00', 'https://referrer.example', None)])
+  assert parse_click_batch({'clicks': [], 'events': []}) == ({}, [])
+  for invalid in (None, [], {'clicks': [[1, 0]], 'events': []}, {'clicks': [[1, True]], 'events': []},
+                  {'clicks': [], 'events': [[1, 'yesterday', None, None]]}, {'clicks': []}):
+    assert parse_click_batch(invalid) is None
+
+# Primary's click endpoint answering every batch with status
+@pytest.fixture
+def primary():
+  class Handler(BaseHTTPRequestHandler):
+    def do_POST(self):
+      self.rfile.read(int(self.headers['Content-Length']))
+      self.send_response(server.status)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    def log_message(self, *args):
+      pass
+  server = HTTPServer(('127.0.0.1', 0), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  yield server
+  server.shutdown()
+
+@pytest.mark.parametrize('status, kept', [(200, 0), (503, 2), (400, 0), (401, 0), (404, 0)])
+def test_remote_click_buffer(primary, status, kept):
+  primary.status = status
+  buffer = RemoteClickBuffer(f'http://127.0.0.1:{primary.server_port}', 'token', flush_interval=3600)
+  buffer.record(1, 7)
+  buffer.record(1, 7)
+  buffer.flush()
+  assert buffer.pending(1) == kept
+  assert buffer.dropped_events == (2 if status in (400, 401, 404) else 0)
+  buffer._stopping = True
@@ -0,0 +1,73 @@
+import struct
+import time
+import pytest
+from cache import MISSING
+from code_index import CodeIndex, build_code_index
+
+@pytest.fixture
+def index_path(tmp_path):
+  return str(tmp_path / 'codes.idx')
+
+def create(storage, user_id, *codes):
+  storage.create_urls(user_id, 'alice', [(f'https://example.com/{code}', code) for code in codes])
+
+def test_index_answers_lookups(storage, user_id, index_path):
+  create(storage, user_id, 'abc123', 'zzz999', 'legacy-code')
+  assert build_code_index(storage, index_path) == 2
+  index = CodeIndex(index_path, check_interval=0)
+  assert index.get('abc123')['original_url'] == 'https://example.com/abc123'
+  assert index.get('zzz999')['user_id'] == user_id
+  # Unknown and unindexable codes are left to the DB
+  assert index.get('aaa000') is None and index.get('legacy-code') is None
+  index.close()
+
+def test_delta_log_reaches_other_workers(storage, user_id, index_path):
+  create(storage, user_id, 'abc123')
+  build_code_index(storage, index_path)
+  writer, reader = CodeIndex(index_path, check_interval=0), CodeIndex(index_path, check_interval=0)
+  storage.code_index = writer
+  create(storage, user_id, 'new001')
+  storage.delete_url(storage.get_user_url('abc123', user_id))
+  assert reader.get('new001')['original_url'] == 'https://example.com/new001'
+  assert reader.get('abc123') is MISSING
+  # A rebuild folds the log into the new index
+  assert build_code_index(storage, index_path) == 1
+  assert reader.get('new001') is not None and reader.get('abc123') is None
+  for index in (writer, reader):
+    index.close()
+
+def test_delta_past_its_bound_rebuilds_the_index(storage, user_id, index_path):
+  create(storage, user_id, 'abc123')
+  build_code_index(storage, index_path)
+  writer = CodeIndex(index_path, check_interval=0, max_delta=2)
+  reader = CodeIndex(index_path, check_interval=0, max_delta=2, rebuild=lambda: build_code_index(storage, index_path))
+  storage.code_index = writer
+  create(storage, user_id, 'new001', 'new002')
+  assert reader.get('new001') is not None and reader.rebuilds == 0
+  create(storage, user_id, 'new003')
+  # Delta dropped, lookups go to the DB while the index is rebuilt
+  assert reader.get('new001') is None and writer.get('abc123') is None
+  deadline = time.monotonic() + 5
+  while not reader.rebuilds and time.monotonic() < deadline:
+    time.sleep(0.01)
+  assert reader.get('new003')['original_url'] == 'https://example.com/new003' and reader.rebuilds == 1
+  assert reader.links == 4 and len(reader._delta) == 0
+  for index in (writer, reader):
+    index.close()
+
+def test_code_format_must_fit_keys(storage, index_path):
+  with pytest.raises(ValueError):
+    CodeIndex(index_path, length=13)
+  with pytest.raises(ValueError):
+    build_code_index(storage, index_path, length=13)
+  CodeIndex(index_path, length=12).close()
+
+def test_index_failures_dont_fail_writes(storage, user_id):
+  class BrokenIndex:
+    def get(self, code):
+      return None
+    def log(self, rows, deleted):
+      raise struct.error('argument out of range')
+  storage.code_index = BrokenIndex()
+  create(storage, user_id, 'abc123')
+  assert storage.get_link('abc123') is not None
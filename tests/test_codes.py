@@ -0,0 +1,55 @@
+import pytest
+from utils import encode_code, decode_code, FeistelPermutation, ShortCodeAllocator
+
+def test_encode_decode_round_trip():
+  for number in (0, 1, 35, 36, 36 ** 6 - 1):
+    code = encode_code(number)
+    assert len(code) == 6 and decode_code(code) == number
+  assert encode_code(5, 'ab', 4) == 'abab'
+  assert decode_code('ABC') is None
+  with pytest.raises(ValueError):
+    encode_code(36 ** 6)
+
+def test_feistel_permutation_is_a_bijection():
+  for domain in (2, 36, 1000, 36 ** 2):
+    permutation = FeistelPermutation(domain, 'key')
+    assert sorted(permutation.permute(value) for value in range(domain)) == list(range(domain))
+  assert [FeistelPermutation(1000, 'a').permute(v) for v in range(10)] != [FeistelPermutation(1000, 'b').permute(v) for v in range(10)]
+
+def test_next_takes_codes_from_reserved_blocks(storage):
+  allocator = ShortCodeAllocator(storage, key='key', block_size=10)
+  codes = [allocator.next() for _ in range(25)]
+  assert len(set(codes)) == 25
+  # Three blocks reserved
+  assert storage.reserve_ids('urls', 0) == 30
+
+def test_allocator_reserves_whole_blocks(storage):
+  allocator = ShortCodeAllocator(storage, key='key', block_size=100)
+  codes = [allocator.next() for _ in range(3)] + [allocator.allocate(1)[0] for _ in range(5)]
+  # Single creates take ids from the reserved block, one reservation so far
+  assert storage.reserve_ids('urls', 0) == 100
+  codes += allocator.allocate(250)
+  # 92 ids left in the block, the other 158 reserved at once
+  assert storage.reserve_ids('urls', 0) == 100 + 158
+  codes += allocator.allocate(1)
+  assert storage.reserve_ids('urls', 0) == 100 + 158 + 100
+  assert len(set(codes)) == len(codes) == 259
+
+def test_allocators_never_share_codes(storage):
+  first = ShortCodeAllocator(storage, key='key', block_size=10)
+  second = ShortCodeAllocator(storage, key='key', block_size=10)
+  codes = [allocator.allocate(3)[0] for _ in range(20) for allocator in (first, second)]
+  codes += [allocator.next() for _ in range(20) for allocator in (first, second)]
+  assert len(set(codes)) == len(codes)
+
+def test_allocator_sequential_without_key(storage):
+  allocator = ShortCodeAllocator(storage, block_size=10)
+  assert allocator.allocate(3) == ['aaaaaa', 'aaaaab', 'aaaaac']
+
+def test_allocator_code_space(storage):
+  with pytest.raises(ValueError):
+    ShortCodeAllocator(storage, alphabet='aa')
+  allocator = ShortCodeAllocator(storage, alphabet='ab', length=2, block_size=2)
+  assert sorted(allocator.allocate(4)) == ['aa', 'ab', 'ba', 'bb']
+  with pytest.raises(ValueError):
+    allocator.next()
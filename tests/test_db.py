@@ -0,0 +1,60 @@
+import sqlite3
+import pytest
+from flask import Flask
+from db import ConnectionPool
+from storage import create_storage
+
+@pytest.fixture
+def pool(tmp_path):
+  pool = ConnectionPool(str(tmp_path / 'test.db'), pool_size=2)
+  yield pool
+  pool.close()
+
+def test_connections_are_tuned(pool):
+  conn = pool.connect()
+  assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+  # NORMAL
+  assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+  assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == 5000
+  # INCREMENTAL, set before the new file got its first table
+  assert conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+  assert conn.execute("SELECT 1 AS one").fetchone()['one'] == 1
+  conn.close()
+
+def test_released_connections_are_reused(pool):
+  conn = pool.acquire()
+  pool.release(conn)
+  assert pool.acquire() is conn
+  assert pool.created == 1
+
+def test_idle_connections_beyond_pool_size_are_closed(pool):
+  connections = [pool.acquire() for _ in range(3)]
+  for conn in connections:
+    pool.release(conn)
+  assert pool.idle() == 2
+  with pytest.raises(sqlite3.ProgrammingError):
+    connections[-1].execute("SELECT 1")
+
+def test_release_rolls_back_open_transaction(pool):
+  conn = pool.acquire()
+  conn.execute("CREATE TABLE items (name TEXT)")
+  conn.commit()
+  conn.execute("INSERT INTO items VALUES ('half done')")
+  pool.release(conn)
+  conn = pool.acquire()
+  assert conn.execute("SELECT COUNT(*) FROM items").fetchone()[0] == 0
+
+def test_app_context_reuses_one_connection(tmp_path):
+  app = Flask(__name__)
+  app.config['DATABASE'] = str(tmp_path / 'test.db')
+  storage = create_storage(app)
+  with app.app_context():
+    with storage.connection() as first, storage.connection() as second:
+      assert first is second
+      # Unshared connections (e.g. reserving code ids) never commit the request's transaction
+      with storage.connection(shared=False) as other:
+        assert other is not first
+    assert storage.pool.idle() == 1
+  # Given back to the pool on teardown
+  assert storage.pool.idle() == 2
+  storage.close()
@@ -0,0 +1,30 @@
+from links import link_policy, link_policy_error, expires_in_error, link_expiry, is_expired, redirect_policy
+
+def test_link_policy_defaults():
+  assert link_policy() == (302, 0)
+  assert link_policy(301, default_max_age=3600) == (301, 3600)
+  assert link_policy(307, default_max_age=3600) == (307, 0)
+  assert link_policy(308, 60) == (308, 60)
+
+def test_policy_validation():
+  assert link_policy_error(None, None) is None and link_policy_error(308, 0) is None
+  assert link_policy_error(303, None) and link_policy_error('301', None) and link_policy_error(True, None)
+  assert link_policy_error(301, -1) and link_policy_error(301, 10 ** 9)
+  assert expires_in_error(None) is None and expires_in_error(60) is None
+  assert expires_in_error(0) and expires_in_error(1.5)
+
+def test_expiry():
+  assert link_expiry(None) is None and link_expiry(60, now=1000) == 1060
+  assert is_expired({'expires_at': 1000}, now=1000) and not is_expired({'expires_at': 1001}, now=1000)
+  assert not is_expired({'expires_at': None})
+
+def test_redirect_policy():
+  assert redirect_policy({'redirect_status': 302, 'cache_max_age': 0, 'expires_at': None}) == (302, 'no-store')
+  assert redirect_policy({'redirect_status': 301, 'cache_max_age': 60, 'expires_at': None}) == (301, 'public, max-age=60')
+  # Rows cached before links had a policy
+  assert redirect_policy({'id': 1, 'original_url': 'https://example.com'}) == (302, 'no-store')
+
+def test_cache_lifetime_stops_at_expiry(monkeypatch):
+  monkeypatch.setattr('time.time', lambda: 1000)
+  assert redirect_policy({'redirect_status': 301, 'cache_max_age': 60, 'expires_at': 1030}) == (301, 'public, max-age=30')
+  assert redirect_policy({'redirect_status': 301, 'cache_max_age': 60, 'expires_at': 900}) == (301, 'no-store')
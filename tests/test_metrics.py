@@ -0,0 +1,46 @@
+import sqlite3
+from metrics import Registry, QueryMetrics, InstrumentedConnection, query_label, parse_networks, address_in
+
+def test_render_counters_and_histograms():
+  registry = Registry()
+  requests = registry.counter('requests_total', 'Requests.', ['method'])
+  latency = registry.histogram('latency_seconds', 'Latency.', ['route'], buckets=(0.1, 1.0))
+  requests.inc('GET')
+  requests.inc('GET', amount=2)
+  latency.observe(0.5, 'a"b')
+  registry.collected('broken', 'Fails at scrape time.', [], lambda: 1 / 0)
+  lines = registry.render().splitlines()
+  assert '# TYPE requests_total counter' in lines and 'requests_total{method="GET"} 3' in lines
+  assert 'latency_seconds_bucket{route="a\\"b",le="0.1"} 0' in lines
+  assert 'latency_seconds_bucket{route="a\\"b",le="+Inf"} 1' in lines
+  assert 'latency_seconds_sum{route="a\\"b"} 0.5' in lines and 'latency_seconds_count{route="a\\"b"} 1' in lines
+  # Other metrics are still rendered
+  assert not any(line.startswith('# HELP broken') for line in lines)
+
+def test_query_label():
+  assert query_label('SELECT * FROM urls WHERE id = ?') == 'SELECT urls'
+  assert query_label('insert into click_events (url_id) VALUES (?)') == 'INSERT click_events'
+  assert query_label('CREATE TABLE IF NOT EXISTS users (id INTEGER)') == 'CREATE users'
+  assert query_label('PRAGMA journal_mode = WAL') == 'PRAGMA'
+  assert query_label('') == 'unknown'
+
+def test_instrumented_connection_times_queries(tmp_path):
+  registry = Registry()
+  metrics = QueryMetrics(registry)
+  conn = InstrumentedConnection(sqlite3.connect(str(tmp_path / 'test.db')), metrics)
+  conn.execute("CREATE TABLE urls (id INTEGER)")
+  cursor = conn.cursor()
+  cursor.executemany("INSERT INTO urls (id) VALUES (?)", [(1,), (2,)])
+  conn.commit()
+  assert [row for row in cursor.execute("SELECT id FROM urls")] == [(1,), (2,)]
+  output = registry.render()
+  assert 'shortener_db_query_duration_seconds_count{query="INSERT urls"} 1' in output
+  assert 'shortener_db_query_duration_seconds_count{query="SELECT urls"} 1' in output
+  assert 'shortener_db_commits_total 1' in output
+  conn.close()
+
+def test_networks():
+  networks = parse_networks(' 127.0.0.1, 10.0.0.0/8,,::1')
+  assert address_in('10.1.2.3', networks) and address_in('127.0.0.1', networks) and address_in('::1', networks)
+  assert not address_in('198.51.100.1', networks) and not address_in(None, networks)
+  assert not address_in('unknown', networks) and parse_networks('') == []
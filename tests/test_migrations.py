@@ -0,0 +1,23 @@
+import pytest
+from migrations import migration
+from storage import create_storage
+
+def test_migrate_is_idempotent(storage):
+  assert storage.migrate() == []
+  version, pending = storage.schema_status()
+  assert version > 0 and pending == []
+
+def test_migrate_up_to_target(app):
+  storage = create_storage(app)
+  _, pending = storage.schema_status()
+  assert [version for version, _ in storage.migrate(2)] == [1, 2]
+  assert storage.schema_status() == (2, pending[2:])
+  assert storage.migrate()[0][0] == 3 and storage.schema_status()[1] == []
+  storage.close()
+
+def test_migrations_register_in_order():
+  registry = []
+  migration(1, 'first', registry)(lambda conn: None)
+  with pytest.raises(ValueError):
+    migration(1, 'again', registry)(lambda conn: None)
+  assert [name for _, name, _ in registry] == ['first']
@@ -0,0 +1,8 @@
+from models import User
+
+def test_snapshot_carries_no_password_hash():
+  user = User(7, 'alice', 'hash', 'Al', 'Ice', 'a@example.com', None, 'https://alice.example.com')
+  snapshot = user.to_snapshot()
+  assert 'password' not in snapshot
+  copy = User.from_snapshot(snapshot)
+  assert copy.get_id() == '7' and copy.website == user.website and copy.password is None
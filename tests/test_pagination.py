@@ -0,0 +1,65 @@
+import sys
+import pytest
+import pagination
+from clicks import write_clicks
+from pagination import encode_token, decode_token
+from storage import StorageError
+
+def create(storage, user_id, count):
+  storage.create_urls(user_id, 'alice', [(f'https://example.com/{n}', f'code{n:02}') for n in range(count)])
+
+def codes(page):
+  return [row['shortened_url'] for row in page]
+
+def test_page_tokens():
+  assert decode_token(encode_token((3, 12)), 'clicks') == (3, 12)
+  assert decode_token('3_12', 'recent') is None and decode_token('x', 'recent') is None
+
+def test_pages_follow_each_other(storage, user_id):
+  create(storage, user_id, 5)
+  page = storage.user_urls_page(user_id, 'recent', None, 2)
+  assert codes(page) == ['code04', 'code03'] and page.next_page
+  page = storage.user_urls_page(user_id, 'recent', page.next_page, 2)
+  assert codes(page) == ['code02', 'code01']
+  page = storage.user_urls_page(user_id, 'recent', page.next_page, 2)
+  assert codes(page) == ['code00'] and page.next_page is None
+
+def test_pages_sorted_by_clicks(storage, user_id):
+  create(storage, user_id, 3)
+  write_clicks(storage, {storage.get_link('code01')['id']: 2}, [])
+  page = storage.user_urls_page(user_id, 'clicks', None, 1, lambda row: dict(row, seen=True))
+  rows = list(page)
+  assert rows[0]['shortened_url'] == 'code01' and rows[0]['seen']
+  assert codes(storage.user_urls_page(user_id, 'clicks', page.next_page, 5)) == ['code02', 'code00']
+
+def test_empty_page(storage, user_id):
+  page = storage.user_urls_page(user_id, 'unknown sort', 'bad token', 2)
+  assert not page and codes(page) == []
+
+# Cursor whose connection breaks after the first row
+class BreakingCursor:
+  def __init__(self, cursor, error):
+    self.cursor = cursor
+    self.error = error
+    self.rows = 0
+
+  def execute(self, *args):
+    return self.cursor.execute(*args)
+
+  def fetchone(self):
+    self.rows += 1
+    if self.rows > 1:
+      raise self.error
+    return self.cursor.fetchone()
+
+  def fetchall(self):
+    raise self.error
+
+def test_driver_errors_raise_in_storage_call(storage, user_id, monkeypatch):
+  create(storage, user_id, 3)
+  error = storage.errors[0]('connection lost')
+  monkeypatch.setattr(sys.modules[type(storage).__module__], 'user_urls_page',
+                      lambda cursor, *args, **kwargs: pagination.user_urls_page(BreakingCursor(cursor, error), *args, **kwargs))
+  # Raised where routes catch StorageError, not while a template iterates the page
+  with pytest.raises(StorageError):
+    storage.user_urls_page(user_id, 'recent', None, 2)
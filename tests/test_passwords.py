@@ -0,0 +1,36 @@
+import threading
+import time
+import pytest
+from flask_bcrypt import Bcrypt
+from passwords import PasswordHasher, HasherBusy
+
+def test_hash_and_check():
+  hasher = PasswordHasher(Bcrypt(), log_rounds=4)
+  password_hash = hasher.generate('secret')
+  assert password_hash.startswith('$2b$04$')
+  assert hasher.check(password_hash, 'secret') and not hasher.check(password_hash, 'wrong')
+  assert not hasher.needs_rehash(password_hash)
+  assert PasswordHasher(Bcrypt(), log_rounds=5).needs_rehash(password_hash)
+  assert hasher.needs_rehash('plain text')
+  hasher.close()
+
+def test_full_pool_rejects_requests():
+  release = threading.Event()
+  class SlowBcrypt:
+    def check_password_hash(self, password_hash, password):
+      release.wait()
+      return True
+  hasher = PasswordHasher(SlowBcrypt(), workers=1, queue_size=1)
+  threads = [threading.Thread(target=hasher.check, args=('hash', 'secret')) for _ in range(2)]
+  for thread in threads:
+    thread.start()
+  # One check hashing, one waiting
+  while hasher.in_flight < 2:
+    time.sleep(0.001)
+  with pytest.raises(HasherBusy):
+    hasher.check('hash', 'secret')
+  release.set()
+  for thread in threads:
+    thread.join()
+  assert (hasher.rejected, hasher.in_flight) == (1, 0)
+  hasher.close()
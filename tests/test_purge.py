@@ -0,0 +1,94 @@
+import time
+from cache import LRUCache
+from clicks import ClickBuffer, SharedClickBuffer, write_clicks
+from purge import LinkPurger
+from storage import create_storage
+
+def create(storage, user_id, *codes, **policy):
+  storage.create_urls(user_id, 'alice', [(f'https://example.com/{code}', code) for code in codes], **policy)
+
+def test_purge_urls(storage, user_id):
+  now = int(time.time())
+  create(storage, user_id, 'old001', expires_at=now - 10)
+  create(storage, user_id, 'new001', expires_at=now + 3600)
+  create(storage, user_id, 'keep01')
+  assert storage.purge_urls(now) == ['old001']
+  assert storage.get_link('old001') is None and storage.get_link('new001') is not None
+  # Unclicked links count from their creation time
+  assert storage.purge_urls(now, unclicked_before=now - 60) == []
+  assert sorted(storage.purge_urls(now + 1, unclicked_before=now + 5)) == ['keep01', 'new001']
+  assert storage.user_stats(user_id) == (0, 0)
+
+def test_unclicked_purge_keeps_cached_and_recently_clicked_links(storage, user_id):
+  now = int(time.time())
+  create(storage, user_id, 'plain1', 'event1')
+  create(storage, user_id, 'perm01', redirect_status=301)
+  create(storage, user_id, 'perm02', redirect_status=308)
+  create(storage, user_id, 'cache1', cache_max_age=60)
+  create(storage, user_id, 'keep01')
+  # A click event in the unclicked window, logged without its count
+  clicked_at = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(now + 10))
+  write_clicks(storage, {}, [(storage.get_link('event1')['id'], clicked_at, None, None)])
+  keep = [storage.get_link('keep01')['id']]
+  assert storage.purge_urls(now + 1, unclicked_before=now + 5, keep=keep) == ['plain1']
+
+def test_purger_deletes_in_batches(storage, user_id):
+  now = int(time.time())
+  create(storage, user_id, *[f'old{n:03}' for n in range(5)], expires_at=now - 10)
+  create(storage, user_id, 'keep01')
+  cache = LRUCache()
+  cache.set('old000', {'id': 1})
+  buffer = ClickBuffer(storage, flush_interval=3600)
+  purger = LinkPurger(storage, cache, buffer, batch_size=2, pause=0)
+  assert purger.run_once() == 5 and purger.purged == 5
+  assert cache.get('old000') is None
+  assert [row['shortened_url'] for row in storage.link_batch(0, 10)] == ['keep01']
+  assert purger.run_once() == 0
+  buffer.stop()
+
+def test_pending_clicks_keep_links(storage, user_id):
+  create(storage, user_id, 'click1')
+  buffer = ClickBuffer(storage, flush_interval=3600)
+  buffer.record(storage.get_link('click1')['id'], user_id)
+  # Every link is older than a negative age, but this one was just clicked
+  purger = LinkPurger(storage, LRUCache(), buffer, unclicked_age=-10, pause=0)
+  assert purger.run_once() == 0 and storage.get_link('click1') is not None
+  buffer.stop()
+
+def test_purger_drains_clicks_of_all_workers(storage, tier, user_id):
+  create(storage, user_id, 'click1', 'click2', 'plain1')
+  other = SharedClickBuffer(storage, tier, flush_interval=3600, batch_size=1)
+  for code in ('click1', 'click2'):
+    other.record(storage.get_link(code)['id'], user_id)
+  buffer = SharedClickBuffer(storage, tier, flush_interval=3600, batch_size=1)
+  purger = LinkPurger(storage, LRUCache(), buffer, unclicked_age=-10, pause=0)
+  assert purger.run_once() == 1 and storage.get_link('plain1') is None
+  assert storage.get_user_url('click2', user_id)['clicks'] == 1
+  for worker in (other, buffer):
+    worker.stop()
+
+def test_purger_keeps_unclicked_links_while_tier_is_down(storage, tier, user_id):
+  create(storage, user_id, 'plain1')
+  create(storage, user_id, 'old001', expires_at=int(time.time()) - 10)
+  buffer = SharedClickBuffer(storage, tier, flush_interval=3600)
+  tier.client.down = True
+  purger = LinkPurger(storage, LRUCache(), buffer, unclicked_age=-10, pause=0)
+  assert purger.run_once() == 1 and storage.get_link('plain1') is not None
+  tier.client.down = False
+  buffer.stop()
+
+def test_links_older_than_creation_time_are_backfilled(app):
+  storage = create_storage(app)
+  _, pending = storage.schema_status()
+  backfill = [version for version, name in pending if name == 'backfill creation time of urls'][0]
+  storage.migrate(backfill - 1)
+  storage.create_user('alice', 'hash', 'Al', 'Ice', 'a@example.com', None, None)
+  with storage.connection(shared=False) as conn:
+    conn.execute("INSERT INTO urls (original_url, shortened_url, user_id) VALUES ('https://example.com', 'old001', 1)")
+    conn.commit()
+  storage.migrate()
+  now = int(time.time())
+  # Old unclicked links get the full unclicked age from the upgrade on
+  assert storage.purge_urls(now, unclicked_before=now - 60) == []
+  assert storage.link_batch(0, 1)[0]['shortened_url'] == 'old001'
+  storage.close()
@@ -0,0 +1,34 @@
+import pytest
+from ratelimit import RateLimiter, SharedRateLimiter, parse_budget
+
+def test_parse_budget():
+  assert parse_budget('300/60') == (300, 60)
+  assert parse_budget('') is None
+  with pytest.raises(ValueError):
+    parse_budget('0/60')
+
+def test_rate_limiter_token_bucket():
+  limiter = RateLimiter({'search': (3, 60)})
+  assert [limiter.take('search', 'ip:1') for _ in range(3)] == [None] * 3
+  assert limiter.take('search', 'ip:1') == 20
+  assert limiter.take('search', 'ip:2') is None
+  assert limiter.limited == 1
+
+def test_rate_limiter_evicts_idle_clients():
+  limiter = RateLimiter({'search': (1, 60)}, maxsize=2)
+  for client in ('a', 'b', 'c'):
+    limiter.take('search', client)
+  # a was dropped and comes back with a full bucket
+  assert limiter.take('search', 'a') is None
+  assert limiter.take('search', 'c') is not None
+
+def test_shared_rate_limiter(tier):
+  budgets = {'api': (3, 60)}
+  first, second = SharedRateLimiter(tier, budgets), SharedRateLimiter(tier, budgets)
+  # One budget across workers
+  assert [limiter.take('api', 'key:1') for limiter in (first, second, first)] == [None] * 3
+  wait = second.take('api', 'key:1')
+  assert wait is not None and 1 <= wait <= 120
+  assert second.limited == 1
+  tier.client.down = True
+  assert first.take('api', 'key:1') is None
@@ -0,0 +1,31 @@
+from search_index import url_location, match_expression, parse_page_token
+
+def test_url_location_splits_hostname_and_path():
+  assert url_location('https://www.python.org/downloads/release?x=1') == 'python org downloads release'
+  assert url_location('not a url') == 'not a url'
+
+def test_match_expression_prefix_matches_every_word():
+  assert match_expression('Python docs!') == '"Python"* "docs"*'
+  assert match_expression('!?') is None
+
+def test_invalid_page_token():
+  assert parse_page_token('-1.5_3') == (-1.5, 3)
+  assert parse_page_token('nonsense') is None and parse_page_token(None) is None
+
+def test_search_pages_results(storage, user_id):
+  storage.create_urls(user_id, 'alice', [('https://www.python.org/downloads', 'py0001'),
+                                         ('https://docs.python.org/3/', 'py0002'),
+                                         ('https://www.rust-lang.org', 'rs0001')])
+  first, next_page = storage.search_urls('python', limit=1)
+  assert len(first) == 1 and next_page
+  second, next_page = storage.search_urls('python', limit=1, after=next_page)
+  assert sorted(row['shortened_url'] for row in first + second) == ['py0001', 'py0002'] and next_page is None
+  # Words match as prefixes, usernames too
+  assert [row['shortened_url'] for row in storage.search_urls('rus')[0]] == ['rs0001']
+  assert len(storage.search_urls('alice')[0]) == 3
+  assert storage.search_urls('')[0] == []
+
+def test_deleted_urls_leave_index(storage, user_id):
+  storage.create_urls(user_id, 'alice', [('https://www.python.org/downloads', 'py0001')])
+  storage.delete_url(storage.get_user_url('py0001', user_id))
+  assert storage.search_urls('python')[0] == []
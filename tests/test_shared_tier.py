@@ -0,0 +1,53 @@
+import pytest
+from cache import MISSING
+from shared_tier import SharedCache, TierDown
+from clicks import SharedClickBuffer
+
+# Shared tier users, run against the in-process stand-in (memory://) and with it down
+
+def test_tier_down_raises_and_recovers(tier):
+  assert tier.run(lambda client: client.set(tier.key('a'), '1')) is True
+  tier.client.down = True
+  with pytest.raises(TierDown):
+    tier.run(lambda client: client.get(tier.key('a')))
+  tier.client.down = False
+  assert tier.run(lambda client: client.get(tier.key('a'))) == '1'
+  assert tier.failures == 1
+
+def test_shared_cache(tier):
+  first = SharedCache(tier, 'link', dumps=str, loads=int, local_ttl=60)
+  second = SharedCache(tier, 'link', dumps=str, loads=int, local_ttl=60)
+  first.set('abc', 1)
+  first.set_missing('nosuch')
+  assert second.get('abc') == 1 and second.get('nosuch') is MISSING
+  assert second.stats()['shared_hits'] == 2
+  first.invalidate('abc')
+  # Other workers keep their local copy until it expires
+  assert second.get('abc') == 1
+  assert SharedCache(tier, 'link', dumps=str, loads=int).get('abc') is None
+
+def test_shared_cache_falls_back_while_tier_is_down(tier):
+  cache = SharedCache(tier, 'link', dumps=str, loads=int)
+  tier.client.down = True
+  cache.set('abc', 1)
+  assert cache.get('abc') == 1
+  assert cache.get('other', 'default') == 'default'
+
+def test_shared_click_buffer(storage, tier, user_id):
+  storage.create_urls(user_id, 'alice', [('https://example.com', 'abc123')])
+  url_id = storage.get_link('abc123')['id']
+  first = SharedClickBuffer(storage, tier, flush_interval=3600)
+  second = SharedClickBuffer(storage, tier, flush_interval=3600)
+  first.record(url_id, user_id)
+  second.record(url_id, user_id)
+  assert first.pending(url_id) == 2 and second.pending_for_user(user_id) == 2
+  # Clicks counted while the tier is down stay in the worker
+  tier.client.down = True
+  first.record(url_id, user_id)
+  tier.client.down = False
+  assert second.flush() == 2
+  assert first.flush() == 1
+  assert storage.get_user_url('abc123', user_id)['clicks'] == 3
+  assert first.pending_for_user(user_id) == 0
+  for buffer in (first, second):
+    buffer.stop()
@@ -0,0 +1,30 @@
+import os
+import pytest
+from snapshot import write_snapshot, LinkSnapshot
+from storage import StorageError
+
+def test_snapshot_answers_lookups(storage, user_id, tmp_path):
+  storage.create_urls(user_id, 'alice', [('https://example.com/1', 'abc001'), ('https://example.com/2', 'abc002')],
+                      redirect_status=301, cache_max_age=60, expires_at=2000000000)
+  path = str(tmp_path / 'links.db')
+  assert write_snapshot(storage, path, batch_size=1) == 2
+  snapshot = LinkSnapshot(path)
+  link = snapshot.get_link('abc002')
+  assert dict(link) == dict(storage.get_link('abc002'))
+  assert snapshot.get_link('nosuch') is None and snapshot.links == 2
+  snapshot.close()
+
+def test_snapshot_switches_to_new_files(storage, user_id, tmp_path):
+  path = str(tmp_path / 'links.db')
+  snapshot = LinkSnapshot(path, check_interval=0)
+  with pytest.raises(StorageError):
+    snapshot.get_link('abc001')
+  write_snapshot(storage, path)
+  assert snapshot.get_link('abc001') is None
+  storage.create_urls(user_id, 'alice', [('https://example.com/1', 'abc001')])
+  write_snapshot(storage, path)
+  assert snapshot.get_link('abc001')['original_url'] == 'https://example.com/1'
+  # Loaded snapshot still served while the file is missing
+  os.remove(path)
+  assert snapshot.get_link('abc001') is not None and snapshot.loads == 2
+  snapshot.close()
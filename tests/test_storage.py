@@ -0,0 +1,45 @@
+import pytest
+from storage import CodeCollision
+
+# Storage interface, run against every backend (see conftest.app)
+
+def create(storage, user_id, *codes, **policy):
+  storage.create_urls(user_id, 'alice', [(f'https://example.com/{code}', code) for code in codes], **policy)
+
+def test_users(storage, user_id):
+  assert storage.get_user(user_id)['username'] == 'alice'
+  storage.update_user('alice', 'Alice', 'Ice', 'alice@example.com', '123', None)
+  assert storage.get_user(user_id)['fname'] == 'Alice'
+  storage.update_password(user_id, 'new hash')
+  assert storage.get_user_by_username('alice')['password'] == 'new hash'
+  assert storage.get_user_by_username('bob') is None
+
+def test_create_and_get_links(storage, user_id):
+  create(storage, user_id, 'abc123', 'def456', redirect_status=301, cache_max_age=60)
+  link = storage.get_link('abc123')
+  assert link['original_url'] == 'https://example.com/abc123'
+  assert (link['user_id'], link['redirect_status'], link['cache_max_age'], link['expires_at']) == (user_id, 301, 60, None)
+  assert storage.get_link('nosuch') is None
+  assert storage.user_stats(user_id) == (2, 0)
+  assert [row['shortened_url'] for row in storage.link_batch(0, 10)] == ['abc123', 'def456']
+  assert [row['shortened_url'] for row in storage.link_batch(link['id'], 10)] == ['def456']
+
+def test_code_collision_inserts_nothing(storage, user_id):
+  create(storage, user_id, 'abc123')
+  with pytest.raises(CodeCollision):
+    create(storage, user_id, 'new001', 'abc123')
+  assert storage.get_link('new001') is None
+  assert storage.user_stats(user_id) == (1, 0)
+
+def test_delete_url(storage, user_id):
+  create(storage, user_id, 'abc123')
+  url_row = storage.get_user_url('abc123', user_id)
+  assert storage.get_user_url('abc123', user_id + 1) is None
+  storage.delete_url(url_row)
+  assert storage.get_link('abc123') is None
+  assert storage.user_stats(user_id) == (0, 0)
+
+def test_reserve_ids(storage):
+  assert storage.reserve_ids('urls', 100) == 100
+  assert storage.reserve_ids('urls', 5) == 105
+  assert storage.reserve_ids('other', 1) == 1
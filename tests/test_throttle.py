@@ -0,0 +1,37 @@
+import time
+from datetime import timedelta
+import pytest
+from throttle import LoginThrottle, SharedLoginThrottle, estimate
+
+@pytest.mark.parametrize('shared', [False, True])
+def test_login_throttle(storage, tier, shared):
+  window = timedelta(minutes=30)
+  if shared:
+    throttle = SharedLoginThrottle(storage, tier, max_attempts=3, max_ip_attempts=5, window=window)
+  else:
+    throttle = LoginThrottle(storage, max_attempts=3, max_ip_attempts=5, window=window)
+  now = time.time()
+  assert [throttle.attempt('alice', '10.0.0.1', now) for _ in range(3)] == [None] * 3
+  wait = throttle.attempt('alice', '10.0.0.1', now)
+  assert wait is not None and timedelta(0) < wait <= 2 * window
+  # Other accounts from the same IP until the IP limit
+  assert throttle.attempt('bob', '10.0.0.1', now) is None
+  assert throttle.attempt('carol', '10.0.0.1', now) is not None
+  throttle.succeeded('alice')
+  assert throttle.attempt('alice', '10.0.0.2', now) is None
+
+def test_sliding_window_estimate():
+  assert estimate(2, 10, 0, 60) == 12
+  assert estimate(2, 10, 30, 60) == 7
+  assert estimate(2, 10, 60, 60) == 2
+
+def test_login_attempts(storage):
+  keys = ['user:alice', 'ip:10.0.0.1']
+  assert storage.count_login_attempts(keys, 1000, 60) == {'user:alice': (1, 0), 'ip:10.0.0.1': (1, 0)}
+  assert storage.count_login_attempts(keys, 1000, 60)['user:alice'] == (2, 0)
+  # Next window carries this window's count as previous
+  assert storage.count_login_attempts(keys, 1060, 60)['user:alice'] == (1, 2)
+  storage.clear_login_attempts('user:alice')
+  assert storage.count_login_attempts(keys, 1060, 60) == {'user:alice': (1, 0), 'ip:10.0.0.1': (2, 2)}
+  storage.purge_login_attempts(2000)
+  assert storage.count_login_attempts(keys, 2000, 60)['ip:10.0.0.1'] == (1, 0)
@@ -0,0 +1,18 @@
+from clicks import write_clicks
+
+def test_counters_follow_urls_and_clicks(storage, user_id):
+  assert storage.user_stats(user_id) == (0, 0)
+  storage.create_urls(user_id, 'alice', [('https://example.com/1', 'abc001'), ('https://example.com/2', 'abc002')])
+  first, second = storage.get_link('abc001')['id'], storage.get_link('abc002')['id']
+  write_clicks(storage, {first: 2, second: 1}, [])
+  assert storage.user_stats(user_id) == (2, 3)
+  storage.delete_url(storage.get_user_url('abc001', user_id))
+  assert storage.user_stats(user_id) == (1, 1)
+
+def test_rebuild_fixes_drift(storage, user_id):
+  storage.create_urls(user_id, 'alice', [('https://example.com/1', 'abc001')])
+  with storage.connection() as conn:
+    conn.execute("UPDATE user_stats SET url_count = 7, total_clicks = 9")
+    conn.commit()
+  storage.rebuild_user_stats()
+  assert storage.user_stats(user_id) == (1, 0)
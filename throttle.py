@@ -0,0 +1,112 @@
+import math
+import time
+from datetime import timedelta
+from shared_tier import TierDown
+
+# Login attempts allowed within a sliding window, per account and per client IP
+# Attempts are counted before the password is checked, so blocked attempts cost no bcrypt work
+# Account counters are reset by a successful login, IP counters only decay (shared NATs get a higher limit)
+MAX_LOGIN_ATTEMPTS = 5
+MAX_IP_LOGIN_ATTEMPTS = 50
+LOGIN_WINDOW = timedelta(minutes=30)
+
+# Sliding window estimate from counts of the current fixed window and the one before it,
+# the previous window's count weighted by how much of it still overlaps the sliding window
+def estimate(attempts, previous, elapsed, window):
+  return attempts + previous * (1 - elapsed / window)
+
+# Seconds from window_start until the next attempt is allowed, i.e. the estimate drops below limit
+def retry_after(attempts, previous, window, limit):
+  if attempts >= limit:
+    # Wait for the next window, until this window's count has decayed enough
+    return window + window * (1 - (limit - 1) / attempts)
+  return window * (1 - (limit - 1 - attempts) / previous)
+
+# Login throttling kept in the login_attempts table, one upsert per attempt counts it against all its keys
+class LoginThrottle:
+  def __init__(self, storage, max_attempts=MAX_LOGIN_ATTEMPTS, max_ip_attempts=MAX_IP_LOGIN_ATTEMPTS,
+               window=LOGIN_WINDOW):
+    self.storage = storage
+    self.max_attempts = max_attempts
+    self.max_ip_attempts = max_ip_attempts
+    self.window = int(window.total_seconds())
+    self._purged_at = 0
+
+  # Throttle keys of an attempt with their limits
+  def _limits(self, username, ip):
+    limits = {'user:' + username: self.max_attempts}
+    if ip:
+      limits['ip:' + ip] = self.max_ip_attempts
+    return limits
+
+  # Count attempts of keys in window starting at window_start, returns {key: (attempts, previous)}
+  def _count(self, keys, window_start):
+    return self.storage.count_login_attempts(keys, window_start, self.window)
+
+  # Count a login attempt of username from ip
+  # Returns None if it may go ahead, or how long until the account/IP may try again if it's blocked
+  def attempt(self, username, ip, now=None):
+    now = time.time() if now is None else now
+    window_start = int(now) - int(now) % self.window
+    self._purge(window_start)
+    limits = self._limits(username, ip)
+    counts = self._count(list(limits), window_start)
+    wait = None
+    for key, limit in limits.items():
+      attempts, previous = counts[key]
+      if estimate(attempts, previous, now - window_start, self.window) > limit:
+        seconds = retry_after(attempts, previous, self.window, limit) - (now - window_start)
+        wait = max(wait or 0, math.ceil(seconds))
+    return timedelta(seconds=wait) if wait is not None else None
+
+  # Clear account's attempts after a successful login
+  def succeeded(self, username):
+    self.storage.clear_login_attempts('user:' + username)
+
+  # Drop counters older than the previous window, at most once per window per worker
+  def _purge(self, window_start):
+    if window_start > self._purged_at:
+      self._purged_at = window_start
+      self.storage.purge_login_attempts(window_start - self.window)
+
+# Login throttling kept in the shared tier: one counter per key and window, expiring after two windows
+# Each attempt increments the current window's counters and reads the previous ones in one MULTI/EXEC
+# Uses the login_attempts table while the tier is down (counts in the tier meanwhile don't carry over)
+class SharedLoginThrottle(LoginThrottle):
+  def __init__(self, storage, tier, max_attempts=MAX_LOGIN_ATTEMPTS, max_ip_attempts=MAX_IP_LOGIN_ATTEMPTS,
+               window=LOGIN_WINDOW):
+    super().__init__(storage, max_attempts, max_ip_attempts, window)
+    self.tier = tier
+
+  def _key(self, key, window_start):
+    return self.tier.key('login', key, window_start)
+
+  def _count(self, keys, window_start):
+    def count(client):
+      pipe = client.pipeline()
+      for key in keys:
+        pipe.incr(self._key(key, window_start))
+        pipe.expire(self._key(key, window_start), 2 * self.window)
+        pipe.get(self._key(key, window_start - self.window))
+      return pipe.execute()
+    try:
+      results = self.tier.run(count)
+    except TierDown:
+      return super()._count(keys, window_start)
+    return {key: (int(results[index * 3]), int(results[index * 3 + 2] or 0)) for index, key in enumerate(keys)}
+
+  def succeeded(self, username):
+    now = int(time.time())
+    window_start = now - now % self.window
+    try:
+      self.tier.run(lambda client: client.delete(self._key('user:' + username, window_start),
+                                                 self._key('user:' + username, window_start - self.window)))
+    except TierDown:
+      pass
+    super().succeeded(username)
+
+  # Tier counters expire by themselves, the table is only used while the tier is down
+  def _purge(self, window_start):
+    if self.tier.available:
+      return
+    super()._purge(window_start)
@@ -0,0 +1,31 @@
+# Materialized per-user counters, so the dashboard doesn't COUNT/SUM all of a user's URLs
+
+# Add to a user's counters, creating the row if needed
+def increment_user_stats(cursor, user_id, urls=0, clicks=0):
+  query = """INSERT INTO user_stats (user_id, url_count, total_clicks) VALUES (?, ?, ?)
+             ON CONFLICT (user_id) DO UPDATE SET url_count = url_count + excluded.url_count,
+                                                 total_clicks = total_clicks + excluded.total_clicks"""
+  cursor.execute(query, (user_id, urls, clicks))
+
+# Add flushed clicks to owners of the clicked URLs, as (clicks, url_id) pairs
+# URLs deleted meanwhile are skipped, like their counter update
+def add_clicks_by_url(conn, clicks_by_url):
+  query = """UPDATE user_stats SET total_clicks = total_clicks + ?
+             WHERE user_id = (SELECT user_id FROM urls WHERE id = ?)"""
+  conn.executemany(query, clicks_by_url)
+
+# Get user's counters as (url_count, total_clicks)
+def get_user_stats(cursor, user_id):
+  query = "SELECT url_count, total_clicks FROM user_stats WHERE user_id = ?"
+  cursor.execute(query, (user_id,))
+  row = cursor.fetchone()
+  return (row['url_count'], row['total_clicks']) if row else (0, 0)
+
+# Recompute all counters from urls table, fixing any drift
+def rebuild_user_stats(conn):
+  conn.execute("DELETE FROM user_stats")
+  conn.execute("""INSERT INTO user_stats (user_id, url_count, total_clicks)
+                  SELECT user_id, COUNT(*), COALESCE(SUM(clicks), 0)
+                  FROM urls
+                  WHERE user_id IS NOT NULL
+                  GROUP BY user_id""")
@@ -1,7 +1,115 @@
+import hashlib
+import hmac
 import string
-import random
+import threading
 
-# Generate a short URL method
-def generate_short_url(length=6):
-  chars = string.ascii_lowercase + string.digits
-  return ''.join(random.choice(chars) for _ in range(length))
\ No newline at end of file
+# Default short code format: 6 characters of lowercase letters and digits
+DEFAULT_ALPHABET = string.ascii_lowercase + string.digits
+DEFAULT_LENGTH = 6
+
+# Encode a number as a fixed length code (bijective for 0 <= number < len(alphabet) ** length)
+def encode_code(number, alphabet=DEFAULT_ALPHABET, length=DEFAULT_LENGTH):
+  base = len(alphabet)
+  chars = []
+  for _ in range(length):
+    number, digit = divmod(number, base)
+    chars.append(alphabet[digit])
+  if number:
+    raise ValueError('Number too large for code length')
+  return ''.join(reversed(chars))
+
+# Decode a fixed length code back to its number, None if code doesn't belong to alphabet
+def decode_code(code, alphabet=DEFAULT_ALPHABET):
+  base = len(alphabet)
+  number = 0
+  for char in code:
+    digit = alphabet.find(char)
+    if digit < 0:
+      return None
+    number = number * base + digit
+  return number
+
+# Keyed permutation of range(domain), so sequential ids don't give guessable codes
+# Feistel network over the smallest even number of bits covering domain, with cycle walking
+class FeistelPermutation:
+  def __init__(self, domain, key, rounds=4):
+    self.domain = domain
+    self.key = key.encode('utf-8') if isinstance(key, str) else key
+    self.rounds = rounds
+    bits = max(2, (domain - 1).bit_length())
+    bits += bits % 2
+    self.half = bits // 2
+    self.mask = (1 << self.half) - 1
+
+  def _round(self, index, value):
+    digest = hmac.new(self.key, bytes([index]) + value.to_bytes(8, 'big'), hashlib.sha256).digest()
+    return int.from_bytes(digest[:8], 'big') & self.mask
+
+  def _encrypt(self, value):
+    left, right = value >> self.half, value & self.mask
+    for index in range(self.rounds):
+      left, right = right, left ^ self._round(index, right)
+    return (left << self.half) | right
+
+  def permute(self, value):
+    value = self._encrypt(value)
+    # Values outside domain are re-encrypted until they land inside it
+    while value >= self.domain:
+      value = self._encrypt(value)
+    return value
+
+# Collision-free short code allocator
+# Each process reserves blocks of sequence ids from storage, then mints codes from them without DB access
+class ShortCodeAllocator:
+  def __init__(self, storage, alphabet=DEFAULT_ALPHABET, length=DEFAULT_LENGTH, key=None, block_size=100, name='urls'):
+    if len(set(alphabet)) != len(alphabet) or len(alphabet) < 2:
+      raise ValueError('Alphabet must contain at least 2 unique characters')
+    self.storage = storage
+    self.alphabet = alphabet
+    self.length = length
+    self.block_size = block_size
+    self.name = name
+    self.capacity = len(alphabet) ** length
+    self.permutation = FeistelPermutation(self.capacity, key) if key else None
+    self._next = 0
+    self._end = 0
+    self._lock = threading.Lock()
+
+  # Reserve the next block of ids, returns its range
+  def _reserve(self, size):
+    end = self.storage.reserve_ids(self.name, size)
+    return end - size, end
+
+  # Map a sequence id to its code
+  def code_for(self, number):
+    if number >= self.capacity:
+      raise ValueError('Short code space exhausted, increase code length')
+    if self.permutation:
+      number = self.permutation.permute(number)
+    return encode_code(number, self.alphabet, self.length)
+
+  # Get next unique short code
+  def next(self):
+    with self._lock:
+      if self._next >= self._end:
+        self._next, self._end = self._reserve(self.block_size)
+      number = self._next
+      self._next += 1
+    return self.code_for(number)
+
+  # Get count unique short codes, reserving at least a whole block when more ids are needed
+  # Ids of the new block left over are kept for next calls, so single creates don't reserve every time
+  def allocate(self, count):
+    with self._lock:
+      available = min(count, self._end - self._next)
+      numbers = list(range(self._next, self._next + available))
+      self._next += available
+      if available < count:
+        start, end = self._reserve(max(self.block_size, count - available))
+        needed = count - available
+        numbers.extend(range(start, start + needed))
+        self._next, self._end = start + needed, end
+    return [self.code_for(number) for number in numbers]
+
+# Allocated codes never repeat, but may hit a code created before the allocator existed
+MAX_CODE_ATTEMPTS = 5